@@ -6,6 +6,7 @@ import math
 
 from pump import Pump
 from moisture import MoistureSensor
+from calibration import RAW_MAX
 from xy_motion import XY_motion
 from z_motion import Z_motion
 
@@ -49,13 +50,30 @@ class AgBot():
         await self.xy.move_relative_xy(dx, dy)
 
     async def read(self):
+        reading, confidence = await self.sense()
+        return reading
+
+    async def sense(self):
+        # Probes the soil, returns (moisture %, confidence from 0 to 1)
         await self.z.down()
-        reading = self.sensor.read()
+        reading, confidence = await self.sensor.acquire()
         await self.z.up()
-        return reading
+        return round(reading, 1), confidence
+
+    async def sense_raw(self):
+        # Probes the soil for a calibration point, returns (read_u16 value, confidence)
+        await self.z.down()
+        reading, confidence = await self.sensor.acquire(self.sensor.read_linear)
+        await self.z.up()
+        return int(round(reading * RAW_MAX / 100)), confidence
     
     async def water(self, ml):
-        await self.pump.water(ml)
+        # Returns the ml dispensed
+        return await self.pump.water(ml)
+
+    async def prime(self):
+        # Fills the pump line, over a spot that can take the purged water
+        return await self.pump.prime()
         
     def manual(self):
         # home and move a little to the center  
@@ -3,12 +3,25 @@ import aioble
 import bluetooth
 
 import json
+import os
 import struct
 
+from log_index import LogIndex, file_size, date_key_from_timestamp
+from log_rotation import LogRotation
+from log_writer import LogWriter
+from record_log import pre_zero
+
+MISSION_HISTORY = "mission_history.csv"
+ERROR_LOG = "error_log.csv"
+
+# file bytes per payload packet
+CHUNK_SIZE = 100
+
 file_types = {
     "JSON": 0x01,
     "CSV": 0x02,
-    "TBD": 0x03
+    "TBD": 0x03,
+    "BIN": 0x04
 }
 
 def calcule_hash(data):
@@ -27,19 +40,23 @@ def chunk_file(data, chunk_size):
     return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
 
 def generate_header_message(num_chunks, json_data, file_type_id):
+    return generate_stream_header_message(num_chunks, len(json_data), calcule_hash(json_data), file_type_id)
+
+def generate_stream_header_message(num_chunks, length, checksum, file_type_id):
     header = bytearray()
     header.append(0x01)
     header.append(file_type_id)
-    header.append(num_chunks)
-    header.extend(struct.pack("<I", len(json_data)))
-    header.append(calcule_hash(json_data))
+    # the chunk count only has a byte, clients go by the length
+    header.append(num_chunks & 0xFF)
+    header.extend(struct.pack("<I", length))
+    header.append(checksum)
     header.append(calcule_hash(header))
     return header
 
 def generate_payload_message(file_chunk, chunk_index):
     payload = bytearray()
     payload.append(0x02)
-    payload.append(chunk_index)
+    payload.append(chunk_index & 0xFF)
     payload.extend(file_chunk)
     payload.append(calcule_hash(payload))
     return payload
@@ -53,46 +70,134 @@ def generate_last_message(file_name=None):
     last.extend(bytearray(file_name, 'utf-8'))
     return last
 
+def checksum_update(checksum, data):
+    # calcule_hash of everything so far followed by [data]
+    return (checksum + sum(data)) % 256
+
+# opcode, file type, chunk count, length, file checksum (header checksum follows)
+HEADER_FORMAT = "<BBBIB"
+HEADER_SIZE = 9
+
+class PacketEncoder:
+    """
+    Builds the v1 packets (see Utils.send_file_task) in one preallocated
+    buffer with struct.pack_into, so sending a file allocates nothing per
+    packet. Every packet returned is a view of that buffer: send it
+    before building the next one.
+
+    Payload data is read straight into [chunk] and framed by payload().
+    """
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.buffer = bytearray(max(chunk_size + 3, HEADER_SIZE))
+        self.view = memoryview(self.buffer)
+        self.chunk = self.view[2:2 + chunk_size]
+
+    def header(self, num_chunks, length, checksum, file_type_id):
+        # the chunk count only has a byte, clients go by the length
+        struct.pack_into(HEADER_FORMAT, self.buffer, 0, 0x01, file_type_id, num_chunks & 0xFF, length, checksum)
+        self.buffer[HEADER_SIZE - 1] = calcule_hash(self.view[:HEADER_SIZE - 1])
+        return self.view[:HEADER_SIZE]
+
+    def payload(self, index, size):
+        # Frames the [size] bytes already in [chunk] as chunk [index]
+        self.buffer[0] = 0x02
+        self.buffer[1] = index & 0xFF
+        self.buffer[2 + size] = calcule_hash(self.view[:2 + size])
+        return self.view[:3 + size]
+
+    def last(self, file_name=None):
+        self.buffer[0] = 0x03
+        if file_name is None:
+            return self.view[:1]
+        name = file_name.encode('utf-8')[:len(self.buffer) - 1]
+        self.view[1:1 + len(name)] = name
+        return self.view[:1 + len(name)]
+
+def stream_checksum(stream, buffer, length=None):
+    # Byte count and checksum of the rest of [stream] (or its next [length]
+    # bytes), read through [buffer]
+    counted = 0
+    checksum = 0
+    while length is None or counted < length:
+        size = len(buffer) if length is None else min(len(buffer), length - counted)
+        read = stream.readinto(buffer[:size])
+        if not read:
+            break
+        counted += read
+        checksum = checksum_update(checksum, buffer[:read])
+    return counted, checksum
+
+class BytesStream:
+    """
+    Reads [data] (bytes in RAM) like a file for send_stream_task and
+    FileTransfer, without copying it
+    """
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.position = 0
+
+    def readinto(self, buffer):
+        count = min(len(buffer), len(self.data) - self.position)
+        buffer[:count] = self.data[self.position:self.position + count]
+        self.position += count
+        return count
+
+    def seek(self, position):
+        self.position = min(position, len(self.data))
+        return self.position
+
+    def close(self):
+        pass
+
 class Utils:
     @staticmethod
     def reading_name_from_time(month, day, year, hour, minute, second):
         return str(month) + "," + str(day) + "," + str(year-2000) + "," + str(hour) + "," + str(minute)
 
     @staticmethod
-    def get_mission_history():
-        try:
-            with open("mission_history.csv", 'r') as file:
-                # Return the data as a list of lists
-                # each line is a mission
-                # [2, 3, 4, 5]
-                # where data[0] is the mission id
-                # and data[1] is the day
-                # and data[2] is the month
-                # and data[3] is the year
-                # and data[4] is the hour
-                # and data[5] is the minute
-                return [[int(x) for x in line.rstrip().split(",")] for line in file.readlines()]
-        except Exception as e:
-            print("Error reading file: ", e)
-            return []
+    def get_mission_history(since=None):
+        # Return the data as a list of lists
+        # each line is a mission
+        # [2, 3, 4, 5]
+        # where data[0] is the mission id
+        # and data[1] is the day
+        # and data[2] is the month
+        # and data[3] is the year
+        # and data[4] is the hour
+        # and data[5] is the minute
+        return list(Utils.iter_mission_history(since))
+
+    @staticmethod
+    def iter_mission_history(since=None):
+        # Yields the missions of get_mission_history one at a time. With
+        # [since] (seconds since 2000) only the missions logged at or after
+        # it are read: the date index gives where they start
+        segments = LogRotation.get_default_log_rotation().segments(MISSION_HISTORY, since)
+        offset = 0
+        if since is not None:
+            index = LogIndex.get_log_index(segments[0])
+            if index is not None:
+                # first entry at or after the minute of [since]
+                offset = index.offset_after(date_key_from_timestamp(since) - 1)
+        for segment in segments:
+            try:
+                with open(segment, 'r') as file:
+                    file.seek(offset)
+                    for line in file:
+                        yield [int(x) for x in line.rstrip().split(",")]
+            except Exception as e:
+                print("Error reading file: ", e)
+            offset = 0
 
     @staticmethod
     def append_mission_to_history(mission_id, day, month, year, hour, minute):
-        try:
-            with open("mission_history.csv", 'a') as file:
-                file.write(str(mission_id) + "," + str(day) + "," + str(month) + "," + str(year-2000) + "," + str(hour) + "," + str(minute))
-                file.write('\n')
-        except Exception as e:
-            print("Error writing to file: ", e)
+        Utils.append_reading_to_csv(MISSION_HISTORY,
+                                    str(mission_id) + "," + str(day) + "," + str(month) + "," + str(year-2000) + "," + pre_zero(int(hour)) + "," + pre_zero(int(minute)))
 
     @staticmethod
     def append_error_to_log(error):
-        try:
-            with open("error_log.csv", 'a') as file:
-                file.write(error)
-                file.write('\n')
-        except Exception as e:
-            print("Error writing to file: ", e)
+        LogWriter.get_default_log_writer().append(ERROR_LOG, error + '\n')
 
     @staticmethod
     def get_file_data(file_name):
@@ -105,13 +210,14 @@ class Utils:
         
     @staticmethod
     def append_reading_to_csv(file_name, reading):
-        # Append the reading to the csv file
-        try:
-            with open(file_name, 'a') as file:
-                file.write(reading)
-                file.write('\n')
-        except Exception as e:
-            print("Error writing to file: ", e)
+        # Append the reading to the csv file, buffered by the LogWriter
+        writer = LogWriter.get_default_log_writer()
+        offset = file_size(file_name) + writer.pending(file_name)
+        if not writer.append(file_name, reading + '\n'):
+            return
+        index = LogIndex.get_log_index(file_name)
+        if index is not None:
+            index.add(reading, offset)
 
     # This fuction is a generator that splits the data into chunks of size n
     def send_file_task(file_data, file_type, file_name=None):
@@ -176,3 +282,62 @@ class Utils:
         last_message = generate_last_message(file_name=file_name)
         yield last_message
 
+    def send_stream_task(open_stream, file_type, file_name=None, length=None):
+        """
+        Same packets as send_file_task, read from a stream instead of bytes
+        in RAM. [open_stream] returns a new object with readinto and close;
+        it is read twice, once for the checksum and once for the payloads.
+        [length] is computed on the first pass when not given.
+
+        Every payload packet is a view of one reused buffer, send it before
+        asking for the next one. The chunk index wraps past 255.
+        """
+        file_type_id = file_types.get(file_type, None)
+        if file_type_id is None:
+            print("Invalid file type", file_type)
+            return
+
+        encoder = PacketEncoder()
+        chunk = encoder.chunk
+
+        stream = open_stream()
+        try:
+            counted, checksum = stream_checksum(stream, chunk)
+        finally:
+            stream.close()
+
+        if length is not None and length != counted:
+            print("File changed size while sending: ", length, counted)
+        length = counted
+
+        num_chunks = (length + CHUNK_SIZE - 1) // CHUNK_SIZE
+        yield encoder.header(num_chunks, length, checksum, file_type_id)
+
+        stream = open_stream()
+        try:
+            index = 0
+            sent = 0
+            while sent < length:
+                read = stream.readinto(chunk[:min(CHUNK_SIZE, length - sent)])
+                if not read:
+                    break
+                sent += read
+                yield encoder.payload(index, read)
+                index += 1
+        finally:
+            stream.close()
+
+        yield encoder.last(file_name)
+
+    def send_file_stream_task(file_name, file_type, transfer_name=None):
+        # Streams [file_name] from flash, sent as [transfer_name]
+        try:
+            length = os.stat(file_name)[6]
+        except OSError as e:
+            print("Error reading file: ", e)
+            return
+        yield from Utils.send_stream_task(lambda: open(file_name, 'rb'), file_type, transfer_name, length)
+
+    def send_bytes_stream_task(data, file_type, transfer_name=None):
+        # Streams [data] from RAM, sent as [transfer_name]
+        yield from Utils.send_stream_task(lambda: BytesStream(data), file_type, transfer_name, len(data))
@@ -1,22 +1,115 @@
 import json
-import random
+import os
+
+import uasyncio as asyncio
 
 from machine import RTC
 from agbot_file_util import Utils
+from scheduler import schedule_error
+
 
+class default_journal_params:
+    # Compact the journal into the snapshot once it is this big (bytes)
+    COMPACT_SIZE = 4096
+    # How often the background compactor checks the journal (s)
+    COMPACT_PERIOD = 60
 
 class JsonReaderWriter:
-    def __init__(self, filename):
+    """
+    JSON data kept on flash as a snapshot plus an append-only journal.
+
+    Mutations are appended to [filename].journal as one JSON record per
+    line and compacted into the snapshot later, so a change only writes a
+    few bytes. On load the journal is replayed onto the snapshot. A record
+    without its trailing newline was torn by a power cut and is dropped.
+
+    Records must be idempotent: a crash between replacing the snapshot and
+    clearing the journal replays them onto a snapshot that has them already.
+    Subclasses apply records in apply_record, records they do not know
+    are left to this one, which logs and skips them.
+    """
+    def __init__(self, filename, compact_size=default_journal_params.COMPACT_SIZE):
         self.filename = filename
+        self.journal_filename = filename + ".journal"
+        self.compact_size = compact_size
+        self.journal_size = 0
         self.data = self.load()
+        self.replay()
 
     def load(self):
         with open(self.filename, 'r') as file:
             return json.load(file)
 
+    def replay(self):
+        try:
+            file = open(self.journal_filename, 'r')
+        except OSError:
+            return
+
+        torn = False
+        with file:
+            while True:
+                line = file.readline()
+                if not line:
+                    break
+                if not line.endswith("\n"):
+                    torn = True
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    torn = True
+                    break
+                self.apply_record(record)
+                self.journal_size += len(line)
+
+        if torn:
+            # anything appended after a torn record would be lost on the next replay
+            print("Dropped torn journal record, compacting")
+            self.save()
+
+    def apply_record(self, record):
+        # A record no subclass knows, e.g. from newer firmware, the data is left as is
+        print("Unknown journal record: ", record)
+
+    def journal(self, record):
+        # Applies [record] to the data and appends it to the journal
+        self.apply_record(record)
+        line = json.dumps(record) + "\n"
+        with open(self.journal_filename, 'a') as file:
+            file.write(line)
+        self.journal_size += len(line)
+
     def save(self):
-        with open(self.filename, 'w') as file:
+        # Writes a full snapshot and clears the journal
+        temp_filename = self.filename + ".tmp"
+        with open(temp_filename, 'w') as file:
             json.dump(self.data, file)
+        os.rename(temp_filename, self.filename)
+        with open(self.journal_filename, 'w'):
+            pass
+        self.journal_size = 0
+
+    def snapshot(self):
+        # The data as it is now, serialized once per BLE transfer and kept in RAM.
+        # A transfer reads what it sends more than once (checksum, payloads,
+        # retransmits), from this copy BLE commands changing the data in
+        # between can not make the passes disagree
+        return json.dumps(self.data).encode('utf-8')
+
+    def needs_compaction(self):
+        return self.journal_size >= self.compact_size
+
+    async def compactor(self, period_s=default_journal_params.COMPACT_PERIOD):
+        # Background task folding the journal into the snapshot once it grows
+        while True:
+            await asyncio.sleep(period_s)
+            if self.needs_compaction():
+                print("Compacting journal: ", self.journal_size, "bytes")
+                self.save()
+
+# ids go over BLE as uint16
+MAX_ID = 0xFFFF
 
 class AgBotMemory(JsonReaderWriter):
     @classmethod
@@ -24,8 +117,104 @@ class AgBotMemory(JsonReaderWriter):
         return AgBotMemory('/agbot_data.json')   
     
     def __init__(self, filename):
+        # called with no arguments when a mission is added, changed or deleted
+        self.mission_listeners = []
         super().__init__(filename)
+        # planned visiting order per (mission_id, route kind), see Controller
+        self.route_cache = {}
+
+    def load(self):
+        data = super().load()
+        # probe -> {"version": n, "points": [[raw, percent], ...]}, see calibration
+        data.setdefault("calibrations", {})
+        self.build_indexes(data)
+        return data
+
+    ### Id Indexes
+
+    def build_indexes(self, data):
+        # plant id -> plant name and mission id -> position in data["missions"],
+        # kept up to date by apply_record
+        self.plant_names_by_id = {}
+        self.mission_positions = {}
+        next_ids = data.setdefault("next_ids", {"plant": 1, "mission": 1})
+        for plant_name, plant in data["plants"].items():
+            self.plant_names_by_id[plant['id']] = plant_name
+            next_ids["plant"] = max(next_ids["plant"], plant['id'] + 1)
+        for position, mission in enumerate(data["missions"]):
+            self.mission_positions[mission['mission_id']] = position
+            next_ids["mission"] = max(next_ids["mission"], mission['mission_id'] + 1)
+
+    def allocate_id(self, kind, in_use):
+        # Next id of [kind] ("plant" or "mission"), never handing out an id twice
+        # until the uint16 space runs out
+        next_ids = self.data["next_ids"]
+        new_id = next_ids[kind]
+        if new_id > MAX_ID:
+            print("Ran out of ", kind, " ids, reusing free ones")
+            new_id = 1
+            while new_id in in_use:
+                new_id += 1
+        return new_id
+
+    def get_plant_name(self, plant_id):
+        return self.plant_names_by_id.get(plant_id, None)
     
+    ### Journal Records
+
+    def apply_record(self, record):
+        """
+        Records, all of them safe to apply twice:
+        ["plant", name, plant]       add or replace a plant
+        ["plant_del", name]          delete a plant
+        ["mission", mission]         add or replace a mission (by mission_id)
+        ["mission_del", mission_id]  delete a mission
+        ["gantry_size", [x, y]]      set the gantry size
+        ["calibration", probe, curve] set the calibration curve of a probe
+        """
+        kind = record[0]
+        next_ids = self.data["next_ids"]
+        if kind == "plant":
+            plant_name, plant = record[1], record[2]
+            old_plant = self.data["plants"].get(plant_name, None)
+            if old_plant is not None:
+                self.plant_names_by_id.pop(old_plant['id'], None)
+            self.data["plants"][plant_name] = plant
+            self.plant_names_by_id[plant['id']] = plant_name
+            next_ids["plant"] = max(next_ids["plant"], plant['id'] + 1)
+        elif kind == "plant_del":
+            plant = self.data["plants"].pop(record[1], None)
+            if plant is not None:
+                self.plant_names_by_id.pop(plant['id'], None)
+        elif kind == "mission":
+            mission = record[1]
+            mission_id = mission['mission_id']
+            position = self.mission_positions.get(mission_id, None)
+            missions = self.data["missions"]
+            if position is None:
+                self.mission_positions[mission_id] = len(missions)
+                missions.append(mission)
+            else:
+                missions[position] = mission
+            next_ids["mission"] = max(next_ids["mission"], mission_id + 1)
+            self.missions_changed()
+        elif kind == "mission_del":
+            position = self.mission_positions.pop(record[1], None)
+            if position is not None:
+                # the last mission takes the deleted one's place
+                missions = self.data["missions"]
+                last = missions.pop()
+                if position < len(missions):
+                    missions[position] = last
+                    self.mission_positions[last['mission_id']] = position
+            self.missions_changed()
+        elif kind == "gantry_size":
+            self.data['gantry_size'] = record[1]
+        elif kind == "calibration":
+            self.data["calibrations"][record[1]] = record[2]
+        else:
+            super().apply_record(record)
+
     ### Plant Functions
     
     def add_plant(self, plant_name, 
@@ -39,24 +228,19 @@ class AgBotMemory(JsonReaderWriter):
         plant['moisture_threshhold'] = moisture_threshhold
         plant["ml_response"] = ml_response
         
-        id_already_exists = False
-        while True:
-            plant_id = random.randint(0, 1000)
-            for plant_in_mem in self.data["plants"].keys():
-                if self.get_plant(plant_in_mem)['id'] == plant_id:
-                    id_already_exists = True
-                    print("ID already exists")
-                    break
-            if not id_already_exists:
-                print("ID does not exist, using: ", plant_id)    
-                break
-    
-        plant['id'] = plant_id
+        plant['id'] = self.allocate_id("plant", self.plant_names_by_id)
+        print("Using plant id: ", plant['id'])
         
-        self.data["plants"][plant_name] = plant
-        self.save()
+        if plant_name in self.data["plants"]:
+            # coordinates of a planned plant changed
+            self.invalidate_routes()
+        self.journal(["plant", plant_name, plant])
 
     def add_mission(self, mission_name, hour, minute, action):
+        if not (0 <= hour < 24 and 0 <= minute < 60):
+            # the scheduler could never run it
+            print("Error: mission not added, time out of range: ", hour, minute)
+            return
         mission = {}
         mission['mission_name'] = mission_name
         mission['time'] = [hour, minute]
@@ -66,75 +250,73 @@ class AgBotMemory(JsonReaderWriter):
         elif action == 1:
             mission['type'] = "sense_moisture"
 
-        id_already_exists = False
-        while True:
-            mission_id = random.randint(0, 1000)
-            for mission_in_mem in self.data["missions"]:
-                if mission_in_mem['mission_id'] == mission_id:
-                    id_already_exists = True
-                    print("ID already exists")
-                    break
-            if not id_already_exists:
-                print("ID does not exist, using: ", mission_id)    
-                break
-    
-        mission['mission_id'] = mission_id
+        mission['mission_id'] = self.allocate_id("mission", self.mission_positions)
+        print("Using mission id: ", mission['mission_id'])
         mission['locations'] = []
 
-        self.data["missions"].append(mission)
-        self.save()
+        self.journal(["mission", mission])
 
     def add_plant_to_mission(self, plant_id, mission_id):
-        plant = None
-        # find plant name
-        for plant_name in self.data["plants"].keys():
-            if self.get_plant(plant_name)["id"] == plant_id:
-                print("Plant found: ", plant_name)
-                plant = plant_name
-                break
+        plant = self.get_plant_name(plant_id)
+        mission = self.get_mission(mission_id)
+        if plant is None or mission is None:
+            return
 
-        if plant is not None:
-            # find mission
-            for mission in self.data["missions"]:
-                if mission['mission_id'] == mission_id:
-                    print("Mission found: ", mission['mission_name'])
-                    mission['locations'].append(plant)
-                    self.save()
-                    return
+        print("Adding ", plant, " to mission ", mission['mission_name'])
+        updated = dict(mission)
+        updated['locations'] = mission['locations'] + [plant]
+        self.invalidate_routes(mission_id)
+        self.journal(["mission", updated])
 
     def remove_plant_from_mission(self, plant_id, mission_id):
-        plant = None
-        # find plant name
-        for plant_name in self.data["plants"].keys():
-            if self.get_plant(plant_name)["id"] == plant_id:
-                print("Plant found: ", plant_name)
-                plant = plant_name
-                break
+        plant = self.get_plant_name(plant_id)
+        mission = self.get_mission(mission_id)
+        if plant is None or mission is None:
+            return
 
-        if plant is not None:
-            # find mission
-            for mission in self.data["missions"]:
-                if mission['mission_id'] == mission_id:
-                    print("Mission found: ", mission['mission_name'])
-                    mission['locations'].remove(plant)
-                    self.save()
-                    return
+        print("Removing ", plant, " from mission ", mission['mission_name'])
+        updated = dict(mission)
+        updated['locations'] = list(mission['locations'])
+        updated['locations'].remove(plant)
+        self.invalidate_routes(mission_id)
+        self.journal(["mission", updated])
+
+    def set_mission_schedule(self, mission_id, hour, minute, repeat, every_hours=24, weekdays=0x7F, catch_up="once"):
+        # See scheduler for what the schedule fields mean, returns False if it was not set
+        mission = self.get_mission(mission_id)
+        if mission is None:
+            return False
+        error = schedule_error(hour, minute, repeat, every_hours, weekdays, catch_up)
+        if error is not None:
+            print("Error: mission schedule not set, ", error, ": ", hour, minute, repeat, every_hours, weekdays, catch_up)
+            return False
+        updated = dict(mission)
+        updated['time'] = [hour, minute]
+        updated['repeat'] = repeat
+        updated['every_hours'] = every_hours
+        updated['weekdays'] = weekdays
+        updated['catch_up'] = catch_up
+        self.journal(["mission", updated])
+        return True
+
+    def on_missions_changed(self, listener):
+        self.mission_listeners.append(listener)
+
+    def missions_changed(self):
+        for listener in self.mission_listeners:
+            listener()
 
     def delete_mission(self, mission_id):
-        for index, mission in enumerate(self.data["missions"]):
-            if mission['mission_id'] == mission_id:
-                self.data["missions"].pop(index)
-                self.save()
-                return
+        if mission_id in self.mission_positions:
+            self.invalidate_routes(mission_id)
+            self.journal(["mission_del", mission_id])
       
     def delete_plant(self, plant_id):
-        for plant in self.data["plants"].keys():
-            print(plant)
-            if self.get_plant(plant)["id"] == plant_id:
-                print("Deleting plant: ", plant)
-                self.data["plants"].pop(plant)
-                self.save()
-                return
+        plant = self.get_plant_name(plant_id)
+        if plant is not None:
+            print("Deleting plant: ", plant)
+            self.invalidate_routes()
+            self.journal(["plant_del", plant])
 
     def get_plant(self, plant_name):
         return self.data["plants"].get(plant_name, {})
@@ -145,6 +327,9 @@ class AgBotMemory(JsonReaderWriter):
             plant_list.append(plant_name)
         return plant_list
 
+    def get_plant_count(self):
+        return len(self.data["plants"])
+
     def get_plant_water_spot(self, plant):
         return self.get_plant(plant)['location']
 
@@ -161,11 +346,27 @@ class AgBotMemory(JsonReaderWriter):
         return self.data.get("missions", [])
     
     def get_mission(self, mission_id):
-        missions = self.get_missions()
-        for mission in missions:
-            if mission['mission_id'] == mission_id:
-                return mission
-        return None
+        position = self.mission_positions.get(mission_id, None)
+        if position is None:
+            return None
+        return self.data["missions"][position]
+
+    ### Planned Routes
+
+    def get_cached_route(self, mission_id, kind):
+        return self.route_cache.get((mission_id, kind), None)
+
+    def cache_route(self, mission_id, kind, route):
+        self.route_cache[(mission_id, kind)] = route
+
+    def invalidate_routes(self, mission_id=None):
+        # Drop the planned routes of [mission_id], or of every mission if None
+        if mission_id is None:
+            self.route_cache = {}
+            return
+        for key in list(self.route_cache.keys()):
+            if key[0] == mission_id:
+                self.route_cache.pop(key)
 
     ### Gantry Params
 
@@ -173,8 +374,20 @@ class AgBotMemory(JsonReaderWriter):
         return self.data['gantry_size']
 
     def set_gantry_size(self, x, y):
-        self.data['gantry_size'] = [x,y] 
-        self.save()
+        self.journal(["gantry_size", [x, y]])
+
+    ### Probe Calibration
+
+    def get_calibration(self, probe):
+        # {"version": n, "points": [[raw, percent], ...]} of [probe], None when not calibrated
+        return self.data["calibrations"].get(probe, None)
+
+    def set_calibration(self, probe, points):
+        # Stores a new curve for [probe], returns its version
+        old = self.get_calibration(probe)
+        version = old["version"] + 1 if old is not None else 1
+        self.journal(["calibration", probe, {"version": version, "points": points}])
+        return version
         
     ### Add reading to memory
     
@@ -235,9 +448,9 @@ if __name__ == "__main__":
     for plant in agm.get_plant_names():
         print(plant, " ", agm.get_plant_water_spot(plant))
 
-    print(agm.get_mission_time())
+    print(agm.get_missions())
 
-    time = Utils.reading_name_from_time(06, 19, 2024)
+    time = Utils.reading_name_from_time(6, 19, 2024, 0, 0, 0)
     print(time)
     print("Contains : ", time)
     # agm.save()
\ No newline at end of file
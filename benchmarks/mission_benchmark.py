@@ -0,0 +1,246 @@
+"""
+Mission time benchmark on the simulator.
+
+Generates synthetic farms (grid, random and clustered layouts of 10, 50
+and 200 plants), runs Controller.run_mission end to end on a simulated
+gantry and records, per scenario:
+
+- mission_time_s: virtual time the mission took
+- belt_travel_mm: |da| + |db| travelled by the belts
+- z_cycles: times the probe went into the soil
+- memory_saves: AgBotMemory.save calls (full snapshot rewrites)
+- journal_bytes: bytes appended to the memory journal
+- log_bytes: bytes appended to the logs (CSV and binary record logs)
+- log_appends, log_writes: records logged and file writes it took (LogWriter)
+- i2c_transactions: I2C transfers, the mission reads the time from SoftClock
+- dry_plants: plants below their threshold
+- water_ml, purge_ml: water given to the plants and purged priming the
+  pump, from the water log
+
+The moisture threshold is set from the simulated field so that about
+DRY_SHARE of the plants are dry and get watered.
+
+Results are written as JSON so runs can be compared:
+
+    python benchmarks/mission_benchmark.py --output bench_results.json
+    python benchmarks/mission_benchmark.py --sizes 10 50 --layouts grid --modes 1
+
+Two phase mode (1) pays off when the water spots are far from the sense
+spots, compare the modes with --water-offset 150 0.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sim
+
+BED_SIZE = (400.0, 300.0)
+MARGIN = 20.0
+# water spot relative to the sense spot
+WATER_OFFSET = (8.0, 8.0)
+MISSION_ID = 1
+# share of the plants drier than the threshold
+DRY_SHARE = 0.4
+
+SIZES = (10, 50, 200)
+LAYOUTS = ("grid", "random", "clustered")
+
+
+def _clamp_to_bed(x, y, water_offset=WATER_OFFSET):
+    x = min(max(x, MARGIN), BED_SIZE[0] - MARGIN - water_offset[0])
+    y = min(max(y, MARGIN), BED_SIZE[1] - MARGIN - water_offset[1])
+    return round(x), round(y)
+
+
+def layout_points(layout, count, rng, water_offset=WATER_OFFSET):
+    width = BED_SIZE[0] - 2 * MARGIN - water_offset[0]
+    height = BED_SIZE[1] - 2 * MARGIN - water_offset[1]
+    points = []
+    if layout == "grid":
+        columns = max(1, int(math.ceil(math.sqrt(count * width / height))))
+        rows = int(math.ceil(count / columns))
+        for i in range(count):
+            column, row = i % columns, i // columns
+            x = MARGIN + width * (column + 0.5) / columns
+            y = MARGIN + height * (row + 0.5) / rows
+            points.append(_clamp_to_bed(x, y, water_offset))
+        # plants get added to missions in no particular order
+        rng.shuffle(points)
+    elif layout == "random":
+        for _ in range(count):
+            points.append(_clamp_to_bed(MARGIN + rng.uniform(0, width), MARGIN + rng.uniform(0, height),
+                                        water_offset))
+    elif layout == "clustered":
+        centers = [(MARGIN + rng.uniform(0, width), MARGIN + rng.uniform(0, height))
+                   for _ in range(max(1, count // 10))]
+        for _ in range(count):
+            cx, cy = rng.choice(centers)
+            points.append(_clamp_to_bed(rng.gauss(cx, 20), rng.gauss(cy, 20), water_offset))
+    else:
+        raise ValueError("Unknown layout %s" % layout)
+    return points
+
+
+def dry_threshold(points, field, share=DRY_SHARE):
+    """
+    Moisture threshold (whole %) that about [share] of the soil at the
+    sense spots [points] is below, and how many of them are
+    """
+    moistures = sorted(field.moisture_at(x, y) for x, y in points)
+    threshold = int(math.ceil(moistures[min(len(moistures) - 1, int(share * len(moistures)))]))
+    return threshold, sum(1 for moisture in moistures if moisture < threshold)
+
+
+def make_farm(layout, count, seed, threshold=40, water_offset=WATER_OFFSET):
+    """
+    agbot_data.json contents for a farm with one mission over every plant
+    """
+    rng = random.Random(seed)
+    plants = {}
+    for plant_id, (x, y) in enumerate(layout_points(layout, count, rng, water_offset)):
+        plants["plant_%d" % plant_id] = {
+            "sense": [x, y],
+            "location": [x + water_offset[0], y + water_offset[1]],
+            "moisture_threshhold": threshold,
+            "ml_response": 5,
+            "id": plant_id,
+        }
+    mission = {
+        "mission_name": "benchmark",
+        "time": [8, 0],
+        "type": "sense_moisture",
+        "mission_id": MISSION_ID,
+        "locations": list(plants.keys()),
+    }
+    return {"gantry_size": [0, 0], "missions": [mission], "plants": plants}
+
+
+def _log_bytes(workdir):
+    total = 0
+    for name in os.listdir(workdir):
+        if name.endswith(".csv") or name.endswith(".bin"):
+            total += os.path.getsize(os.path.join(workdir, name))
+    return total
+
+
+def _logged_water(water_log, start):
+    # (water ml, purge ml) logged in [water_log] from record [start] on
+    from record_log import KIND_WATER, KIND_PURGE, WATER_SCALE
+
+    totals = {KIND_WATER: 0, KIND_PURGE: 0}
+    for record in water_log.records(start):
+        if record[5] in totals:
+            totals[record[5]] += record[4]
+    return totals[KIND_WATER] / WATER_SCALE, totals[KIND_PURGE] / WATER_SCALE
+
+
+def run_scenario(layout, count, mode, seed, workdir, water_offset=WATER_OFFSET):
+    shutil.rmtree(workdir, ignore_errors=True)
+    sim.reset(x_size=BED_SIZE[0], y_size=BED_SIZE[1], seed=seed)
+    points = layout_points(layout, count, random.Random(seed), water_offset)
+    threshold, dry_plants = dry_threshold(points, sim.board().field)
+    controller = sim.build_controller(workdir, make_farm(layout, count, seed, threshold, water_offset))
+
+    # find the bed and park before timing anything
+    sim.run(controller.setup_xy_max())
+    sim.run(controller.agbot.move_to(10, 10))
+
+    saves = [0]
+    save = controller.memory.save
+
+    def counting_save():
+        saves[0] += 1
+        save()
+
+    controller.memory.save = counting_save
+
+    board = sim.board()
+    start_stats = board.stats()
+    start_logs = _log_bytes(workdir)
+    start_journal = controller.memory.journal_size
+    start_water = controller.water_log.count()
+    start_appends = controller.writer.appends
+    start_writes = controller.writer.writes
+    start_time = sim.now()
+    start_cpu = time.process_time()
+
+    sim.run(controller.run_mission(mission_id=MISSION_ID, mode=mode))
+
+    end_stats = board.stats()
+    water_ml, purge_ml = _logged_water(controller.water_log, start_water)
+    return {
+        "layout": layout,
+        "plants": count,
+        "mode": mode,
+        "seed": seed,
+        "water_offset": list(water_offset),
+        "mission_time_s": round(sim.now() - start_time, 3),
+        "belt_travel_mm": round(end_stats["belt_travel_mm"] - start_stats["belt_travel_mm"], 1),
+        "z_cycles": end_stats["z_cycles"] - start_stats["z_cycles"],
+        "moisture_threshold": threshold,
+        "dry_plants": dry_plants,
+        "water_ml": round(water_ml, 1),
+        "purge_ml": round(purge_ml, 1),
+        "memory_saves": saves[0],
+        "journal_bytes": controller.memory.journal_size - start_journal,
+        "log_bytes": _log_bytes(workdir) - start_logs,
+        "log_appends": controller.writer.appends - start_appends,
+        "log_writes": controller.writer.writes - start_writes,
+        "i2c_transactions": end_stats["i2c_transactions"] - start_stats["i2c_transactions"],
+        "host_cpu_s": round(time.process_time() - start_cpu, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mission time benchmark on the simulator")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    parser.add_argument("--layouts", nargs="+", default=list(LAYOUTS), choices=LAYOUTS)
+    parser.add_argument("--modes", type=int, nargs="+", default=[0, 1],
+                        help="mission modes, 0 per plant, 1 two phase")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--water-offset", type=float, nargs=2, default=list(WATER_OFFSET),
+                        help="water spot relative to the sense spot (mm)")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--verbose", action="store_true", help="keep the firmware's prints")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    sim.install()
+    workroot = tempfile.mkdtemp(prefix="agbot-bench-")
+
+    results = []
+    for count in args.sizes:
+        for layout in args.layouts:
+            for mode in args.modes:
+                workdir = os.path.join(workroot, "%s_%d_%d" % (layout, count, mode))
+                stdout = sys.stdout
+                if not args.verbose:
+                    sys.stdout = open(os.devnull, "w")
+                try:
+                    result = run_scenario(layout, count, mode, args.seed, workdir, tuple(args.water_offset))
+                finally:
+                    if sys.stdout is not stdout:
+                        sys.stdout.close()
+                        sys.stdout = stdout
+                results.append(result)
+                print("%-9s %4d plants mode %d: %8.1f s  %9.0f mm  %4d z  %4d dry  %6.1f ml  %5.1f purge ml  %3d saves  %7d log bytes  %4d writes" % (
+                    layout, count, mode, result["mission_time_s"], result["belt_travel_mm"],
+                    result["z_cycles"], result["dry_plants"], result["water_ml"], result["purge_ml"], result["memory_saves"],
+                    result["log_bytes"], result["log_writes"]))
+
+    with open(output, "w") as file:
+        json.dump({"bed_size": BED_SIZE, "results": results}, file, indent=2)
+    print("Results written to", output)
+    shutil.rmtree(workroot, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Heap cost of building the v1 file transfer packets.
+
+Compares the in-RAM generator (Utils.send_file_task: whole file read into
+RAM, chunk list, a new bytearray per packet) with the streaming one
+(Utils.send_file_stream_task: PacketEncoder, one reused buffer) on
+generated CSV files.
+
+Runs on the host through the simulator:
+
+    python benchmarks/packet_alloc_benchmark.py --sizes 10000 100000
+
+and on the Pico (copy it next to the firmware and import it), where
+gc is disabled while a transfer is built so gc.mem_alloc() counts every
+byte allocated, garbage included. On the host that number is not
+available and the peak heap growth (tracemalloc) is reported instead.
+"""
+import gc
+import sys
+import time
+
+MICROPYTHON = sys.implementation.name == "micropython"
+
+if not MICROPYTHON:
+    import argparse
+    import os
+    import tempfile
+    import tracemalloc
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import sim
+    sim.install()
+
+from agbot_file_util import Utils
+
+SIZES = (10000, 100000)
+LINE = b"6,19,24,10,30,123,45,67\n"
+
+
+def make_file(file_name, size):
+    with open(file_name, "wb") as file:
+        written = 0
+        while written < size:
+            line = LINE[:size - written]
+            file.write(line)
+            written += len(line)
+
+
+def legacy_packets(file_name):
+    return Utils.send_file_task(Utils.get_file_data(file_name), "CSV", "bench")
+
+
+def streamed_packets(file_name):
+    return Utils.send_file_stream_task(file_name, "CSV", "bench")
+
+
+def measure(make_packets, file_name):
+    """
+    Builds every packet like file_write_task would, returns
+    (packets, bytes, heap bytes, seconds)
+    """
+    packets = 0
+    sent = 0
+    gc.collect()
+    if MICROPYTHON:
+        gc.disable()
+        before = gc.mem_alloc()
+        start = time.ticks_us()
+    else:
+        tracemalloc.start()
+        start = time.perf_counter()
+
+    for packet in make_packets(file_name):
+        packets += 1
+        sent += len(packet)
+
+    if MICROPYTHON:
+        seconds = time.ticks_diff(time.ticks_us(), start) / 1000000
+        heap = gc.mem_alloc() - before
+        gc.enable()
+    else:
+        seconds = time.perf_counter() - start
+        heap = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return packets, sent, heap, seconds
+
+
+def run(sizes=SIZES, file_name="bench_packets.csv"):
+    results = []
+    for size in sizes:
+        make_file(file_name, size)
+        for name, make_packets in (("legacy", legacy_packets), ("encoder", streamed_packets)):
+            packets, sent, heap, seconds = measure(make_packets, file_name)
+            results.append({"file_bytes": size, "builder": name, "packets": packets,
+                            "packet_bytes": sent, "heap_bytes": heap, "seconds": seconds})
+            print("%7d bytes %-8s %5d packets  %8d heap bytes  %.3f s" % (size, name, packets, heap, seconds))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Heap cost of building file transfer packets")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="agbot-packets-"))
+    run(args.sizes)
+
+
+if __name__ == "__main__":
+    main()
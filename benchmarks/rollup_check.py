@@ -0,0 +1,123 @@
+"""
+Checks the per plant rollups (rollups.Rollups) over a full week of
+readings on the simulator.
+
+For each plant count, every plant gets READINGS_PER_DAY readings a day
+from a monday to the sunday, and a watering for the dry ones, added the
+way Controller.log_reading does (fit, then add). Then, for the rollups
+in RAM and for the file loaded again, every plant must have one week
+bucket starting on that monday with all of its readings and water, and
+a day bucket for the sunday.
+
+    python benchmarks/rollup_check.py --plants 10 60 200
+
+Exits with status 1 if a bucket is missing or wrong.
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sim
+
+PLANTS = (10, 60, 200)
+READINGS_PER_DAY = 3
+DRY = 30
+WATER_ML = 5
+# a monday
+START = (2025, 6, 2)
+
+
+def log_week(rollups, plants, seed):
+    """
+    Logs a week for plants 1 to [plants], returns what each week bucket
+    should hold: plant id -> [readings, sum, water ml]
+    """
+    from record_log import timestamp
+
+    rng = random.Random(seed)
+    expected = {}
+    start = timestamp(*START)
+    for day in range(7):
+        for reading in range(READINGS_PER_DAY):
+            seconds = start + day * 86400 + reading * 4 * 3600
+            for plant_id in range(1, plants + 1):
+                rollups.fit(plant_id)
+                moisture = rng.randint(0, 100)
+                rollups.add_moisture(plant_id, seconds, moisture)
+                bucket = expected.setdefault(plant_id, [0, 0, 0])
+                bucket[0] += 1
+                bucket[1] += moisture
+                if moisture < DRY:
+                    rollups.add_water(plant_id, seconds, WATER_ML)
+                    bucket[2] += WATER_ML
+    return expected
+
+
+def wrong_buckets(rollups, expected):
+    # Plants whose week or sunday bucket is missing or wrong
+    from record_log import timestamp
+    from rollups import PERIOD_DAY, PERIOD_WEEK
+
+    monday = timestamp(*START) // 86400
+    wrong = 0
+    for plant_id, (count, total, water_ml) in expected.items():
+        week = rollups.get(plant_id, PERIOD_WEEK)
+        day = rollups.get(plant_id, PERIOD_DAY)
+        if (week is None or week["day"] != monday or week["count"] != count
+                or round(week["mean"] * count) != total or week["water_ml"] != water_ml
+                or day is None or day["day"] != monday + 6 or day["count"] != READINGS_PER_DAY):
+            wrong += 1
+    return wrong
+
+
+def check(plants, seed, workdir):
+    from log_writer import LogWriter
+    from rollups import Rollups
+
+    file_name = os.path.join(workdir, "rollups.bin")
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        rollups = Rollups(file_name)
+        expected = log_week(rollups, plants, seed)
+        LogWriter.get_default_log_writer().flush()
+        loaded = Rollups(file_name)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return {
+        "plants": plants,
+        "wrong_in_ram": wrong_buckets(rollups, expected),
+        "wrong_loaded": wrong_buckets(loaded, expected),
+        "room": loaded.plants,
+        "file_bytes": os.path.getsize(file_name),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Week of rollups on the simulator")
+    parser.add_argument("--plants", type=int, nargs="+", default=list(PLANTS))
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    sim.install()
+    failed = False
+    for plants in args.plants:
+        workdir = tempfile.mkdtemp(prefix="agbot-rollups-")
+        try:
+            result = check(plants, args.seed, workdir)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        failed = failed or result["wrong_in_ram"] or result["wrong_loaded"]
+        print("%4d plants: %4d wrong buckets, %4d after loading, room for %4d plants, %6d bytes" % (
+            plants, result["wrong_in_ram"], result["wrong_loaded"], result["room"], result["file_bytes"]))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
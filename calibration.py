@@ -0,0 +1,144 @@
+"""
+Moisture probe calibration: a curve from raw ADC readings (read_u16,
+0-65535) to volumetric water content (%), per probe.
+
+A curve is a list of [raw, percent] points, at least two, raw up to
+RAW_MAX - 1 (the most read_u16 returns), linearly
+interpolated between them and held flat past the ends. Capacitive probes
+read lower the wetter the soil, so percent may go down as raw goes up.
+
+Every curve has a version, the version a reading was taken with is kept
+in its record (see record_log) so readings from before a recalibration
+can be told apart. Version 0 is the uncalibrated linear curve the
+firmware always used (raw / 65536 * 100).
+
+Conversions go through a table of the curve at every 256 raw counts
+(LUT_BITS), two lookups and a multiply per reading.
+
+Calibrating (CalibrationSession): put the probe over soil of known
+water content, probe it and give the reference % (measure), for two or
+more soils from dry to saturated, then store the curve (finish). A
+reading too close to an earlier one with another % is rejected, the
+probe can not tell those soils apart.
+"""
+from array import array
+
+class default_calibration_params:
+    # the table holds the curve every 2 ** (16 - LUT_BITS) raw counts
+    LUT_BITS = 8
+    # probe the firmware has, calibrations are kept per probe
+    PROBE = "0"
+    # a point closer than this to another one (raw counts) replaces it
+    MIN_POINT_SPACING = 64
+
+RAW_MAX = 65536
+LINEAR_VERSION = 0
+# raw / 65536 * 100 up to the top reading
+LINEAR_POINTS = [[0, 0.0], [RAW_MAX - 1, (RAW_MAX - 1) * 100.0 / RAW_MAX]]
+
+def interpolate(points, raw):
+    # Percent at [raw] on the curve through [points] (sorted by raw)
+    if raw <= points[0][0]:
+        return points[0][1]
+    for position in range(1, len(points)):
+        raw_high, percent_high = points[position]
+        if raw <= raw_high:
+            raw_low, percent_low = points[position - 1]
+            return percent_low + (percent_high - percent_low) * (raw - raw_low) / (raw_high - raw_low)
+    return points[-1][1]
+
+def check_points(points):
+    # Sorted copy of [points], None when they do not make a curve
+    try:
+        points = sorted([[int(raw), float(percent)] for raw, percent in points])
+    except (TypeError, ValueError):
+        return None
+    if len(points) < 2:
+        return None
+    for position in range(1, len(points)):
+        if points[position][0] == points[position - 1][0]:
+            return None
+    for raw, percent in points:
+        if raw < 0 or raw >= RAW_MAX or percent < 0 or percent > 100:
+            return None
+    return points
+
+
+class Calibration:
+    """
+    The curve of one probe with its table. percent() is the only thing
+    used while probing.
+    """
+    def __init__(self, points=LINEAR_POINTS, version=LINEAR_VERSION,
+                 lut_bits=default_calibration_params.LUT_BITS):
+        self.points = check_points(points)
+        if self.points is None:
+            print("Bad calibration curve, using the linear one: ", points)
+            self.points = LINEAR_POINTS
+            version = LINEAR_VERSION
+        self.version = version
+        self.shift = 16 - lut_bits
+        self.step = 1 << self.shift
+        # percent * 100 at raw = index << shift, one more entry for the top end
+        self.lut = array('H', [int(round(interpolate(self.points, index << self.shift) * 100))
+                               for index in range((1 << lut_bits) + 1)])
+
+    def percent(self, raw):
+        # Moisture % of a read_u16 value
+        index = raw >> self.shift
+        fraction = raw & (self.step - 1)
+        low = self.lut[index]
+        return (low + (self.lut[index + 1] - low) * fraction / self.step) / 100
+
+    def to_dict(self):
+        return {"version": self.version, "points": self.points}
+
+
+class CalibrationSession:
+    """
+    Guided calibration of [probe]: measure() probes the soil under the
+    AgBot for every reference, finish() stores the curve in [memory] and
+    returns its Calibration (None when the points do not make a curve).
+    [sense_raw] is an async function returning (raw, confidence).
+    """
+    def __init__(self, memory, sense_raw, probe=default_calibration_params.PROBE,
+                 min_point_spacing=default_calibration_params.MIN_POINT_SPACING):
+        self.memory = memory
+        self.sense_raw = sense_raw
+        self.probe = probe
+        self.min_point_spacing = min_point_spacing
+        self.points = []
+        print("Calibrating probe ", probe, ": put it over soil of known water content and measure,")
+        print("from dry to saturated, at least 2 soils")
+
+    def add_point(self, raw, percent):
+        """
+        Adds the reference [percent] read as [raw], returns False when it
+        is rejected: a reading closer than min_point_spacing to an earlier
+        one is the same soil measured again, it replaces that point when
+        the % is the same too
+        """
+        for point in self.points:
+            if abs(point[0] - raw) < self.min_point_spacing and point[1] != percent:
+                print("Calibration point rejected: raw ", raw, " is too close to raw ", point[0],
+                      " measured as ", point[1], "%")
+                return False
+        self.points = [point for point in self.points if abs(point[0] - raw) >= self.min_point_spacing]
+        self.points.append([raw, percent])
+        return True
+
+    async def measure(self, percent):
+        # Probes the soil under the AgBot, [percent] its known water content
+        raw, confidence = await self.sense_raw()
+        print("Calibration point: raw ", raw, " is ", percent, "% confidence: ", confidence)
+        self.add_point(raw, percent)
+        return raw, confidence
+
+    def finish(self):
+        points = check_points(self.points)
+        if points is None:
+            print("Calibration needs 2 or more different soils: ", self.points)
+            return None
+        version = self.memory.set_calibration(self.probe, points)
+        print("Calibration of probe ", self.probe, " stored as version ", version)
+        return Calibration(points, version)
@@ -104,6 +104,18 @@ class Clock:
                 value = f"0{value}"  # From now on the value is a string!
         return value
 
+    # Read the Realtime from the DS3231 as numbers: year, month, day, hour, minute, second
+    # No formatting, for SoftClock. None when the DS3231 can not be read
+    def read_time(self):
+        try:
+            buffer = self.i2c.readfrom_mem(self.rtc_address, self.rtc_register, 7)
+        except Exception as e:
+            print("Error: in the DS3231 not connected or some other problem: %s" % e)
+            return None
+        bcd2bin = self.bcd2bin
+        return (bcd2bin(buffer[6]) + 2000, bcd2bin(buffer[5]), bcd2bin(buffer[4]),
+                bcd2bin(buffer[2]), bcd2bin(buffer[1]), bcd2bin(buffer[0]))
+
     # Read the Realtime from the DS3231 with errorhandling. Currently two output modes can be used.
     def get_time(self, mode=0):
         try:
@@ -0,0 +1,230 @@
+import uasyncio as asyncio
+
+import struct
+import time
+
+from gc_policy import GcPolicy
+
+class default_dispatcher_params:
+    # commands waiting to run, new ones are rejected past this
+    MAX_QUEUED = 16
+
+# actions the dispatcher handles itself
+STOP_ACTION = 0
+BATCH_ACTION = 11
+
+# lower runs first, only a stop cuts into the running action
+PRIORITY_STOP = 0
+PRIORITY_MANUAL = 1
+PRIORITY_MISSION = 2
+
+# command states sent on the status characteristic
+STATUS_QUEUED = 0
+STATUS_STARTED = 1
+STATUS_DONE = 2
+STATUS_CANCELLED = 3
+STATUS_FAILED = 4
+STATUS_REJECTED = 5
+
+def decode_batch(data):
+    """
+    Splits a batch write into its commands
+    Byte 0-1 -> Action (11)
+    Byte 2 -> Number Of Commands
+    Then for each command:
+        1 Byte Length, then the command bytes as they would be written alone
+    """
+    commands = []
+    if len(data) < 3:
+        return commands
+    count = data[2]
+    position = 3
+    for _ in range(count):
+        if position >= len(data):
+            break
+        length = data[position]
+        commands.append(data[position + 1:position + 1 + length])
+        position += 1 + length
+    return commands
+
+
+class Command:
+    """
+    A write on the desired location characteristic, decoded once.
+    The first 2 bytes (uint16) are the action, [data] is the whole write.
+    [seq] numbers commands in the order they arrived, it is reported with
+    every status update.
+    """
+    @classmethod
+    def decode(cls, data, seq, priorities, connection=None):
+        if data is None or len(data) < 2:
+            print("Command too short: ", data)
+            return None
+        action, = struct.unpack_from("<H", data)
+        return Command(action, data, seq, priorities.get(action, PRIORITY_MANUAL), connection)
+
+    def __init__(self, action, data, seq, priority=PRIORITY_MANUAL, connection=None):
+        self.action = action
+        self.data = data
+        self.seq = seq
+        self.priority = priority
+        self.connection = connection
+        self.received = time.ticks_ms()
+        self.started = None
+
+
+class CommandQueue:
+    """
+    Commands ordered by priority, then by arrival. uasyncio has no
+    asyncio.Queue so this waits on an Event.
+    """
+    def __init__(self, max_size=default_dispatcher_params.MAX_QUEUED):
+        self.items = []
+        self.max_size = max_size
+        self.event = asyncio.Event()
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, command):
+        # False when full
+        if len(self.items) >= self.max_size:
+            return False
+        index = len(self.items)
+        while index > 0 and self.items[index - 1].priority > command.priority:
+            index -= 1
+        self.items.insert(index, command)
+        self.event.set()
+        return True
+
+    async def get(self):
+        while not self.items:
+            self.event.clear()
+            await self.event.wait()
+        return self.items.pop(0)
+
+    def clear(self):
+        # Empties the queue, returns what was in it
+        items = self.items
+        self.items = []
+        return items
+
+
+class CommandDispatcher:
+    """
+    Runs commands one at a time, by priority then arrival, through
+    [actions], a table of action code -> async handler(controller, data).
+
+    A stop empties the queue and cancels the running action right away,
+    [on_preempt] (e.g. AgBot.stop) is then called so nothing is left
+    moving. Every other command waits its turn. [on_status] is called with
+    (command, state, queued) as commands are queued, start and finish.
+    """
+    def __init__(self, controller, actions, priorities=None, on_preempt=None, on_status=None,
+                 max_queued=default_dispatcher_params.MAX_QUEUED):
+        self.controller = controller
+        self.actions = actions
+        self.priorities = priorities if priorities is not None else {}
+        self.on_preempt = on_preempt
+        self.on_status = on_status
+        self.queue = CommandQueue(max_queued)
+        self.current = None
+        self.current_command = None
+        self.preempted = False
+        self.next_seq = 0
+
+        # latency from the write arriving to its handler starting (ms)
+        self.commands_run = 0
+        self.last_latency_ms = 0
+        self.max_latency_ms = 0
+        self.total_latency_ms = 0
+
+    def status(self, command, state):
+        if self.on_status is not None:
+            self.on_status(command, state, len(self.queue))
+
+    def submit(self, data, connection=None):
+        # Queues the command(s) in [data], returns how many were accepted
+        if data is not None and len(data) >= 2 and struct.unpack_from("<H", data)[0] == BATCH_ACTION:
+            accepted = 0
+            for command_data in decode_batch(data):
+                accepted += self.submit_one(command_data, connection)
+            return accepted
+        return self.submit_one(data, connection)
+
+    def submit_one(self, data, connection=None):
+        command = Command.decode(data, self.next_seq, self.priorities, connection)
+        if command is None:
+            return 0
+        self.next_seq = (self.next_seq + 1) & 0xFFFF
+
+        if command.action == STOP_ACTION:
+            for dropped in self.queue.clear():
+                self.status(dropped, STATUS_CANCELLED)
+            if self.current is not None and not self.current.done():
+                print("Preempting action: ", self.current_command.action)
+                self.preempted = True
+                self.current.cancel()
+
+        if not self.queue.put(command):
+            print("Command queue full, rejecting: ", command.action)
+            self.status(command, STATUS_REJECTED)
+            return 0
+        self.status(command, STATUS_QUEUED)
+        return 1
+
+    def record_start(self, command):
+        command.started = time.ticks_ms()
+        latency = time.ticks_diff(command.started, command.received)
+        self.commands_run += 1
+        self.last_latency_ms = latency
+        self.max_latency_ms = max(self.max_latency_ms, latency)
+        self.total_latency_ms += latency
+
+    def stats(self):
+        average = self.total_latency_ms / self.commands_run if self.commands_run else 0
+        return {
+            "commands_run": self.commands_run,
+            "queued": len(self.queue),
+            "last_latency_ms": self.last_latency_ms,
+            "max_latency_ms": self.max_latency_ms,
+            "average_latency_ms": average,
+        }
+
+    async def run(self):
+        while True:
+            command = await self.queue.get()
+            handler = self.actions.get(command.action, None)
+            if handler is None:
+                print("Not a known action: ", command.action)
+                self.status(command, STATUS_FAILED)
+                continue
+
+            self.record_start(command)
+            print("Running action: ", command.action, " seq: ", command.seq, " latency: ", self.last_latency_ms, "ms")
+            self.status(command, STATUS_STARTED)
+            self.current_command = command
+            self.current = asyncio.create_task(handler(self.controller, command.data))
+            state = STATUS_DONE
+            try:
+                await self.current
+            except asyncio.CancelledError:
+                if not self.preempted:
+                    # the dispatcher itself is being cancelled
+                    self.current.cancel()
+                    raise
+                print("Action cancelled: ", command.action)
+                state = STATUS_CANCELLED
+                if self.on_preempt is not None:
+                    self.on_preempt()
+            except Exception as e:
+                print("Action failed: ", command.action, e)
+                state = STATUS_FAILED
+            finally:
+                self.preempted = False
+                self.current = None
+                self.current_command = None
+            print("Action done: ", command.action, " in ", time.ticks_diff(time.ticks_ms(), command.started), "ms")
+            self.status(command, state)
+            if not self.queue:
+                GcPolicy.get_default_gc_policy().idle()
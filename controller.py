@@ -1,29 +1,79 @@
 from agbot import AgBot
 from agbot_memory import AgBotMemory
 
-from agbot_file_util import Utils
+from agbot_file_util import Utils, MISSION_HISTORY, ERROR_LOG
 
 import uasyncio as asyncio
-from clock import Clock
+from soft_clock import SoftClock
+from route_planner import RoutePlanner, default_route_params
+from gc_policy import GcPolicy
+from rollups import Rollups
+from record_log import RecordLog, MOISTURE_LOG, WATER_LOG, KIND_MOISTURE, KIND_WATER, KIND_PURGE, UNKNOWN_PLANT, timestamp_from_reading_name, first_record_timestamp, date_from_timestamp
+from log_index import history_first_timestamp
+from log_rotation import LogRotation
+from log_writer import LogWriter
+from scheduler import MissionScheduler
+from calibration import Calibration, CalibrationSession, LINEAR_POINTS, default_calibration_params
+
+## Mission modes
+# Sense a plant then water it right away if it is dry
+MISSION_MODE_PER_PLANT = 0
+# Sense every plant first, then water all the dry ones in one sweep. Opt in:
+# the sweep is a second tour from home, it only pays off when the water spots
+# are far from the sense spots (per plant mode goes back and forth between
+# them) or the pump needs priming (per plant mode detours to PURGE_SPOT)
+MISSION_MODE_TWO_PHASE = 1
+
+class default_mission_params:
+    # Mode used when the mission does not set one
+    MODE = MISSION_MODE_PER_PLANT
+    # Where the pump purges its line before watering when it needs priming
+    PURGE_SPOT = default_route_params.HOME
 
 class Controller():
     @classmethod
     def get_default_controller(cls):
         memory = AgBotMemory.get_default_agbotmemory()
         agBot = AgBot.get_default_agbot()
-        clock = Clock.get_default_clock()
+        clock = SoftClock.get_default_soft_clock()
         return Controller(memory, agBot, clock)
     
     def __init__(self,
                  memory: AgBotMemory,
                  agbot: AgBot,
-                 clock: Clock):
+                 clock: SoftClock):
         self.memory = memory
         self.agbot = agbot
         self.clock = clock
+        self.planner = RoutePlanner.get_default_route_planner(agbot.xy)
+        self.moisture_log = RecordLog(MOISTURE_LOG)
+        self.water_log = RecordLog(WATER_LOG)
+        self.rollups = Rollups.get_default_rollups()
+        self.rollups.fit(memory.get_plant_count())
+        self.writer = LogWriter.get_default_log_writer()
+        self.logs = LogRotation.get_default_log_rotation()
+        self.logs.register(MISSION_HISTORY, history_first_timestamp)
+        self.logs.register(ERROR_LOG)
+        self.logs.register(MOISTURE_LOG, first_record_timestamp)
+        self.logs.register(WATER_LOG, first_record_timestamp)
+        self.scheduler = MissionScheduler(memory, self.now_timestamp, self.run_scheduled_mission)
+        # schedule changes over BLE are seen right away
+        memory.on_missions_changed(self.scheduler.wake)
+        # logs kept by older firmware, as CSV or older records
+        for log in (MOISTURE_LOG, WATER_LOG):
+            for segment in self.logs.segments(log):
+                RecordLog(segment).upgrade()
+        self.moisture_log.import_csv("moisture_readings.csv", KIND_MOISTURE)
+        self.water_log.import_csv("water_log.csv", KIND_WATER)
+        self.load_calibration()
+        self.calibration_session = None
         
         self.agbot.stop()
         
+    def now_timestamp(self):
+        # Seconds since 2000 from the software clock, None when the RTC was never read
+        return self.clock.timestamp()
+
     async def setup_xy_max(self, force=False):
         ## sets gantry endstops
         
@@ -74,10 +124,84 @@ class Controller():
         # go back home
         self.agbot.home()
     
-    def log_string_from_reading(self, date, x, y, reading):
-        return date + "," + str(int(x)) + "," + str(int(y)) + "," + str(reading)
+    def plan_mission_route(self, mission):
+        """
+        Returns the mission locations in the order that needs the least belt travel,
+        starting and finishing at the home spot. The order is cached in memory
+        until the mission's plants change.
+        """
+        mission_id = mission["mission_id"]
+        route = self.memory.get_cached_route(mission_id, "sense")
+        if route is not None:
+            return route
+
+        stops = {}
+        unknown = []
+        for location in mission.get("locations", []):
+            cordiantes = self.memory.get_plant_sense_spot(location)
+            if cordiantes is None:
+                unknown.append(location)
+            else:
+                stops[location] = cordiantes
+
+        home = default_route_params.HOME
+        route = self.planner.plan(stops, home, home)
+        print("Planned route: ", route)
+        # plants missing from memory are kept so run_mission can report them
+        route = route + unknown
+        self.memory.cache_route(mission_id, "sense", route)
+        return route
+
+    ### Probe Calibration
+
+    def load_calibration(self, probe=default_calibration_params.PROBE):
+        curve = self.memory.get_calibration(probe)
+        if curve is None:
+            calibration = Calibration()
+        else:
+            calibration = Calibration(curve["points"], curve["version"])
+        print("Probe ", probe, " calibration version ", calibration.version)
+        self.agbot.sensor.set_calibration(calibration)
+
+    def start_calibration(self, probe=default_calibration_params.PROBE):
+        self.calibration_session = CalibrationSession(self.memory, self.agbot.sense_raw, probe)
 
-    async def run_mission(self, date=None, mission_id=0):
+    async def measure_calibration_point(self, percent):
+        # Probes the soil under the AgBot, [percent] its known volumetric water content
+        if self.calibration_session is None:
+            self.start_calibration()
+        return await self.calibration_session.measure(percent)
+
+    def finish_calibration(self):
+        if self.calibration_session is None:
+            print("No calibration started")
+            return None
+        calibration = self.calibration_session.finish()
+        if calibration is not None:
+            self.agbot.sensor.set_calibration(calibration)
+            self.calibration_session = None
+        return calibration
+
+    def reset_calibration(self, probe=default_calibration_params.PROBE):
+        # Back to the linear curve, as a new version so readings stay told apart
+        self.memory.set_calibration(probe, LINEAR_POINTS)
+        self.calibration_session = None
+        self.load_calibration(probe)
+
+    def log_reading(self, log, date, location, x, y, value, kind):
+        plant_id = self.memory.get_plant(location).get("id", UNKNOWN_PLANT)
+        seconds = timestamp_from_reading_name(date)
+        # the curve the moisture was read with, kept next to the reading
+        calibration = self.agbot.sensor.calibration.version if kind == KIND_MOISTURE else 0
+        log.append(seconds, plant_id, x, y, value, kind, calibration)
+        # plants added since boot need room too
+        self.rollups.fit(self.memory.get_plant_count())
+        if kind == KIND_WATER:
+            self.rollups.add_water(plant_id, seconds, value)
+        else:
+            self.rollups.add_moisture(plant_id, seconds, value)
+
+    async def run_mission(self, date=None, mission_id=0, mode=None):
         # Step 1: Move to each location
         # Step 2: Sense the moisture
         # Repeat for all locations in mission
@@ -85,71 +209,128 @@ class Controller():
         mission = self.memory.get_mission(mission_id)
 
         if date is None:
-            time = self.clock.get_time()
+            time = self.clock.datetime()
             if time is not None:
-                second, minute, hour, weekday, month, day, year = self.clock.get_time()
-                print(second, minute, hour, weekday, month, day, year)
+                year, month, day, hour, minute, second = time
+                print(second, minute, hour, month, day, year)
                 date = Utils.reading_name_from_time(month, day, year, hour, minute, second)
             else:
                 print("Error: Could not get time")
                 return
             
         if mission is not None:
-            for location in mission.get("locations", []):
-                print("Sensing moisture at: ", location)
-                cordiantes = self.memory.get_plant_sense_spot(location)
-                if cordiantes is None:
-                    print("Plant not found in memory")
-                    continue
-                
-                print("Cordinates: ", cordiantes)
-                await self.agbot.move_to(cordiantes[0], cordiantes[1])
-                moisture_reading = await self.agbot.read()
-                reading_string = self.log_string_from_reading(date,
-                                                              cordiantes[0],
-                                                              cordiantes[1],
-                                                              moisture_reading)
-
-                moisure_threshold = self.memory.get_moisture_threshold(location)
-                water_amount = 0
-                print("Moisture reading: ", moisture_reading)
-                print("Moisture threshold: ", moisure_threshold)
-                if moisture_reading < moisure_threshold:
-                    print("Watering plant: ", location)
-                    # if moisutre is below threshold, water the plant
-                    # move there
-                    water_site = self.memory.get_plant_water_spot(location)
-                    await self.agbot.move_to(water_site[0], water_site[1])
-
-                    # water
-                    water_amount = self.memory.get_plant_ml_response(location)
-                    await self.agbot.water(water_amount)
-                    water_reading_string = self.log_string_from_reading(date,
-                                                                        water_site[0],
-                                                                        water_site[1],
-                                                                        water_amount)
-                    print("Watering: ", water_reading_string)
-                    Utils.append_reading_to_csv("water_log.csv", water_reading_string)
-
-
-                print("String to log: ", reading_string)
-                Utils.append_reading_to_csv("moisture_readings.csv", reading_string)
+            if mode is None:
+                mode = mission.get("mode", default_mission_params.MODE)
+
+            if mode == MISSION_MODE_TWO_PHASE:
+                await self.run_mission_two_phase(date, mission)
+            else:
+                await self.run_mission_per_plant(date, mission)
 
             # Step 3: Move back home
-            await self.agbot.move_to(10, 10)
+            await self.agbot.move_to(default_route_params.HOME[0], default_route_params.HOME[1])
+
+        # the mission's records go to flash in one write per file
+        self.writer.flush("mission")
+        # nothing runs between missions, a good time to collect
+        GcPolicy.get_default_gc_policy().idle()
+
+    async def sense_plant(self, date, location):
+        """
+        Moves to the sense spot of [location], probes it and logs the reading.
+        Returns the reading, or None if the plant is not in memory
+        """
+        print("Sensing moisture at: ", location)
+        cordiantes = self.memory.get_plant_sense_spot(location)
+        if cordiantes is None:
+            print("Plant not found in memory")
+            return None
+
+        print("Cordinates: ", cordiantes)
+        await self.agbot.move_to(cordiantes[0], cordiantes[1])
+        moisture_reading, confidence = await self.agbot.sense()
+        print("Moisture reading: ", moisture_reading, "confidence: ", confidence)
+        self.log_reading(self.moisture_log, date, location,
+                         cordiantes[0], cordiantes[1], moisture_reading, KIND_MOISTURE)
+        return moisture_reading
+
+    async def prime_pump(self, date):
+        # Primes the pump over PURGE_SPOT and logs the ml purged, apart from the waterings
+        purge_spot = default_mission_params.PURGE_SPOT
+        await self.agbot.move_to(purge_spot[0], purge_spot[1])
+        purged = await self.agbot.prime()
+        print("Purged: ", purged, "ml")
+        self.water_log.append(timestamp_from_reading_name(date), UNKNOWN_PLANT,
+                              purge_spot[0], purge_spot[1], purged, KIND_PURGE)
+
+    async def water_plant(self, date, location):
+        # Moves to the water spot of [location], waters it and logs the amount dispensed
+        print("Watering plant: ", location)
+        if self.agbot.pump.needs_prime():
+            await self.prime_pump(date)
+        water_site = self.memory.get_plant_water_spot(location)
+        await self.agbot.move_to(water_site[0], water_site[1])
+
+        # water
+        water_amount = self.memory.get_plant_ml_response(location)
+        dispensed = await self.agbot.water(water_amount)
+        print("Watering: ", dispensed, "ml of ", water_amount, "ml")
+        self.log_reading(self.water_log, date, location,
+                         water_site[0], water_site[1], dispensed, KIND_WATER)
+
+    async def run_mission_per_plant(self, date, mission):
+        # Sense each plant and water it right away if it is dry
+        for location in self.plan_mission_route(mission):
+            moisture_reading = await self.sense_plant(date, location)
+            if moisture_reading is None:
+                continue
+
+            moisure_threshold = self.memory.get_moisture_threshold(location)
+            print("Moisture threshold: ", moisure_threshold)
+            if moisture_reading < moisure_threshold:
+                # if moisutre is below threshold, water the plant
+                await self.water_plant(date, location)
+
+    async def run_mission_two_phase(self, date, mission):
+        # Phase 1: sense every plant along the mission route, back to home
+        readings = {}
+        for location in self.plan_mission_route(mission):
+            moisture_reading = await self.sense_plant(date, location)
+            if moisture_reading is not None:
+                readings[location] = moisture_reading
+
+        # Phase 2: water the dry plants in a single sweep that ends at home
+        dry_plants = {}
+        for location, moisture_reading in readings.items():
+            moisure_threshold = self.memory.get_moisture_threshold(location)
+            if moisture_reading < moisure_threshold:
+                dry_plants[location] = self.memory.get_plant_water_spot(location)
+        print("Plants to water: ", list(dry_plants.keys()))
+        if not dry_plants:
+            return
+
+        start = self.agbot.xy.get_position()
+        if self.agbot.pump.needs_prime():
+            # prime before the sweep so water_plant makes no detour in the middle of it
+            start = default_mission_params.PURGE_SPOT
+            await self.prime_pump(date)
+        for location in self.planner.plan(dry_plants, start, default_route_params.HOME):
+            await self.water_plant(date, location)
 
     async def run(self):
         """
         Run the scheduled routine
-        This function will run the routine at scheduled times
+        Missions run at their scheduled times, the scheduler sleeps until
+        the next one is due (see scheduler)
         """
-        missions = self.memory.get_missions()
-        mission_history = Utils.get_mission_history()
-        for m in mission_history:
-            print("Mission history: ", m)
+        # only today's missions matter, the rest of the history is not read
+        now = self.now_timestamp()
+        self.scheduler.runs.load(Utils.iter_mission_history(None if now is None else now - now % 86400))
+        for mission_id, last_run in self.scheduler.runs.last_runs.items():
+            print("Mission history: ", mission_id, "last ran at", last_run)
 
         print("Mission times: ")
-        for mission in missions:                
+        for mission in self.memory.get_missions():
             print("\t", mission["type"], "at", mission["time"][0], mission["time"][1])
 
         await self.agbot.home()
@@ -158,38 +339,17 @@ class Controller():
         await asyncio.sleep(1)
         await self.agbot.move_to(20, 20)
 
-        while True:
-            # get the time
-            time = self.clock.get_time()
-            if time is None:
-                print("Error: Could not get time")
-                await asyncio.sleep(30)
-                continue
-            second, minute, hour, weekday, month, day, year = self.clock.get_time()
-            print(second, minute, hour, weekday, month, day, year)
-            date = Utils.reading_name_from_time(month, day, year, hour, minute, second)
-            
-            for mission in missions:
-                mission_compeleted = False
-                for past_mission in mission_history:
-                    if past_mission[0] == mission["mission_id"]:
-                        # Mission has already been run today
-                        if past_mission[1] == day and past_mission[2] == month and past_mission[3] == year-2000:
-                            mission_compeleted = True
-                            break
-                
-                # If its is past mission time, run the mission
-                if (mission_compeleted == False) and (mission["time"][0] == int(hour) and mission["time"][1] <= int(minute) or \
-                    mission["time"][0] < int(hour)): 
-                    # we run the mission if it is within 5 minutes of the scheduled time
-                    # if the mission has not been completed
-                    print("Running mission: ", mission["type"])
-                    if mission["type"] == "sense_moisture":
-                        await self.run_mission(date, mission["mission_id"])
-                        mission_history.append([mission["mission_id"], day, month, year-2000, hour, minute])
-                        Utils.append_mission_to_history(mission["mission_id"], day, month, year, hour, minute)
-
-            await asyncio.sleep(30)
+        await self.scheduler.run()
+
+    async def run_scheduled_mission(self, mission, now):
+        # Runs a mission the scheduler found due at [now] and logs it
+        year, month, day, hour, minute, second = date_from_timestamp(now)
+        date = Utils.reading_name_from_time(month, day, year, hour, minute, second)
+        print("Running mission: ", mission["type"], "at", date)
+        await self.run_mission(date, mission["mission_id"])
+        Utils.append_mission_to_history(mission["mission_id"], day, month, year, hour, minute)
+        # a mission left out of the history would run again after a reset
+        self.writer.flush("mission")
           
     def manual(self):
         while True:
@@ -0,0 +1,251 @@
+"""
+Protocol v2 for sending files over the json characteristic.
+
+v1 (agbot_file_util.send_file_task) sends 100 byte chunks with a one byte
+index and sleeps 100 ms after every notify. v2 sizes the chunks from the
+connection MTU, numbers them with 32 bits and keeps a window of chunks in
+flight, resending only the ones the client reports missing.
+
+Client -> device, written to the json write characteristic:
+- Request: 0x20, file id - 1 byte, window - 1 byte (optional),
+           range kind - 1 byte, range value - 4 bytes (optional)
+           range kinds: 0x00 whole file, 0x01 from byte [value] (to
+           resume), 0x02 records logged after the log_index.date_key
+           [value] (to sync, logs only)
+- Ack:     0x21, base - 4 bytes, bitmap - N bytes
+           every chunk before [base] arrived, bit i of the bitmap (byte
+           i // 8, bit i % 8) says chunk base + i arrived. Chunks missing
+           before the highest one set are resent.
+- Cancel:  0x22
+
+Device -> client, notified on the json characteristic:
+- Header:  0x11, file type - 1 byte, payload size - 2 bytes, window - 2 bytes,
+           number of chunks - 4 bytes, start offset - 4 bytes,
+           length - 4 bytes, file checksum - 1 byte, header checksum - 1 byte
+- Payload: 0x12, chunk index - 4 bytes, data - payload size bytes (less
+           for the last one), checksum - 1 byte
+- Last:    0x13, file name (optional)
+
+The client acks at least every window / 2 chunks and after the last one.
+"""
+import uasyncio as asyncio
+
+import errno
+import struct
+
+from agbot_file_util import file_types, calcule_hash, stream_checksum, generate_last_message
+from gc_policy import GcPolicy
+
+
+class default_transfer_params:
+    # asked for at boot, the client can still settle on less
+    PREFERRED_MTU = 247
+    # chunks sent before waiting for an ack
+    WINDOW = 32
+    MAX_WINDOW = 255
+    # with no ack for this long the unacked chunks are sent again
+    ACK_TIMEOUT_MS = 2000
+    # ack timeouts in a row before the transfer is given up
+    MAX_TIMEOUTS = 5
+    # wait when the BLE stack has no free TX buffer
+    BUSY_RETRY_MS = 5
+
+# client -> device
+TRANSFER_REQUEST = 0x20
+TRANSFER_ACK = 0x21
+TRANSFER_CANCEL = 0x22
+
+# request range kinds
+RANGE_ALL = 0x00
+RANGE_FROM_OFFSET = 0x01
+RANGE_AFTER_DATE = 0x02
+
+# device -> client
+HEADER_V2 = 0x11
+PAYLOAD_V2 = 0x12
+LAST_V2 = 0x13
+
+# opcode + index + checksum
+PAYLOAD_OVERHEAD = 6
+# ATT notification header
+ATT_OVERHEAD = 3
+# the default ATT MTU when no exchange happened
+DEFAULT_MTU = 23
+
+def generate_v2_header_message(file_type_id, payload_size, window, num_chunks, offset, length, checksum):
+    header = bytearray(struct.pack("<BBHHIIIB", HEADER_V2, file_type_id, payload_size, window,
+                                   num_chunks, offset, length, checksum))
+    header.append(calcule_hash(header))
+    return header
+
+def generate_v2_payload_message(buffer, index, size):
+    # Fills the opcode, index and checksum around the [size] data bytes
+    # already in [buffer][5:], returns the packet as a view of [buffer]
+    struct.pack_into("<BI", buffer, 0, PAYLOAD_V2, index)
+    buffer[5 + size] = calcule_hash(memoryview(buffer)[:5 + size])
+    return memoryview(buffer)[:size + PAYLOAD_OVERHEAD]
+
+def generate_v2_last_message(file_name=None):
+    last = generate_last_message(file_name)
+    last[0] = LAST_V2
+    return last
+
+def payload_size_for_mtu(mtu):
+    if not mtu:
+        mtu = DEFAULT_MTU
+    return mtu - ATT_OVERHEAD - PAYLOAD_OVERHEAD
+
+
+class FileTransfer:
+    """
+    Sends the stream opened by [open_stream] (see Utils.send_stream_task)
+    to [connection] with protocol v2. The stream must also have seek, to go
+    back for retransmits.
+    """
+    def __init__(self, characteristic, write_characteristic, connection,
+                 open_stream, file_type, file_name=None, offset=0, length=None,
+                 window=default_transfer_params.WINDOW,
+                 ack_timeout_ms=default_transfer_params.ACK_TIMEOUT_MS,
+                 max_timeouts=default_transfer_params.MAX_TIMEOUTS):
+        self.characteristic = characteristic
+        self.write_characteristic = write_characteristic
+        self.connection = connection
+        self.open_stream = open_stream
+        self.file_type = file_type
+        self.file_name = file_name
+        self.offset = offset
+        self.length = length
+        self.window = max(1, min(window, default_transfer_params.MAX_WINDOW))
+        self.ack_timeout_ms = ack_timeout_ms
+        self.max_timeouts = max_timeouts
+
+        # counters
+        self.chunks_sent = 0
+        self.chunks_resent = 0
+        # ack timeouts in a row, reset by an ack that acknowledges new chunks
+        self.timeouts = 0
+
+    async def notify(self, packet):
+        # Notifies [packet], waiting while the stack's TX buffers are full
+        while True:
+            try:
+                self.characteristic.notify(self.connection, packet)
+                return
+            except OSError as e:
+                if e.args[0] != errno.ENOMEM:
+                    raise
+            await asyncio.sleep_ms(default_transfer_params.BUSY_RETRY_MS)
+
+    async def run(self):
+        """
+        Sends the file. Returns a write that arrived on the write
+        characteristic and was not an ack (the transfer stops for it, the
+        caller should handle it), or None.
+        """
+        file_type_id = file_types.get(self.file_type, None)
+        if file_type_id is None:
+            print("Invalid file type", self.file_type)
+            return None
+
+        payload_size = payload_size_for_mtu(self.connection.mtu)
+        buffer = bytearray(payload_size + PAYLOAD_OVERHEAD)
+        chunk = memoryview(buffer)[5:5 + payload_size]
+
+        stream = self.open_stream()
+        try:
+            stream.seek(self.offset)
+            length, checksum = stream_checksum(stream, chunk, self.length)
+            num_chunks = (length + payload_size - 1) // payload_size
+            print("Sending ", length, " bytes in ", num_chunks, " chunks of ", payload_size)
+            await self.notify(generate_v2_header_message(file_type_id, payload_size, self.window,
+                                                         num_chunks, self.offset, length, checksum))
+
+            acked = bytearray((num_chunks + 7) // 8)
+            acked_count = 0
+            # every chunk before [acked_low] is acked, acks only set bits from there on
+            acked_low = 0
+            next_new = 0
+            resend = []
+            position = None
+
+            while acked_count < num_chunks:
+                # fill the window, lost chunks first
+                while resend or (next_new < num_chunks and next_new - acked_count - len(resend) < self.window):
+                    if resend:
+                        index = resend.pop(0)
+                        self.chunks_resent += 1
+                    else:
+                        index = next_new
+                        next_new += 1
+                    start = index * payload_size
+                    size = min(payload_size, length - start)
+                    if position != start:
+                        stream.seek(self.offset + start)
+                    read = stream.readinto(chunk[:size])
+                    position = start + read
+                    await self.notify(generate_v2_payload_message(buffer, index, read))
+                    self.chunks_sent += 1
+                    # let the other tasks run between packets
+                    await asyncio.sleep_ms(0)
+
+                # the client needs a moment to ack the window anyway
+                GcPolicy.get_default_gc_policy().idle()
+                try:
+                    _, data = await self.write_characteristic.written(timeout_ms=self.ack_timeout_ms) # type: ignore
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                    print("Transfer ack timeout ", self.timeouts)
+                    if self.timeouts > self.max_timeouts:
+                        print("Transfer abandoned")
+                        return None
+                    resend = [index for index in range(acked_low, next_new)
+                              if not acked[index >> 3] & (1 << (index & 7))]
+                    continue
+
+                if data is None or len(data) == 0:
+                    continue
+                if data[0] == TRANSFER_CANCEL:
+                    print("Transfer cancelled")
+                    return None
+                if data[0] != TRANSFER_ACK or len(data) < 5:
+                    print("Transfer interrupted by: ", data)
+                    return data
+
+                acked_before = acked_count
+                base, = struct.unpack_from("<I", data, 1)
+                base = min(base, next_new)
+                for index in range(acked_low, base):
+                    byte, bit = index >> 3, 1 << (index & 7)
+                    if not acked[byte] & bit:
+                        acked[byte] |= bit
+                        acked_count += 1
+                acked_low = max(acked_low, base)
+
+                highest = -1
+                for bit_index in range((len(data) - 5) * 8):
+                    index = base + bit_index
+                    if index >= next_new:
+                        break
+                    if data[5 + (bit_index >> 3)] & (1 << (bit_index & 7)):
+                        highest = index
+                        byte, bit = index >> 3, 1 << (index & 7)
+                        if not acked[byte] & bit:
+                            acked[byte] |= bit
+                            acked_count += 1
+
+                while acked_low < next_new and acked[acked_low >> 3] & (1 << (acked_low & 7)):
+                    acked_low += 1
+                if acked_count > acked_before:
+                    self.timeouts = 0
+
+                # chunks after the highest reported one may still be on the way
+                resend = [index for index in range(base, highest)
+                          if not acked[index >> 3] & (1 << (index & 7))]
+
+            await self.notify(generate_v2_last_message(self.file_name))
+            print("Transfer done: ", self.chunks_sent, " chunks sent, ", self.chunks_resent, " resent")
+        except OSError as e:
+            print("Transfer failed: ", e)
+        finally:
+            stream.close()
+        return None
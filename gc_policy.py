@@ -0,0 +1,145 @@
+import uasyncio as asyncio
+
+import gc
+import time
+
+class default_gc_params:
+    # collect as soon as less than this is free (bytes)
+    LOW_WATERMARK = 24 * 1024
+    # how often free memory is checked (ms)
+    CHECK_PERIOD_MS = 1000
+    # idle windows only collect once this much was allocated since the last collection (bytes)
+    IDLE_MIN_ALLOCATED = 8 * 1024
+    # and no more often than this (ms)
+    IDLE_MIN_INTERVAL_MS = 2000
+    # a watermark collection freeing less than this doubles the wait before the next one (bytes)
+    MIN_FREED = 2 * 1024
+    # longest wait between watermark collections while live data keeps memory low (ms)
+    MAX_BACKOFF_MS = 60 * 1000
+
+
+class GcPolicy:
+    """
+    Decides when to run gc.collect instead of collecting before every call:
+    when free memory drops below [low_watermark], and in idle windows the
+    firmware points out (between missions, commands, transfer windows) if
+    enough was allocated since the last collection.
+
+    Every collection records its pause, so the cost of the policy can be
+    read from stats(). Low memory hooks run before a watermark collection,
+    to let go of what can be written out (e.g. LogWriter buffers).
+
+    When live data keeps free memory below the watermark, collecting does
+    not help: after a watermark collection that freed less than
+    [min_freed] the next one waits twice as long, up to [max_backoff_ms],
+    until memory is back above the watermark.
+    """
+    _DEFAULT_GC_POLICY_INSTANCE = None
+
+    @classmethod
+    def get_default_gc_policy(cls):
+        # One policy for the whole firmware
+        if cls._DEFAULT_GC_POLICY_INSTANCE is None:
+            cls._DEFAULT_GC_POLICY_INSTANCE = GcPolicy()
+        return cls._DEFAULT_GC_POLICY_INSTANCE
+
+    def __init__(self, low_watermark=default_gc_params.LOW_WATERMARK,
+                 check_period_ms=default_gc_params.CHECK_PERIOD_MS,
+                 idle_min_allocated=default_gc_params.IDLE_MIN_ALLOCATED,
+                 idle_min_interval_ms=default_gc_params.IDLE_MIN_INTERVAL_MS,
+                 min_freed=default_gc_params.MIN_FREED,
+                 max_backoff_ms=default_gc_params.MAX_BACKOFF_MS):
+        self.low_watermark = low_watermark
+        self.check_period_ms = check_period_ms
+        self.idle_min_allocated = idle_min_allocated
+        self.idle_min_interval_ms = idle_min_interval_ms
+        self.min_freed = min_freed
+        self.max_backoff_ms = max_backoff_ms
+
+        self.last_collect_ms = time.ticks_ms()
+        self.allocated_after_collect = gc.mem_alloc()
+
+        # reason -> [collections, total pause us, max pause us]
+        self.pauses = {}
+        self.last_pause_us = 0
+        self.freed = 0
+        self.last_freed = 0
+        # wait before the next watermark collection, 0 while they free enough
+        self.backoff_ms = 0
+        self.last_watermark_ms = self.last_collect_ms
+        self.low_memory_hooks = []
+
+    def add_low_memory_hook(self, hook):
+        self.low_memory_hooks.append(hook)
+
+    def collect(self, reason="manual"):
+        before = gc.mem_alloc()
+        start = time.ticks_us()
+        gc.collect()
+        pause = time.ticks_diff(time.ticks_us(), start)
+
+        self.last_collect_ms = time.ticks_ms()
+        self.allocated_after_collect = gc.mem_alloc()
+        self.last_freed = max(0, before - self.allocated_after_collect)
+        self.freed += self.last_freed
+        self.last_pause_us = pause
+        record = self.pauses.get(reason, None)
+        if record is None:
+            record = [0, 0, 0]
+            self.pauses[reason] = record
+        record[0] += 1
+        record[1] += pause
+        record[2] = max(record[2], pause)
+        return pause
+
+    def check(self):
+        # Collects if free memory is below the watermark, backing off while collecting does not help
+        if gc.mem_free() >= self.low_watermark:
+            self.backoff_ms = 0
+            return False
+        if self.backoff_ms and time.ticks_diff(time.ticks_ms(), self.last_watermark_ms) < self.backoff_ms:
+            return False
+        for hook in self.low_memory_hooks:
+            hook()
+        self.collect("watermark")
+        self.last_watermark_ms = self.last_collect_ms
+        if self.last_freed < self.min_freed:
+            # live data holds the memory
+            self.backoff_ms = min(max(2 * self.backoff_ms, 2 * self.check_period_ms), self.max_backoff_ms)
+        else:
+            self.backoff_ms = 0
+        return True
+
+    def idle(self):
+        # Called where a pause costs nothing, collects if it is worth it
+        if time.ticks_diff(time.ticks_ms(), self.last_collect_ms) < self.idle_min_interval_ms:
+            return False
+        if gc.mem_alloc() - self.allocated_after_collect < self.idle_min_allocated:
+            return False
+        self.collect("idle")
+        return True
+
+    def stats(self):
+        collections = 0
+        total_pause = 0
+        max_pause = 0
+        for count, total, longest in self.pauses.values():
+            collections += count
+            total_pause += total
+            max_pause = max(max_pause, longest)
+        return {
+            "collections": collections,
+            "total_pause_us": total_pause,
+            "max_pause_us": max_pause,
+            "last_pause_us": self.last_pause_us,
+            "freed": self.freed,
+            "backoff_ms": self.backoff_ms,
+            "mem_free": gc.mem_free(),
+            "by_reason": self.pauses,
+        }
+
+    async def run(self):
+        # Background watermark check
+        while True:
+            self.check()
+            await asyncio.sleep_ms(self.check_period_ms)
@@ -0,0 +1,182 @@
+"""
+Date -> byte offset index of the CSV logs, so a ranged download can start
+at the first record after a date without scanning the log. Only the
+mission history is a CSV log now, readings and waterings are record_log
+files which need no index.
+
+[log].idx holds one (date key, offset) entry per run of records with the
+same date, in the order they were logged. Entries are added after the log
+line is written, a power cut in between only makes a download start a
+little early.
+
+Keys only go up while the clock does. Where it was set back the entries
+start a new run, offset_after searches the runs one after the other.
+"""
+import os
+import struct
+
+from log_rotation import segment_base
+from record_log import timestamp_from_date_key, date_from_timestamp
+from log_writer import LogWriter
+
+ENTRY_FORMAT = "<II"
+ENTRY_SIZE = 8
+
+def date_key(year, month, day, hour, minute):
+    # Sortable minute stamp, [year] is years since 2000
+    return (int(year) << 20) | (int(month) << 16) | (int(day) << 11) | (int(hour) << 6) | int(minute)
+
+def date_key_from_timestamp(seconds):
+    # date_key of [seconds] since 2000
+    year, month, day, hour, minute, _ = date_from_timestamp(seconds)
+    return date_key(year - 2000, month, day, hour, minute)
+
+def reading_line_date_key(line):
+    # month,day,year,hour,minute,... (see Utils.reading_name_from_time)
+    month, day, year, hour, minute = line.split(",")[:5]
+    return date_key(year, month, day, hour, minute)
+
+def history_line_date_key(line):
+    # mission_id,day,month,year,hour,minute
+    day, month, year, hour, minute = line.split(",")[1:6]
+    return date_key(year, month, day, hour, minute)
+
+# log file -> how to read the date of one of its lines
+LINE_DATE_KEYS = {
+    "mission_history.csv": history_line_date_key,
+}
+
+def history_first_timestamp(file_name):
+    # Timestamp of the first mission in a mission history file, None when there is none
+    try:
+        with open(file_name, 'r') as file:
+            return timestamp_from_date_key(history_line_date_key(file.readline()))
+    except (OSError, ValueError, IndexError):
+        return None
+
+def file_size(file_name):
+    try:
+        return os.stat(file_name)[6]
+    except OSError:
+        return 0
+
+
+class LogIndex:
+    _indexes = {}
+
+    @classmethod
+    def get_log_index(cls, log_file_name):
+        # The index of [log_file_name], or None for logs that are not indexed
+        index = cls._indexes.get(log_file_name, None)
+        if index is None:
+            # rotated segments are indexed like the log they come from
+            line_date_key = LINE_DATE_KEYS.get(segment_base(log_file_name), None)
+            if line_date_key is None:
+                return None
+            index = LogIndex(log_file_name, line_date_key)
+            cls._indexes[log_file_name] = index
+        return index
+
+    def __init__(self, log_file_name, line_date_key):
+        self.log_file_name = log_file_name
+        self.index_file_name = log_file_name + ".idx"
+        self.line_date_key = line_date_key
+        self.last_key = None
+        # positions of the entries starting a run, None until offset_after needs them
+        self.runs = None
+        self.entry = bytearray(ENTRY_SIZE)
+
+        count = self.count()
+        if count:
+            last_key, last_offset = self.read_entry(count - 1)
+            self.last_key = last_key
+        if (count == 0 and file_size(log_file_name) > 0) or (count and last_offset > file_size(log_file_name)):
+            self.rebuild()
+
+    def count(self):
+        return file_size(self.index_file_name) // ENTRY_SIZE
+
+    def read_entry(self, position, file=None):
+        if file is None:
+            with open(self.index_file_name, 'rb') as file:
+                return self.read_entry(position, file)
+        file.seek(position * ENTRY_SIZE)
+        file.readinto(self.entry)
+        return struct.unpack(ENTRY_FORMAT, self.entry)
+
+    def key_of(self, line):
+        try:
+            return self.line_date_key(line)
+        except (ValueError, IndexError):
+            return None
+
+    def add(self, line, offset):
+        # Notes that [line] was logged at [offset]
+        if offset == 0:
+            # a new file, the log was rotated or removed
+            self.last_key = None
+            self.runs = None
+        key = self.key_of(line)
+        if key is None or key == self.last_key:
+            return
+        writer = LogWriter.get_default_log_writer()
+        position = (file_size(self.index_file_name) + writer.pending(self.index_file_name)) // ENTRY_SIZE
+        if writer.append(self.index_file_name, struct.pack(ENTRY_FORMAT, key, offset)):
+            if self.runs is not None and self.last_key is not None and key < self.last_key:
+                # the clock was set back
+                self.runs.append(position)
+            self.last_key = key
+
+    def find_runs(self):
+        # Positions of the entries whose key is lower than the one before
+        runs = [0]
+        previous = None
+        with open(self.index_file_name, 'rb') as file:
+            for position in range(self.count()):
+                key = self.read_entry(position, file)[0]
+                if previous is not None and key < previous:
+                    runs.append(position)
+                previous = key
+        return runs
+
+    def rebuild(self):
+        # Indexes the whole log again, only needed when the index is missing or stale
+        print("Rebuilding index of ", self.log_file_name)
+        self.last_key = None
+        self.runs = None
+        with open(self.index_file_name, 'wb'):
+            pass
+        offset = 0
+        try:
+            with open(self.log_file_name, 'rb') as file:
+                while True:
+                    line = file.readline()
+                    if not line:
+                        break
+                    self.add(line.decode('utf-8'), offset)
+                    offset += len(line)
+        except OSError as e:
+            print("Error reading file: ", e)
+
+    def offset_after(self, key):
+        # Offset of the first record logged after [key], or the log size when there is none.
+        # Readers flush the LogWriter first (LogRotation.segments), so the index is all on flash
+        count = self.count()
+        if count == 0:
+            # nothing in the log could be dated, send all of it
+            return 0
+        if self.runs is None:
+            self.runs = self.find_runs()
+        with open(self.index_file_name, 'rb') as file:
+            for run, start in enumerate(self.runs):
+                end = self.runs[run + 1] if run + 1 < len(self.runs) else count
+                low, high = start, min(end, count)
+                while low < high:
+                    middle = (low + high) // 2
+                    if self.read_entry(middle, file)[0] <= key:
+                        low = middle + 1
+                    else:
+                        high = middle
+                if low < min(end, count):
+                    return self.read_entry(low, file)[1]
+        return file_size(self.log_file_name)
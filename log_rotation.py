@@ -0,0 +1,308 @@
+"""
+Size and age based rotation of the append-only logs.
+
+The file being appended to keeps its name (mission_history.csv). Once it
+is too big or its first record too old it is renamed to the next
+numbered segment (mission_history.csv.1, .2, ...), numbers only go up so
+a segment keeps its name until it is dropped. A companion index
+([file].idx) is renamed with it.
+
+Past [max_segments] the oldest segments are deleted, or with [archive]
+deflate compressed into [segment].z first, keeping [max_archives] of
+those. Archives are only kept, nothing in the firmware reads them back.
+A segment that could not be archived (no deflate module, flash full) is
+kept and archived at a later rotation.
+
+Readers go through segments(file_name, since) to only open the segments
+that can hold records after a date.
+"""
+import uasyncio as asyncio
+
+import os
+
+from log_writer import LogWriter
+
+try:
+    import deflate
+except ImportError:
+    deflate = None
+
+class default_rotation_params:
+    # the log is rotated past this size (bytes)
+    MAX_SIZE = 32 * 1024
+    # or once its first record is older than this (seconds), None to only go by size
+    MAX_AGE_S = 31 * 86400
+    # rotated segments kept
+    MAX_SEGMENTS = 8
+    # compress segments past MAX_SEGMENTS instead of deleting them
+    ARCHIVE = False
+    # compressed segments kept
+    MAX_ARCHIVES = 16
+    # how often the logs are checked (ms)
+    CHECK_PERIOD_MS = 10 * 60 * 1000
+
+INDEX_SUFFIX = ".idx"
+ARCHIVE_SUFFIX = ".z"
+
+def segment_name(file_name, number):
+    return file_name + "." + str(number)
+
+def segment_base(name):
+    # mission_history.csv.3 -> mission_history.csv, other names are returned as they are
+    base, _, number = name.rpartition(".")
+    if base and number.isdigit():
+        return base
+    return name
+
+def segment_numbers(file_name, suffix=""):
+    # Numbers of the rotated segments of [file_name], oldest first
+    prefix = file_name + "."
+    numbers = []
+    for entry in os.listdir():
+        if not entry.startswith(prefix) or not entry.endswith(suffix):
+            continue
+        number = entry[len(prefix):len(entry) - len(suffix)]
+        if number.isdigit():
+            numbers.append(int(number))
+    numbers.sort()
+    return numbers
+
+def file_size(file_name):
+    try:
+        return os.stat(file_name)[6]
+    except OSError:
+        return 0
+
+def segments_size(file_names, skip=0):
+    # Bytes a SegmentStream of [file_names] reads
+    total = 0
+    for position, name in enumerate(file_names):
+        size = file_size(name)
+        total += size if position == 0 else max(0, size - skip)
+    return total
+
+def remove(file_name):
+    try:
+        os.remove(file_name)
+    except OSError:
+        pass
+
+
+class RotatingLog:
+    """
+    [first_timestamp] reads the timestamp (seconds since 2000) of the first
+    record of a log file, None when it has none. Without it only the size
+    is checked and every segment is read.
+    """
+    def __init__(self, file_name, first_timestamp=None,
+                 max_size=default_rotation_params.MAX_SIZE,
+                 max_age_s=default_rotation_params.MAX_AGE_S,
+                 max_segments=default_rotation_params.MAX_SEGMENTS,
+                 archive=default_rotation_params.ARCHIVE,
+                 max_archives=default_rotation_params.MAX_ARCHIVES):
+        self.file_name = file_name
+        self.first_timestamp = first_timestamp
+        self.max_size = max_size
+        self.max_age_s = max_age_s
+        self.max_segments = max_segments
+        self.archive = archive
+        self.max_archives = max_archives
+        # first timestamp of the active file, read once
+        self.started = None
+
+    def needs_rotation(self, now=None):
+        size = file_size(self.file_name)
+        if size == 0:
+            self.started = None
+            return False
+        if size >= self.max_size:
+            return True
+        if now is None or self.max_age_s is None or self.first_timestamp is None:
+            return False
+        if self.started is None:
+            self.started = self.first_timestamp(self.file_name)
+        return self.started is not None and now - self.started >= self.max_age_s
+
+    def rotate(self):
+        numbers = segment_numbers(self.file_name)
+        number = numbers[-1] + 1 if numbers else 1
+        segment = segment_name(self.file_name, number)
+        print("Rotating ", self.file_name, " to ", segment)
+        try:
+            os.rename(self.file_name, segment)
+        except OSError as e:
+            print("Error rotating file: ", e)
+            return
+        try:
+            os.rename(self.file_name + INDEX_SUFFIX, segment + INDEX_SUFFIX)
+        except OSError:
+            pass
+        self.started = None
+        numbers.append(number)
+        self.retain(numbers)
+
+    def retain(self, numbers):
+        # Drops or archives the segments past max_segments
+        while len(numbers) > self.max_segments:
+            segment = segment_name(self.file_name, numbers.pop(0))
+            if self.archive and not self.compress(segment):
+                print("Keeping ", segment, " until it can be archived")
+                break
+            remove(segment)
+            remove(segment + INDEX_SUFFIX)
+        archives = segment_numbers(self.file_name, ARCHIVE_SUFFIX)
+        while len(archives) > self.max_archives:
+            remove(segment_name(self.file_name, archives.pop(0)) + ARCHIVE_SUFFIX)
+
+    def compress(self, segment):
+        # Writes [segment].z, returns True if it did
+        if deflate is None:
+            print("No deflate module, not archiving ", segment)
+            return False
+        buffer = bytearray(256)
+        try:
+            with open(segment, 'rb') as source:
+                with open(segment + ARCHIVE_SUFFIX, 'wb') as file:
+                    archive = deflate.DeflateIO(file, deflate.ZLIB)
+                    while True:
+                        count = source.readinto(buffer)
+                        if not count:
+                            break
+                        archive.write(memoryview(buffer)[:count])
+                    archive.close()
+        except Exception as e:
+            print("Error archiving file: ", e)
+            remove(segment + ARCHIVE_SUFFIX)
+            return False
+        return True
+
+    def check(self, now=None):
+        # Rotates the log if it is due, returns True if it did
+        if self.needs_rotation(now):
+            self.rotate()
+            return True
+        return False
+
+    def segments(self, since=None):
+        """
+        The files holding the log, oldest first and the active file last.
+        With [since] (seconds since 2000) the segments that only hold
+        records up to [since] are left out.
+        """
+        names = [segment_name(self.file_name, number) for number in segment_numbers(self.file_name)]
+        names.append(self.file_name)
+        if since is None or self.first_timestamp is None:
+            return names
+        # the newest segment that started before [since] is the first one needed
+        for position in range(len(names) - 1, -1, -1):
+            first = self.first_timestamp(names[position])
+            if first is not None and first <= since:
+                return names[position:]
+        return names
+
+
+class LogRotation:
+    """
+    The logs rotated by the firmware, checked every [check_period_ms]
+    """
+    _DEFAULT_LOG_ROTATION_INSTANCE = None
+
+    @classmethod
+    def get_default_log_rotation(cls):
+        if cls._DEFAULT_LOG_ROTATION_INSTANCE is None:
+            cls._DEFAULT_LOG_ROTATION_INSTANCE = LogRotation()
+        return cls._DEFAULT_LOG_ROTATION_INSTANCE
+
+    def __init__(self, check_period_ms=default_rotation_params.CHECK_PERIOD_MS):
+        self.check_period_ms = check_period_ms
+        self.logs = {}
+
+    def register(self, file_name, first_timestamp=None, **params):
+        log = RotatingLog(file_name, first_timestamp, **params)
+        self.logs[file_name] = log
+        return log
+
+    def segments(self, file_name, since=None):
+        # Files holding [file_name], for logs that were never registered too.
+        # What is waiting in the LogWriter is written first, so readers see all of it
+        LogWriter.get_default_log_writer().flush("read")
+        log = self.logs.get(segment_base(file_name), None)
+        if log is None:
+            log = RotatingLog(file_name)
+        return log.segments(since)
+
+    def check(self, now=None):
+        # a log is never renamed with records for it still waiting
+        LogWriter.get_default_log_writer().flush("rotation")
+        rotated = 0
+        for log in self.logs.values():
+            rotated += log.check(now)
+        return rotated
+
+    async def run(self, get_now):
+        # [get_now] returns the time in seconds since 2000, or None when unknown
+        while True:
+            self.check(get_now())
+            await asyncio.sleep_ms(self.check_period_ms)
+
+
+class SegmentStream:
+    """
+    Reads a list of files as one stream (see Utils.send_stream_task),
+    leaving out the first [skip] bytes of every file after the first (a
+    header repeated in every segment).
+    """
+    def __init__(self, file_names, skip=0):
+        self.file_names = file_names
+        self.skip = skip
+        self.position = 0
+        self.open_file(0)
+
+    def open_file(self, current):
+        self.current = current
+        self.file = None
+        while self.current < len(self.file_names):
+            try:
+                self.file = open(self.file_names[self.current], 'rb')
+            except OSError:
+                self.current += 1
+                continue
+            if self.current > 0 and self.skip:
+                self.file.seek(self.skip)
+            return
+
+    def readinto(self, buffer):
+        count = 0
+        view = memoryview(buffer)
+        while count < len(buffer) and self.file is not None:
+            read = self.file.readinto(view[count:])
+            if not read:
+                self.file.close()
+                self.open_file(self.current + 1)
+                continue
+            count += read
+        self.position += count
+        return count
+
+    def seek(self, position):
+        # Finds the file holding [position] from the file sizes
+        self.close()
+        start = 0
+        for current, name in enumerate(self.file_names):
+            skip = self.skip if current > 0 else 0
+            size = max(0, file_size(name) - skip)
+            if start + size > position or current == len(self.file_names) - 1:
+                self.open_file(current)
+                if self.file is not None:
+                    offset = min(position - start, size)
+                    self.file.seek(skip + offset)
+                    start += offset
+                break
+            start += size
+        self.position = start
+        return self.position
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,157 @@
+"""
+Buffers the appends to the logs in RAM and writes each file once per
+flush, instead of an open, write and close per record (each costing
+littlefs metadata writes).
+
+Buffers are flushed once [max_buffered] bytes are waiting, when the
+oldest one waited [flush_period_ms], at the end of a mission, before a
+reset and when memory runs low. Readers of a log flush first.
+
+With [buffered] False (sync mode) every append is written right away,
+nothing is lost on a power cut.
+"""
+import uasyncio as asyncio
+
+import time
+
+from gc_policy import GcPolicy
+
+class default_log_writer_params:
+    # buffered (True) or sync (False) writes
+    BUFFERED = True
+    # flush once this much is waiting (bytes)
+    MAX_BUFFERED = 2048
+    # or once the oldest append waited this long (ms)
+    FLUSH_PERIOD_MS = 60 * 1000
+    # how often the flush period is checked (ms)
+    CHECK_PERIOD_MS = 1000
+
+
+class LogWriter:
+    """
+    Besides appends, flushers (objects with a flush() method returning the
+    number of files written, e.g. Rollups) can keep their own changes in
+    RAM: they call changed() and are flushed with the buffers.
+    """
+    _DEFAULT_LOG_WRITER_INSTANCE = None
+
+    @classmethod
+    def get_default_log_writer(cls):
+        if cls._DEFAULT_LOG_WRITER_INSTANCE is None:
+            writer = LogWriter()
+            GcPolicy.get_default_gc_policy().add_low_memory_hook(lambda: writer.flush("memory"))
+            cls._DEFAULT_LOG_WRITER_INSTANCE = writer
+        return cls._DEFAULT_LOG_WRITER_INSTANCE
+
+    def __init__(self, buffered=default_log_writer_params.BUFFERED,
+                 max_buffered=default_log_writer_params.MAX_BUFFERED,
+                 flush_period_ms=default_log_writer_params.FLUSH_PERIOD_MS,
+                 check_period_ms=default_log_writer_params.CHECK_PERIOD_MS):
+        self.buffered = buffered
+        self.max_buffered = max_buffered
+        self.flush_period_ms = flush_period_ms
+        self.check_period_ms = check_period_ms
+
+        # file -> bytearray, [order] keeps the files in the order they were
+        # first appended to, so a log is written before its index
+        self.buffers = {}
+        self.order = []
+        self.buffered_bytes = 0
+        self.flushers = []
+        self.dirty = False
+        self.first_pending_ms = None
+
+        # counters
+        self.appends = 0
+        self.writes = 0
+        self.flushes = {}
+
+    def set_buffered(self, buffered):
+        # Durability switch, going to sync mode writes what is waiting
+        if not buffered:
+            self.flush("sync")
+        self.buffered = buffered
+
+    def add_flusher(self, flusher):
+        self.flushers.append(flusher)
+
+    def write(self, file_name, data):
+        try:
+            with open(file_name, 'ab') as file:
+                file.write(data)
+            self.writes += 1
+            return True
+        except Exception as e:
+            print("Error writing to file: ", e)
+            return False
+
+    def append(self, file_name, data):
+        # Appends [data] (bytes or str) to [file_name]
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.appends += 1
+        if not self.buffered:
+            return self.write(file_name, data)
+
+        buffer = self.buffers.get(file_name, None)
+        if buffer is None:
+            buffer = bytearray()
+            self.buffers[file_name] = buffer
+            self.order.append(file_name)
+        buffer.extend(data)
+        self.buffered_bytes += len(data)
+        self.note_pending()
+        if self.buffered_bytes >= self.max_buffered:
+            self.flush("size")
+        return True
+
+    def changed(self):
+        # A flusher has changes waiting
+        if not self.buffered:
+            for flusher in self.flushers:
+                self.writes += flusher.flush()
+            return
+        self.dirty = True
+        self.note_pending()
+
+    def note_pending(self):
+        if self.first_pending_ms is None:
+            self.first_pending_ms = time.ticks_ms()
+
+    def pending(self, file_name):
+        # Bytes of [file_name] waiting to be written
+        buffer = self.buffers.get(file_name, None)
+        return len(buffer) if buffer is not None else 0
+
+    def flush(self, reason="manual"):
+        # Writes everything waiting, one write per file
+        if self.first_pending_ms is None:
+            return
+        for file_name in self.order:
+            self.write(file_name, self.buffers[file_name])
+        self.buffers = {}
+        self.order = []
+        self.buffered_bytes = 0
+        if self.dirty:
+            for flusher in self.flushers:
+                self.writes += flusher.flush()
+            self.dirty = False
+        self.first_pending_ms = None
+        self.flushes[reason] = self.flushes.get(reason, 0) + 1
+
+    def stats(self):
+        return {
+            "buffered": self.buffered,
+            "appends": self.appends,
+            "writes": self.writes,
+            "waiting_bytes": self.buffered_bytes,
+            "flushes": self.flushes,
+        }
+
+    async def run(self):
+        # Flushes what waited too long
+        while True:
+            if (self.first_pending_ms is not None and
+                    time.ticks_diff(time.ticks_ms(), self.first_pending_ms) >= self.flush_period_ms):
+                self.flush("time")
+            await asyncio.sleep_ms(self.check_period_ms)
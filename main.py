@@ -2,7 +2,18 @@
 from controller import Controller
 
 import time
-from agbot_file_util import Utils
+from agbot_file_util import Utils, BytesStream
+from file_transfer import FileTransfer, default_transfer_params, TRANSFER_REQUEST, DEFAULT_MTU, RANGE_FROM_OFFSET, RANGE_AFTER_DATE
+from log_index import LogIndex
+from rollups import ROLLUP_FILE
+from record_log import RecordLog, RecordCsvStream, MOISTURE_LOG, WATER_LOG, timestamp_from_date_key
+from record_log import HEADER_SIZE as RECORD_LOG_HEADER_SIZE
+from log_rotation import SegmentStream, segments_size
+from log_writer import LogWriter
+from telemetry import PositionTelemetry
+from gc_policy import GcPolicy
+from scheduler import REPEATS, CATCH_UPS
+from command_dispatcher import CommandDispatcher, PRIORITY_STOP, PRIORITY_MISSION
 import sys
 
 sys.path.append("")
@@ -16,20 +27,8 @@ from bluetooth import UUID
 import machine
 
 import struct
-import gc
 
 #########################  HELPERS    #######################
-def async_garbage_collect(func):
-    """
-    Garbage Collect Before Running [func]
-    """
-    async def collect_before_run(*args, **kwargs):
-        gc.collect()
-        result = await func(*args, **kwargs)
-        return result
-    return collect_before_run
-
-
 def assertp(predicate, message="Something Bad Happened..."):
     """
     Check If Predicate Is True, Otherwise Raise An Exception
@@ -38,9 +37,6 @@ def assertp(predicate, message="Something Bad Happened..."):
     if not predicate:
         raise Exception(message)
 
-class Interrupt(Exception):
-    pass
-
 #########################  BLUETOOTH    #######################
 
 DEVICE_UUID = UUID(0x181A)
@@ -49,12 +45,16 @@ SENSOR_ACTUAL_LOCATION_UUID  = UUID("35f24b15-aa74-4cfb-a66a-a3252d67c264")
 SENSOR_DESIRED_LOCATION_UUID = UUID("5bfd1e3d-e9e6-4272-b3fe-0be36b98fb9c")
 JSON_CHARACTERISTIC_UUID   = UUID("16cbec17-9876-490c-bc71-85f24643a7d9")
 JSON_WRITE_CHARACTERISTIC_UUID   = UUID("dc5d258b-ae55-48d3-8911-7c733b658cfd")
+COMMAND_STATUS_CHARACTERISTIC_UUID = UUID("8a1c3f52-6d0e-4b7a-9e21-54c7d0b93f6e")
 
 ADVERTISING_APPEARANCE = const(1366)
 
 # How Frequently To Send Advertising Beacons.
 ADVERTISING_INTERVAL_MILLISECONDS = 100
 
+# The central connected to, set by peripheral_task
+active_connection = None
+
 device_info_service = aioble.Service(DEVICE_UUID)
 
 sensor_location_characteristic = aioble.Characteristic(
@@ -73,11 +73,31 @@ json_write_characteristic = aioble.Characteristic(
     device_info_service, JSON_WRITE_CHARACTERISTIC_UUID, write=True, capture=True
 )
 
+command_status_characteristic = aioble.Characteristic(
+    device_info_service, COMMAND_STATUS_CHARACTERISTIC_UUID, read=True, notify=True
+)
+
 aioble.register_services(device_info_service)
+aioble.config(mtu=default_transfer_params.PREFERRED_MTU)
+
+# file id -> (file on flash, name sent with it, file type)
+LOG_FILES = {
+    1: ("mission_history.csv", "mission_history", "CSV"),
+    8: (ROLLUP_FILE, "rollups", "BIN"),
+}
+
+# file id -> (record log, name sent with it, file type)
+# CSV ids send the log as the CSV it used to be, BIN ids send the records as stored
+RECORD_LOGS = {
+    2: (MOISTURE_LOG, "moisture_readings", "CSV"),
+    5: (WATER_LOG, "water_history", "CSV"),
+    6: (MOISTURE_LOG, "moisture_log", "BIN"),
+    7: (WATER_LOG, "water_log", "BIN"),
+}
 
 
 #########################  ACTIONS    #######################
-async def agbot_stop(controller):
+async def agbot_stop(controller, data=None):
     controller.agbot.stop()
 
 
@@ -89,30 +109,68 @@ async def agbot_move_to(controller, data):
     await controller.agbot.move_to(x, y)
 
 
-async def agbot_get_moisture_reading(controller):
+async def agbot_get_moisture_reading(controller, data=None):
     print("Probing...")
-    moisture_reading = await controller.agbot.read()
-    print("Moisture reading: ", moisture_reading)
+    moisture_reading, confidence = await controller.agbot.sense()
+    print("Moisture reading: ", moisture_reading, "confidence: ", confidence)
 
 
-async def agbot_go_home(controller):
+async def agbot_go_home(controller, data=None):
     await controller.agbot.home()
 
 
+async def agbot_pump(controller, data):
+    tenths_ml, = struct.unpack_from("<H", data, 2)
+    if tenths_ml == 0:
+        dispensed = await controller.agbot.prime()
+    else:
+        dispensed = await controller.agbot.water(tenths_ml / 10)
+    print("Pumped: ", dispensed, "ml")
+
+
 async def agbot_run_mission(controller, data):
     mission_id_bytes = data[2:4]
     mission_id, = struct.unpack("<H", mission_id_bytes)
-    print("Running mission: ", mission_id)
-    await controller.run_mission(mission_id=mission_id)
+    # Optional 5th byte picks the mission mode, otherwise the mission's own mode is used
+    mode = None
+    if len(data) > 4:
+        mode = data[4]
+    print("Running mission: ", mission_id, "mode: ", mode)
+    await controller.run_mission(mission_id=mission_id, mode=mode)
 
 
-async def agbot_recalibrate_gantry_size(controller):
+async def agbot_recalibrate_gantry_size(controller, data=None):
     print("Recalibrating gantry size")
     await controller.setup_xy_max(force=True)
     # move to 20, 20
     await controller.agbot.move_to(20, 20)
 
 
+async def agbot_change_mission_schedule(controller, data):
+    mission_id, hour, minute, repeat, every_hours, weekdays, catch_up = struct.unpack_from("<HBBBBBB", data, 2)
+    if repeat >= len(REPEATS) or catch_up >= len(CATCH_UPS):
+        print("Error: unknown mission schedule: ", repeat, catch_up)
+        return
+    print("Changing mission schedule: ", mission_id, hour, minute, REPEATS[repeat])
+    controller.memory.set_mission_schedule(mission_id, hour, minute, REPEATS[repeat],
+                                           every_hours, weekdays, CATCH_UPS[catch_up])
+
+
+async def agbot_calibrate_probe(controller, data):
+    step = data[2]
+    if step == 0:
+        controller.start_calibration()
+    elif step == 1:
+        percent, = struct.unpack_from("<H", data, 3)
+        await controller.measure_calibration_point(percent / 10)
+    elif step == 2:
+        controller.finish_calibration()
+    elif step == 3:
+        controller.reset_calibration()
+    else:
+        print("Unknown calibration step: ", step)
+
+
 async def agbot_delete_mission(controller, data):
     mission_id_bytes = data[2:4]
     mission_id, = struct.unpack("<H", mission_id_bytes)
@@ -138,266 +196,232 @@ async def agbot_modify_plants_in_mission(controller, data):
         controller.memory.remove_plant_from_mission(metadata[0], metadata[1])
 
 
-#########################  STATE    #########################
-previous_sensor_location_characteristic_value = b""
-current_sensor_location_characteristic_value = b""
-
-previous_sensor_desired_location_characteristic_value = b""
-current_sensor_desired_location_characteristic_value = b""
-
-previous_json_characteristic_value = b""
-current_json_characteristic_value = b""
-
-previous_json_write_characteristic_value = b""
-current_json_write_characteristic_value = b""
-
-
-#########################  HELPERS    #######################
-@async_garbage_collect
-async def wait_for_write(characteristic):
-    """
-    Waits For Write From On [characteristic]
-    When A Write Is Received, Updates The Current & Previous Characteristic Value
-
-    Example:
-    - sensor_location_characteristic is written to with value 1
-    -> previous_sensor_location_characteristic_value = b""
-    -> current_sensor_location_characteristic_value = b"1"
-    - sensor_location_characteristic is written to with value 2
-    -> previous_sensor_location_characteristic_value = b"1"
-    -> current_sensor_location_characteristic_value = b"2"
-    """
-    global previous_sensor_desired_location_characteristic_value
-    global current_sensor_desired_location_characteristic_value
-
-    global previous_sensor_location_characteristic_value
-    global current_sensor_location_characteristic_value
-
-    global previous_sensor_desired_location_characteristic_value
-    global current_sensor_desired_location_characteristic_value
-
-    global previous_json_characteristic_value
-    global current_json_characteristic_value
-
-    global previous_json_write_characteristic_value
-    global current_json_write_characteristic_value
-
-    _, value = await characteristic.written(timeout_ms=5000)
-
-    if characteristic.uuid == SENSOR_ACTUAL_LOCATION_UUID:
-        temp = current_sensor_location_characteristic_value
-        current_sensor_location_characteristic_value = value
-        previous_sensor_desired_location_characteristic_value = temp
-    elif characteristic.uuid == SENSOR_DESIRED_LOCATION_UUID:
-        temp = current_sensor_desired_location_characteristic_value
-        current_sensor_desired_location_characteristic_value = value
-        previous_sensor_desired_location_characteristic_value = temp
-    elif characteristic.uuid == JSON_CHARACTERISTIC_UUID:
-        temp = current_json_characteristic_value
-        current_json_characteristic_value = value
-        previous_json_characteristic_value = temp
-    elif characteristic.uuid == JSON_WRITE_CHARACTERISTIC_UUID:
-        temp = current_json_write_characteristic_value
-        current_json_write_characteristic_value = value
-        previous_json_write_characteristic_value = temp
-    else:
-        assertp(False, "Not A Known Characteristic")
+#########################  COMMANDS    #####################
+"""
+Action types (2 bytes uint16), first in every write on the desired location characteristic
+0 -> Stop
+1 -> Move To Absolute Position
+    2 Bytes For X uint16, 2 Bytes For Y uint16
+2 -> Probe At Current Position
+3 -> Move To Home Position
+4 -> Turn On Pump Of A Certain Amount
+    2 Bytes For Amount In 0.1 ml uint16, 0 primes the pump (purges its line)
+5 -> Run Mission By Id
+    2 Bytes For Mission Id uint16
+    Optional 1 Byte Mission Mode (0 per plant, 1 sense all then water)
+6 -> Re-calibrate Gantry Size
+7 -> Change Mission Schedule By Id
+    2 Bytes For Mission Id uint16, 1 Byte Hour, 1 Byte Minute,
+    1 Byte Repeat (0 daily, 1 every N hours, 2 on weekdays), 1 Byte N Hours,
+    1 Byte Weekdays (bit 0 monday ... bit 6 sunday), 1 Byte Catch Up (0 once, 1 none)
+8 -> Delete Mission By Id
+    2 Bytes For Mission Id uint16
+9 -> Delete Plant By Id
+    2 Bytes For Plant Id uint16
+10 -> Add Or Remove Plant In Mission
+    2 Bytes For Plant Id, 2 Bytes For Mission Id, 2 Bytes Add (1) Or Remove (0)
+11 -> Batch
+    1 Byte Number Of Commands, then each command as 1 Byte Length + its bytes
+12 -> Moisture Probe Calibration
+    1 Byte Step: 0 start, 1 probe the soil under the AgBot (then 2 Bytes Its Known
+    Volumetric Water Content in 0.1 % uint16), 2 store the curve, 3 back to uncalibrated
+
+Commands run one after the other in the order they were written, a stop
+cancels the running action and everything queued. Each command gets a
+sequence number (counting writes from boot, a batch counts once per
+command) and its progress is notified on the command status characteristic:
+Byte 0-1 -> Sequence Number uint16
+Byte 2-3 -> Action uint16
+Byte 4 -> State (0 queued, 1 started, 2 done, 3 cancelled, 4 failed, 5 rejected)
+Byte 5 -> Commands Still Queued
+"""
+ACTIONS = {
+    0: agbot_stop,
+    1: agbot_move_to,
+    2: agbot_get_moisture_reading,
+    3: agbot_go_home,
+    4: agbot_pump,
+    5: agbot_run_mission,
+    6: agbot_recalibrate_gantry_size,
+    7: agbot_change_mission_schedule,
+    8: agbot_delete_mission,
+    9: agbot_delete_plant,
+    10: agbot_modify_plants_in_mission,
+    12: agbot_calibrate_probe,
+}
+
+# actions not run at the default priority
+ACTION_PRIORITIES = {
+    0: PRIORITY_STOP,
+    5: PRIORITY_MISSION,
+}
+
+
+def notify_command_status(command, state, queued):
+    command_status_characteristic.write(struct.pack("<HHBB", command.seq, command.action, state, min(queued, 255)))
+    if command.connection is None:
+        return
+    try:
+        command_status_characteristic.notify(command.connection)
+    except Exception as e:
+        print("Command status notify failed: ", e)
 
 
 #########################  TASKS    #########################
-@async_garbage_collect
-async def poll_for_new_commands(characteristic, polling_interval_milliseconds=1000):
-    """
-    Polls For New Writes On [characteristic]
-    If A New Write Is Received And Is Different From The Value 
-    Corresponding To The Current Characteristic Value Raise An Interrupt
-    """
-    global previous_sensor_location_characteristic_value
-    global current_sensor_location_characteristic_value
-
-    global previous_sensor_location_characteristic_value
-    global current_sensor_desired_location_characteristic_value
-
-    global previous_json_characteristic_value
-    global current_json_characteristic_value
-
-    global previous_json_write_characteristic_value
-    global current_json_write_characteristic_value
-
+async def command_task(dispatcher):
+    # Hands every write on the desired location characteristic to [dispatcher]
     while True:
-        try:
-            if characteristic.uuid == SENSOR_ACTUAL_LOCATION_UUID:
-                await wait_for_write(characteristic)
-                if previous_sensor_location_characteristic_value != current_sensor_location_characteristic_value:
-                    raise Interrupt
-            elif characteristic.uuid == SENSOR_DESIRED_LOCATION_UUID:
-                await wait_for_write(characteristic)
-                if previous_sensor_desired_location_characteristic_value != current_sensor_desired_location_characteristic_value:
-                    raise Interrupt
-            elif characteristic.uuid == JSON_CHARACTERISTIC_UUID:
-                await wait_for_write(characteristic)
-                if previous_json_characteristic_value != current_json_characteristic_value:
-                    raise Interrupt
-            elif characteristic.uuid == JSON_WRITE_CHARACTERISTIC_UUID:
-                await wait_for_write(characteristic)
-                if previous_json_write_characteristic_value != current_json_write_characteristic_value:
-                    raise Interrupt
-            else:
-                assertp(False, f"Not A Known Characteristic {characteristic}")
-        except asyncio.TimeoutError:
-            continue
-        finally:
-            if characteristic.uuid == SENSOR_ACTUAL_LOCATION_UUID:
-                previous_sensor_location_characteristic_value = current_sensor_location_characteristic_value
-            elif characteristic.uuid == SENSOR_DESIRED_LOCATION_UUID:
-                previous_sensor_desired_location_characteristic_value = current_sensor_desired_location_characteristic_value
-            elif characteristic.uuid == JSON_CHARACTERISTIC_UUID:
-                previous_json_characteristic_value = current_json_characteristic_value
-            elif characteristic.uuid == JSON_WRITE_CHARACTERISTIC_UUID:
-                previous_json_write_characteristic_value = current_json_write_characteristic_value
-            else:
-                assertp(False, f"Not A Known Characteristic {characteristic}")
-            await asyncio.sleep_ms(polling_interval_milliseconds)
-
-
-# This is a task that waits for writes from the client
-# and updates the sensor location.
-@async_garbage_collect
-async def sensor_location_task(controller):
-    global current_sensor_desired_location_characteristic_value
-    if not current_sensor_desired_location_characteristic_value:
-        return
-    """
-    Action types (2 bytes uint16)
-    0 -> Stop
-    1 -> Move To Absolute Position
-    2 -> Probe At Current Position
-    3 -> Move To Home Position
-    4 -> Turn On Pump Of A Certain Amount
-    5 -> Run Mission By Id
-        2 Bytes For Mission Id uint16
-    6 -> Re-calibrate Gantry Size
-    7 -> Change Mission Details By Id
-    8 -> Delete Mission By Id
-        2 Bytes For Mission Id uint16
-    9 -> Delete Plant By Id
-        2 Bytes For Plant Id uint16
-    Grab The First Byte Of The Data To Determine The Action
-    """
+        connection, data = await sensor_desired_location_characteristic.written() # type: ignore
+        print("Received command: ", data)
+        dispatcher.submit(data, connection)
 
+
+async def sensor_task(controller, telemetry):
     """
-    <H -> Little Endian unsigned short
+    Writes the position to the sensor location characteristic and notifies
+    it to the connected client when [telemetry] says it is worth it
     """
-    action_bytes = current_sensor_desired_location_characteristic_value[:2]
-    print(f"Trying To Unpack {type(action_bytes)}")
-    action, = struct.unpack("<H", action_bytes)
-
-    print("Mission action:", action)
-    
-    if action == 0:
-        await agbot_stop(controller)
-    elif action == 1:
-        await agbot_move_to(controller, current_sensor_desired_location_characteristic_value)
-    elif action == 2:
-        await agbot_get_moisture_reading(controller)
-    elif action == 3:
-        await agbot_go_home(controller)
-    elif action == 5:
-        await agbot_run_mission(controller, current_sensor_desired_location_characteristic_value)
-    elif action == 6:
-        await agbot_recalibrate_gantry_size(controller)
-    elif action == 8:
-        await agbot_delete_mission(controller, current_sensor_desired_location_characteristic_value)
-    elif action == 9:
-        await agbot_delete_plant(controller, current_sensor_desired_location_characteristic_value)
-    elif action == 10:
-        await agbot_modify_plants_in_mission(controller, current_sensor_desired_location_characteristic_value)
-    else:
-        assertp(False, "Not A Known Action")
-        
-
-@async_garbage_collect
-async def sensor_location_task_action_loop(controller):
-    while True:
-        current_sensor_location_task = None
-        poll_for_new_commands_task = None
-        try:
-            current_sensor_location_task = asyncio.create_task(sensor_location_task(controller))
-            poll_for_new_commands_task = asyncio.create_task(poll_for_new_commands(sensor_desired_location_characteristic))
-            await asyncio.gather(current_sensor_location_task, poll_for_new_commands_task)
-        except Interrupt as e:
-            if current_sensor_location_task and not current_sensor_location_task.done():
-                current_sensor_location_task.cancel()
-            try:
-                await current_sensor_location_task
-            except asyncio.CancelledError:
-                print("Sensor location task cancelled.")
-            continue
-        except Exception as e:
-            print(e)
-
-
-@async_garbage_collect
-async def sensor_task(controller):
-    homed, x, y, z = 0, 0, 0, 0
-
     print("Sensor location task started")
 
     while True:
-        # temp_characteristic.write(struct.pack(">H", int(t)))
         if controller.agbot.xy.homed:
             x, y = controller.agbot.xy.get_position()
             homed = 1
             z = controller.agbot.z.get_position()
-            # print("X: ", x, "Y: ", y)
         else:
             homed = 0
             x, y = 0, 0
             z = 0
 
-        sensor_location_characteristic.write(struct.pack(">HHHH", int(homed), int(x), int(y), int(z)))
-        # print("sensor location data updated: ", homed, x, y, z)
-        await asyncio.sleep_ms(500)
-
-
-@async_garbage_collect
-async def notify_gatt_client(connection):
-   if connection is None: 
-       return
-   sensor_location_characteristic.notify(connection)
+        packet = telemetry.update(homed, x, y, z)
+        if packet is not None:
+            sensor_location_characteristic.write(packet)
+            if active_connection is not None:
+                try:
+                    sensor_location_characteristic.notify(active_connection)
+                except OSError:
+                    # TX buffers taken by a file transfer, the next change or heartbeat gets through
+                    pass
+        await asyncio.sleep_ms(telemetry.period_ms())
+
+
+async def send_packets(connection, packets):
+    # Notifies each packet of a file transfer, read lazily from [packets]
+    gc_policy = GcPolicy.get_default_gc_policy()
+    for packet in packets:
+        json_characteristic.write(packet)
+        json_characteristic.notify(connection)
+        gc_policy.idle()
+        await asyncio.sleep_ms(100)
+
+
+def log_transfer(controller, connection, file_id, window, range_kind, range_value):
+    # v2 transfer of a log, its segments read as one file (see log_rotation)
+    since = timestamp_from_date_key(range_value) if range_kind == RANGE_AFTER_DATE else None
+    offset = range_value if range_kind == RANGE_FROM_OFFSET else 0
+
+    if file_id in LOG_FILES:
+        file_name, transfer_name, file_type = LOG_FILES[file_id]
+        segments = controller.logs.segments(file_name, since)
+        length = segments_size(segments)
+        if since is not None:
+            # files without a date index (the rollup ring) are sent whole
+            index = LogIndex.get_log_index(segments[0])
+            if index is not None:
+                offset = index.offset_after(range_value)
+        offset = min(offset, length)
+        return FileTransfer(json_characteristic, json_write_characteristic, connection,
+                            lambda: SegmentStream(segments), file_type, transfer_name,
+                            offset=offset, length=length - offset, window=window)
+
+    log_name, transfer_name, file_type = RECORD_LOGS[file_id]
+    logs = [RecordLog(name) for name in controller.logs.segments(log_name, since)]
+    start = logs[0].find_after(since) if since is not None else 0
+    if file_type == "BIN":
+        # the header is only sent once, at the start
+        segments = [log.file_name for log in logs]
+        length = segments_size(segments, RECORD_LOG_HEADER_SIZE)
+        if start:
+            offset = logs[0].offset_of(start)
+        offset = min(offset, length)
+        return FileTransfer(json_characteristic, json_write_characteristic, connection,
+                            lambda: SegmentStream(segments, RECORD_LOG_HEADER_SIZE), file_type, transfer_name,
+                            offset=offset, length=length - offset, window=window)
+    # the CSV is generated as it is sent, its length is found by the checksum pass
+    return FileTransfer(json_characteristic, json_write_characteristic, connection,
+                        lambda: RecordCsvStream(logs, start), file_type, transfer_name,
+                        offset=offset, window=window)
+
+
+async def send_file_v2(controller, connection, data):
+    """
+    Protocol v2 transfer, see file_transfer
+    Byte 1 -> File Id (0 farm data, one of LOG_FILES or RECORD_LOGS)
+    Byte 2 -> Window (optional)
+    Byte 3 -> Range Kind (optional)
+    Byte 4-7 -> Range Value
+    Returns a write that interrupted the transfer, or None
+    """
+    file_id = data[1]
+    window = data[2] if len(data) > 2 else default_transfer_params.WINDOW
+    range_kind, range_value = 0, 0
+    if len(data) >= 8:
+        range_kind = data[3]
+        range_value, = struct.unpack_from("<I", data, 4)
+
+    if not connection.mtu or connection.mtu <= DEFAULT_MTU:
+        try:
+            await connection.exchange_mtu(default_transfer_params.PREFERRED_MTU)
+        except Exception as e:
+            print("MTU exchange failed: ", e)
+
+    if file_id == 0:
+        offset = range_value if range_kind == RANGE_FROM_OFFSET else 0
+        snapshot = controller.memory.snapshot()
+        transfer = FileTransfer(json_characteristic, json_write_characteristic, connection,
+                                lambda: BytesStream(snapshot), "JSON",
+                                offset=offset, window=window)
+    elif file_id in LOG_FILES or file_id in RECORD_LOGS:
+        transfer = log_transfer(controller, connection, file_id, window, range_kind, range_value)
+    else:
+        print("Unknown file id: ", file_id)
+        return None
+    return await transfer.run()
 
 
-@async_garbage_collect
 async def file_write_task(controller):
+    pending = None
     while True:
-        connection, data = await json_write_characteristic.written() # type: ignore
+        if pending is None:
+            connection, data = await json_write_characteristic.written() # type: ignore
+        else:
+            # a write that interrupted a transfer
+            connection, data = pending
+            pending = None
         print("Received json data: ", data)
         if data is not None:
             file_id_bytes = data[:1]
             file_id, = list(map(int, struct.unpack("<B", file_id_bytes)))
             
             if file_id == 0:
-                for packet in Utils.send_file_task(controller.memory.data, "JSON"):
-                    json_characteristic.write(packet)
-                    json_characteristic.notify(connection)
-                    await asyncio.sleep_ms(100)
-            elif file_id == 1:
-                pass
-                # mission data
-                data = Utils.get_file_data("mission_history.csv")
-                if data is not None:
-                    for packet in Utils.send_file_task(data, "CSV", "mission_history"):
-                        json_characteristic.write(packet)
-                        json_characteristic.notify(connection)
-                        await asyncio.sleep_ms(100)
-            elif file_id == 2:
-                # Moisture data
-                data = Utils.get_file_data("moisture_readings.csv")
-                if data is not None:
-                    for packet in Utils.send_file_task(data, "CSV", "moisture_readings"):
-                        json_characteristic.write(packet)
-                        json_characteristic.notify(connection)
-                        await asyncio.sleep_ms(100)
+                await send_packets(connection, Utils.send_bytes_stream_task(controller.memory.snapshot(), "JSON"))
+            elif file_id in LOG_FILES:
+                # mission history or plant rollups
+                file_name, transfer_name, file_type = LOG_FILES[file_id]
+                segments = controller.logs.segments(file_name)
+                await send_packets(connection, Utils.send_stream_task(lambda: SegmentStream(segments), file_type,
+                                                                      transfer_name, segments_size(segments)))
+            elif file_id in RECORD_LOGS:
+                # moisture or water log data
+                log_name, transfer_name, file_type = RECORD_LOGS[file_id]
+                segments = controller.logs.segments(log_name)
+                if file_type == "BIN":
+                    packets = Utils.send_stream_task(lambda: SegmentStream(segments, RECORD_LOG_HEADER_SIZE), file_type,
+                                                     transfer_name, segments_size(segments, RECORD_LOG_HEADER_SIZE))
+                else:
+                    logs = [RecordLog(name) for name in segments]
+                    packets = Utils.send_stream_task(lambda: RecordCsvStream(logs), file_type, transfer_name)
+                await send_packets(connection, packets)
             elif file_id == 3:
                 """
                 New plant data
@@ -431,10 +455,7 @@ async def file_write_task(controller):
                 # after adding resend the farm data
                 file_id_bytes = data[:1]
                 file_id, = list(map(int, struct.unpack("<B", file_id_bytes)))
-                for packet in Utils.send_file_task(controller.memory.data, "JSON"):
-                    json_characteristic.write(packet)
-                    json_characteristic.notify(connection)
-                    await asyncio.sleep_ms(100)
+                await send_packets(connection, Utils.send_bytes_stream_task(controller.memory.snapshot(), "JSON"))
                     
             elif file_id == 4:
                 """
@@ -459,20 +480,12 @@ async def file_write_task(controller):
                 # after adding resend the farm data
                 file_id_bytes = data[:1]
                 file_id, = list(map(int, struct.unpack("<B", file_id_bytes)))
-                for packet in Utils.send_file_task(controller.memory.data, "JSON"):
-                    json_characteristic.write(packet)
-                    json_characteristic.notify(connection)
-                    await asyncio.sleep_ms(100)
+                await send_packets(connection, Utils.send_bytes_stream_task(controller.memory.snapshot(), "JSON"))
             
-            elif file_id == 5:
-                # water log data
-                data = Utils.get_file_data("water_log.csv")
-                print("Water log data: ", data)
-                if data is not None:
-                    for packet in Utils.send_file_task(data, "CSV", "water_history"):
-                        json_characteristic.write(packet)
-                        json_characteristic.notify(connection)
-                        await asyncio.sleep_ms(100)
+            elif file_id == TRANSFER_REQUEST:
+                write = await send_file_v2(controller, connection, data)
+                if write is not None:
+                    pending = (connection, write)
 
             elif file_id == 99:
                 """
@@ -491,13 +504,14 @@ async def file_write_task(controller):
                 print("Time: ", time)
                 try:
                     controller.clock.set_time_piece_by_piece(seconds, minutes, hours, weekdays, months, days, years)
+                    # missions are due at other times now
+                    controller.scheduler.wake()
                 except Exception as e:
                     print("Error: %s" % e)
 
         await asyncio.sleep_ms(100)       
 
 
-@async_garbage_collect
 async def peripheral_task():
    while True:
       
@@ -512,18 +526,30 @@ async def peripheral_task():
       
          print("Connection from", connection.device)
 
-         while connection.is_connected():
-            await notify_gatt_client(connection)
-            await asyncio.sleep(1)
+         global active_connection
+         active_connection = connection
+         try:
+            await connection.disconnected(timeout_ms=None)
+         finally:
+            active_connection = None
    
 
 async def tasks(controller):
-    sensor_location_async_task = asyncio.create_task(sensor_location_task_action_loop(controller))
+    dispatcher = CommandDispatcher(controller, ACTIONS, ACTION_PRIORITIES,
+                                   on_preempt=controller.agbot.stop,
+                                   on_status=notify_command_status)
+    command_async_task = asyncio.create_task(command_task(dispatcher))
+    dispatcher_async_task = asyncio.create_task(dispatcher.run())
     file_write_async_task = asyncio.create_task(file_write_task(controller))
-    sensor_async_task = asyncio.create_task(sensor_task(controller))
+    sensor_async_task = asyncio.create_task(sensor_task(controller, PositionTelemetry()))
     peripheral_async_task = asyncio.create_task(peripheral_task())
     controller_async_task = asyncio.create_task(controller.run())  
-    await asyncio.gather(sensor_location_async_task, file_write_async_task, sensor_async_task, peripheral_async_task, controller_async_task) # type: ignore
+    compactor_async_task = asyncio.create_task(controller.memory.compactor())
+    gc_async_task = asyncio.create_task(GcPolicy.get_default_gc_policy().run())
+    rotation_async_task = asyncio.create_task(controller.logs.run(controller.now_timestamp))
+    writer_async_task = asyncio.create_task(controller.writer.run())
+    clock_async_task = asyncio.create_task(controller.clock.run())
+    await asyncio.gather(command_async_task, dispatcher_async_task, file_write_async_task, sensor_async_task, peripheral_async_task, controller_async_task, compactor_async_task, gc_async_task, rotation_async_task, writer_async_task, clock_async_task) # type: ignore
 
 
 def main():
@@ -533,10 +559,13 @@ def main():
     except KeyboardInterrupt:
         print("Keyboard interrupt")
         controller.agbot.stop()
+        LogWriter.get_default_log_writer().flush("stop")
     except Exception as e:
         print("Error: ", e)
         controller.agbot.stop()
         Utils.append_error_to_log(str(e))
+        # nothing buffered may be lost to the reset
+        LogWriter.get_default_log_writer().flush("reset")
         machine.reset()
         
 # Run the main function
@@ -1,15 +1,40 @@
 from machine import Pin, ADC
 import time
+import math
+
+import uasyncio as asyncio
+
+from calibration import Calibration, RAW_MAX
 
 class default_moisture_sensor:
     PIN = 27
 
+    ## Acquisition (acquire)
+    # Wait after the probe goes in before sampling (ms)
+    SETTLE_MS = 1000
+    # Time between samples (ms)
+    SAMPLE_PERIOD_MS = 20
+    # Most samples taken
+    MAX_SAMPLES = 40
+    # Samples the value is estimated from, the latest ones
+    WINDOW = 10
+    # Done once the standard error of the value is below this (%)
+    MAX_STDERR = 0.5
+    # Samples further than this many median absolute deviations from the median are outliers
+    OUTLIER_MADS = 3.0
+
 class MoistureSensor:
     @classmethod
     def get_default_moisture_sensor(cls):
         return MoistureSensor(default_moisture_sensor.PIN)
     
-    def __init__(self, moisturePin:int = default_moisture_sensor.PIN):
+    def __init__(self, moisturePin:int = default_moisture_sensor.PIN,
+                 settle_ms=default_moisture_sensor.SETTLE_MS,
+                 sample_period_ms=default_moisture_sensor.SAMPLE_PERIOD_MS,
+                 max_samples=default_moisture_sensor.MAX_SAMPLES,
+                 window=default_moisture_sensor.WINDOW,
+                 max_stderr=default_moisture_sensor.MAX_STDERR,
+                 outlier_mads=default_moisture_sensor.OUTLIER_MADS):
         """
         Implements for a moisture sensor using the built in 12-bit ADC.
         Reads from analog in and converts to a int from 0 (white) to 100 (black)
@@ -23,8 +48,19 @@ class MoistureSensor:
 
         self.MAX_ADC_VALUE: int = 65536
 
+        self.settle_ms = settle_ms
+        self.sample_period_ms = sample_period_ms
+        self.max_samples = max_samples
+        self.window = window
+        self.max_stderr = max_stderr
+        self.outlier_mads = outlier_mads
+        # raw to moisture %, set_calibration for a calibrated probe
+        self.calibration = Calibration()
+        # samples taken by the last acquire
+        self.last_samples = 0
+
     def _get_value(self, sensor: ADC) -> float:
-        return int((sensor.read_u16() / self.MAX_ADC_VALUE) * 100)
+        return int(self.calibration.percent(sensor.read_u16()))
 
     def read(self) -> int:
         """
@@ -33,6 +69,80 @@ class MoistureSensor:
         : rtype: int
         """
         return self._get_value(self._sensor)
+
+    def set_calibration(self, calibration):
+        self.calibration = calibration
+
+    def read_percent(self) -> float:
+        # One sample through the calibration curve, not truncated
+        return self.calibration.percent(self._sensor.read_u16())
+
+    def read_linear(self) -> float:
+        # One sample as % of the ADC range, what a calibration curve maps from
+        return (self._sensor.read_u16() / RAW_MAX) * 100
+
+    def estimate(self, samples):
+        """
+        Robust mean of [samples]: outliers (by median absolute deviation)
+        are left out. Returns (value, standard error, inliers)
+        """
+        ordered = sorted(samples)
+        count = len(ordered)
+        median = (ordered[(count - 1) // 2] + ordered[count // 2]) / 2
+        deviations = sorted([abs(sample - median) for sample in ordered])
+        mad = (deviations[(count - 1) // 2] + deviations[count // 2]) / 2
+        # one 16 bit ADC step, so identical samples are not all outliers
+        limit = self.outlier_mads * mad + 100 / self.MAX_ADC_VALUE
+        inliers = [sample for sample in ordered if abs(sample - median) <= limit]
+
+        total = 0.0
+        for sample in inliers:
+            total += sample
+        mean = total / len(inliers)
+        if len(inliers) < 2:
+            return mean, 0.0, len(inliers)
+        spread = 0.0
+        for sample in inliers:
+            spread += (sample - mean) ** 2
+        stderr = math.sqrt(spread / (len(inliers) - 1) / len(inliers))
+        return mean, stderr, len(inliers)
+
+    async def acquire(self, read=None):
+        """
+        Oversampled reading with the probe in the soil: waits [settle_ms],
+        then samples every [sample_period_ms] until the latest [window]
+        samples agree (standard error below [max_stderr]) and agree with
+        the [window] before them, or [max_samples] were taken.
+        Sleeps between samples so other tasks keep running. Samples come
+        from read_percent, or [read] (read_linear when calibrating).
+        Returns (moisture %, confidence from 0 to 1)
+        """
+        if read is None:
+            read = self.read_percent
+        await asyncio.sleep_ms(self.settle_ms)
+        # the latest 2 windows of samples
+        samples = []
+        value, stderr, inliers = 0.0, 0.0, 0
+        confidence = 0.0
+        for count in range(1, self.max_samples + 1):
+            samples.append(read())
+            if len(samples) > 2 * self.window:
+                samples.pop(0)
+            if len(samples) == 2 * self.window:
+                window = samples[self.window:]
+                value, stderr, inliers = self.estimate(window)
+                # a probe still settling reads higher or lower from one window to the next
+                previous, _, _ = self.estimate(samples[:self.window])
+                # the two window means differ by some noise too, sqrt(2) * stderr on average
+                error = max(stderr, abs(value - previous) / 2)
+                confidence = inliers / self.window * min(1.0, self.max_stderr / error if error else 1.0)
+                if error <= self.max_stderr:
+                    break
+            await asyncio.sleep_ms(self.sample_period_ms)
+        if len(samples) < 2 * self.window:
+            value, stderr, inliers = self.estimate(samples[-self.window:])
+        self.last_samples = count
+        return value, round(confidence, 2)
     
 if __name__ == "__main__":
     ms = MoistureSensor.get_default_moisture_sensor()  
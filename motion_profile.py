@@ -0,0 +1,98 @@
+import math
+
+## Profile shapes
+# Constant acceleration ramps
+TRAPEZOIDAL = 0
+# Cosine shaped ramps, the acceleration (and so the jerk) starts and ends at zero
+S_CURVE = 1
+
+class MotionProfile:
+    """
+    Velocity profile for a single axis move.
+
+    The move accelerates to a peak velocity, cruises, then decelerates back
+    to zero, without going over the given max velocity and acceleration.
+    Short moves never reach max velocity and become a triangle.
+
+    An S_CURVE ramp covers the same distance as a linear ramp of the same
+    length but peaks at pi/2 its mean acceleration, so it is planned with
+    2/pi of the max acceleration.
+    """
+    def __init__(self, distance: float, max_velocity: float, max_acceleration: float,
+                 shape: int = TRAPEZOIDAL):
+        """
+        :param distance: signed length of the move (mm)
+        :param max_velocity: max velocity (mm/s)
+        :param max_acceleration: max acceleration (mm/s^2)
+        :param shape: TRAPEZOIDAL or S_CURVE
+        """
+        self.distance = distance
+        self.direction = math.copysign(1, distance)
+        self.shape = shape
+        if shape == S_CURVE:
+            self.acceleration = max_acceleration * 2 / math.pi
+        else:
+            self.acceleration = max_acceleration
+
+        length = math.fabs(distance)
+        t_ramp = max_velocity / self.acceleration
+        if self.acceleration * t_ramp * t_ramp >= length:
+            # Triangle, the move ends before max velocity is reached
+            t_ramp = math.sqrt(length / self.acceleration)
+            self.t_cruise = 0
+        else:
+            self.t_cruise = (length - self.acceleration * t_ramp * t_ramp) / max_velocity
+        self.t_ramp = t_ramp
+        self.peak_velocity = self.acceleration * t_ramp
+        self.duration = 2 * self.t_ramp + self.t_cruise
+
+    def stretch(self, duration: float):
+        """
+        Lowers the peak velocity so the move takes [duration] seconds.
+        Used to make both belts of a move finish at the same time.
+        """
+        if duration <= self.duration:
+            return
+        length = math.fabs(self.distance)
+        a = self.acceleration
+        # length = v * (duration - v / a), solved for the slower root
+        discriminant = max(0, (a * duration) ** 2 - 4 * a * length)
+        self.peak_velocity = (a * duration - math.sqrt(discriminant)) / 2
+        self.t_ramp = self.peak_velocity / a
+        self.t_cruise = duration - 2 * self.t_ramp
+        self.duration = duration
+
+    def _ramp(self, t):
+        # Position and velocity [t] seconds into the acceleration ramp
+        v_peak = self.peak_velocity
+        if self.shape == S_CURVE:
+            phase = math.pi * t / self.t_ramp
+            velocity = v_peak * (1 - math.cos(phase)) / 2
+            position = v_peak / 2 * (t - self.t_ramp / math.pi * math.sin(phase))
+        else:
+            velocity = v_peak * t / self.t_ramp
+            position = v_peak * t * t / (2 * self.t_ramp)
+        return position, velocity
+
+    def sample(self, t: float):
+        """
+        :param t: time since the start of the move (s)
+        :return: (position, velocity) the axis should be at, signed like the distance
+        :rtype: (float, float)
+        """
+        if t <= 0 or self.duration == 0:
+            return 0, 0
+        if t >= self.duration:
+            return self.distance, 0
+
+        ramp_length = self.peak_velocity * self.t_ramp / 2
+        if t < self.t_ramp:
+            position, velocity = self._ramp(t)
+        elif t < self.t_ramp + self.t_cruise:
+            position = ramp_length + self.peak_velocity * (t - self.t_ramp)
+            velocity = self.peak_velocity
+        else:
+            position, velocity = self._ramp(self.duration - t)
+            position = math.fabs(self.distance) - position
+
+        return position * self.direction, velocity * self.direction
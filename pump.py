@@ -6,6 +6,8 @@ import math
 
 import uasyncio as asyncio
 
+from soft_clock import SoftClock
+
 class default_pump:
     # Default motor for the pump
     MOTOR = EncodedMotor.get_default_encoded_motor(3)
@@ -20,6 +22,31 @@ class default_pump:
     # Negative: -1
     DISPENSE_DIRECTION = 1
 
+    ## Closed loop dispensing (dispense)
+    # Flow held with EncodedMotor.set_speed (ml/s), the pump does 1 ml/s at full effort
+    FLOW_ML_PER_S = 0.8
+    # Slowest flow, near the target volume (ml/s)
+    MIN_FLOW_ML_PER_S = 0.25
+    # The flow ramps down over the last RAMP_ML
+    RAMP_ML = 0.5
+    # Stop once this close to the target volume (ml)
+    TOLERANCE_ML = 0.01
+    # Flow changes smaller than this share of the current flow wait, each change restarts the speed PID
+    FLOW_STEP = 0.2
+    # Speed PID of the pump motor, on the error in encoder counts per 20 ms. The
+    # EncodedMotor default takes seconds to reach a flow, the pump only runs for a few
+    SPEED_KP = 0.03
+    SPEED_KI = 0.4
+    # How often the volume is checked (ms), the speed PID runs every 20 ms
+    CHECK_PERIOD_MS = 20
+    # Give up when less than STALL_ML was pumped in STALL_MS (clogged or jammed)
+    STALL_MS = 2000
+    STALL_ML = 0.05
+    # Wait for the pump to stop before measuring what it dispensed (ms)
+    STOP_SETTLE_MS = 200
+    # Prime again when the pump sat idle this long, the line drains back (s)
+    PRIME_AFTER_S = 30 * 60
+
 def bound_effort(value, max_effort=1.0):
     return max(0, min(max_effort, value))
 
@@ -30,17 +57,36 @@ class Pump(EncodedMotor):
         turns_to_ml = default_pump.TURNS_TO_ML
         purge_ml = default_pump.PURGE_ML
         dispense_direction = default_pump.DISPENSE_DIRECTION
-        return Pump(motor, turns_to_ml, purge_ml, dispense_direction)
+        return Pump(motor, turns_to_ml, purge_ml, dispense_direction,
+                    clock=SoftClock.get_default_soft_clock())
     
     def stop(self):
+        # set_speed() also turns off speed control, which would set the effort again
+        self.motor_pump.set_speed()
         self.motor_pump.set_effort(0)
 
     def __init__(self, 
-            motor_pump, turns_to_ml, purge_ml: float, dispense_direction: int):
+            motor_pump, turns_to_ml, purge_ml: float, dispense_direction: int,
+            flow_ml_per_s=default_pump.FLOW_ML_PER_S,
+            min_flow_ml_per_s=default_pump.MIN_FLOW_ML_PER_S,
+            ramp_ml=default_pump.RAMP_ML,
+            tolerance_ml=default_pump.TOLERANCE_ML,
+            clock=None):
         self.motor_pump = motor_pump
         self.turns_to_ml = turns_to_ml
         self.purge_ml = purge_ml
         self.dispense_direction = dispense_direction
+        self.flow_ml_per_s = flow_ml_per_s
+        self.min_flow_ml_per_s = min_flow_ml_per_s
+        self.ramp_ml = ramp_ml
+        self.tolerance_ml = tolerance_ml
+        # the idle time is kept on [clock] (SoftClock), ticks_ms wraps within days
+        self.clock = clock
+        # seconds since 2000 at the end of the last dispense, None before the first one
+        self.last_dispensed = None
+        # the integral alone can reach full effort, no more (a stall winds it up)
+        self.motor_pump.set_speed_controller(PID(kp=default_pump.SPEED_KP, ki=default_pump.SPEED_KI,
+                                                 max_integral=1 / default_pump.SPEED_KI))
 
         self.stop()
 
@@ -52,9 +98,72 @@ class Pump(EncodedMotor):
 
         self.motor_pump.set_effort(0)
         
+    def dispensed_ml(self, start_position):
+        return abs(self.motor_pump.get_position() - start_position) / self.turns_to_ml
+
+    def set_flow(self, ml_per_s):
+        self.motor_pump.set_speed(self.dispense_direction * ml_per_s * self.turns_to_ml * 60)
+
+    async def dispense(self, ml: float):
+        """
+        Pumps [ml] holding the flow with the motor's speed control, slowing
+        down over the last [ramp_ml] and stopping within [tolerance_ml].
+        Returns the ml dispensed, as measured by the encoder
+        """
+        start_position = self.motor_pump.get_position()
+        flow = 0
+        progress_ml = 0
+        progress_ms = time.ticks_ms()
+        try:
+            while True:
+                dispensed = self.dispensed_ml(start_position)
+                remaining = ml - dispensed
+                if remaining <= self.tolerance_ml:
+                    break
+
+                target = self.flow_ml_per_s
+                if remaining < self.ramp_ml:
+                    target = max(self.min_flow_ml_per_s, target * remaining / self.ramp_ml)
+                if abs(target - flow) > flow * default_pump.FLOW_STEP:
+                    flow = target
+                    self.set_flow(flow)
+
+                if dispensed - progress_ml >= default_pump.STALL_ML:
+                    progress_ml = dispensed
+                    progress_ms = time.ticks_ms()
+                elif time.ticks_diff(time.ticks_ms(), progress_ms) >= default_pump.STALL_MS:
+                    print("Error: pump stalled after ", dispensed, "ml of ", ml, "ml")
+                    break
+                await asyncio.sleep_ms(default_pump.CHECK_PERIOD_MS)
+        finally:
+            self.stop()
+        await asyncio.sleep_ms(default_pump.STOP_SETTLE_MS)
+        self.last_dispensed = self.now()
+        return self.dispensed_ml(start_position)
+
+    def now(self):
+        return self.clock.timestamp() if self.clock is not None else None
+
+    def needs_prime(self):
+        # Whether the line may hold air: never pumped, idle past PRIME_AFTER_S,
+        # or the idle time is not known (no time, or the clock went back)
+        if self.purge_ml <= 0:
+            return False
+        now = self.now()
+        if self.last_dispensed is None or now is None:
+            return True
+        return not 0 <= now - self.last_dispensed < default_pump.PRIME_AFTER_S
+
+    async def prime(self, ml=None):
+        # Purges [ml] (purge_ml by default) to fill the line, returns the ml pumped
+        if ml is None:
+            ml = self.purge_ml
+        print("Priming pump: ", ml, "ml")
+        return await self.dispense(ml)
+
     async def water(self, ml: float):
-        turns = ml * self.turns_to_ml
-        await self.turn(turns)
+        # Returns the ml dispensed
+        return await self.dispense(ml)
 
 if __name__ == "__main__":
     p = Pump.get_default_pump()
@@ -0,0 +1,358 @@
+"""
+Binary logs of moisture readings and waterings.
+
+Every record has the same size, so a log can be read from any record
+without parsing what comes before it, and records after a date are found
+with a binary search. A record is 15 bytes where a CSV line was 20 to 30,
+about half the flash.
+
+Timestamps only go up while the clock does. Where it was set back a new
+run of records starts, find_after searches the runs one after the other.
+
+Header, 8 bytes:
+- Magic b"AGRL" - 4 bytes
+- Version - 1 byte
+- Record size - 1 byte
+- Reserved - 2 bytes
+
+Record, 15 bytes little endian ("<IHHHHBH"):
+- Timestamp, seconds since 2000-01-01 00:00 - 4 bytes
+- Plant id (0xFFFF when not known) - 2 bytes
+- X, Y (mm) - 2 bytes each
+- Value, moisture % or tenths of a ml of water (WATER_SCALE) - 2 bytes
+- Kind (KIND_MOISTURE, KIND_WATER, KIND_PURGE) - 1 byte
+- Version of the probe calibration curve the moisture was read with
+  (0 the uncalibrated linear one, see calibration) - 2 bytes
+
+Purges are the water the pump primes its line with before watering,
+kept in the water log apart from the waterings: no plant, at the purge
+spot. The CSV never had them and leaves them out.
+
+Older logs had a 1 byte value in whole % or ml: version 1 with 12 byte
+records without the curve version, version 2 with 14 byte records.
+upgrade() rewrites them.
+"""
+import os
+import struct
+
+from log_writer import LogWriter
+
+MOISTURE_LOG = "moisture_log.bin"
+WATER_LOG = "water_log.bin"
+
+MAGIC = b"AGRL"
+VERSION = 3
+HEADER_FORMAT = "<4sBBH"
+HEADER_SIZE = 8
+RECORD_FORMAT = "<IHHHHBH"
+RECORD_SIZE = 15
+
+# version -> (record format, record size) of the logs upgrade() rewrites
+OLD_RECORDS = {
+    1: ("<IHHHBB", 12),
+    2: ("<IHHHBBH", 14),
+}
+
+KIND_MOISTURE = 0
+KIND_WATER = 1
+KIND_PURGE = 2
+
+# water is kept in tenths of a ml
+WATER_SCALE = 10
+
+UNKNOWN_PLANT = 0xFFFF
+
+def days_from_civil(year, month, day):
+    # Days since 2000-01-01
+    if month <= 2:
+        year -= 1
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 730425
+
+def civil_from_days(days):
+    # (year, month, day) of [days] since 2000-01-01
+    days += 730425
+    era = days // 146097
+    day_of_era = days - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 - day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    month_index = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * month_index + 2) // 5 + 1
+    month = month_index + (3 if month_index < 10 else -9)
+    year = year_of_era + era * 400 + (1 if month <= 2 else 0)
+    return year, month, day
+
+def timestamp(year, month, day, hour=0, minute=0, second=0):
+    # Seconds since 2000-01-01, [year] in full (2024)
+    return days_from_civil(int(year), int(month), int(day)) * 86400 + int(hour) * 3600 + int(minute) * 60 + int(second)
+
+def date_from_timestamp(seconds):
+    # (year, month, day, hour, minute, second)
+    days, seconds = divmod(seconds, 86400)
+    year, month, day = civil_from_days(days)
+    return year, month, day, seconds // 3600, (seconds // 60) % 60, seconds % 60
+
+def timestamp_from_reading_name(name):
+    # Timestamp of a Utils.reading_name_from_time string (month,day,year-2000,hour,minute)
+    month, day, year, hour, minute = name.split(",")[:5]
+    return timestamp(2000 + int(year), month, day, hour, minute)
+
+def timestamp_from_date_key(key):
+    # Timestamp of a log_index.date_key
+    return timestamp(2000 + (key >> 20), (key >> 16) & 0xF, (key >> 11) & 0x1F, (key >> 6) & 0x1F, key & 0x3F)
+
+def clamp(value, largest):
+    return min(max(int(round(value)), 0), largest)
+
+def pre_zero(value):
+    # Hour and minute were logged with a "0" in front below 10, see Clock.pre_zero
+    if value < 10:
+        return "0" + str(value)
+    return str(value)
+
+def value_text(record):
+    # The value of [record] as the CSV had it, ml of water with a decimal only when not whole
+    value = record[4]
+    if record[5] == KIND_MOISTURE:
+        return str(value)
+    if value % WATER_SCALE:
+        return str(value // WATER_SCALE) + "." + str(value % WATER_SCALE)
+    return str(value // WATER_SCALE)
+
+def csv_line(record):
+    # The CSV line the log used to have for [record]: month,day,year-2000,hour,minute,x,y,value
+    year, month, day, hour, minute, _ = date_from_timestamp(record[0])
+    return (str(month) + "," + str(day) + "," + str(year - 2000) + "," + pre_zero(hour) + "," + pre_zero(minute) +
+            "," + str(record[2]) + "," + str(record[3]) + "," + value_text(record) + "\n")
+
+
+class RecordLog:
+    """
+    Records are appended through a LogWriter, size() and the readers only
+    see what was flushed.
+    """
+    def __init__(self, file_name, writer=None):
+        self.file_name = file_name
+        self.writer = writer if writer is not None else LogWriter.get_default_log_writer()
+        self.record = bytearray(RECORD_SIZE)
+
+    def size(self):
+        try:
+            return os.stat(self.file_name)[6]
+        except OSError:
+            return 0
+
+    def count(self):
+        return max(0, self.size() - HEADER_SIZE) // RECORD_SIZE
+
+    def offset_of(self, index):
+        return HEADER_SIZE + index * RECORD_SIZE
+
+    def append(self, seconds, plant_id, x, y, value, kind, calibration=0):
+        # [value] is moisture % or ml of water
+        if kind != KIND_MOISTURE:
+            value *= WATER_SCALE
+        size = self.size() + self.writer.pending(self.file_name)
+        if size == 0:
+            self.writer.append(self.file_name, struct.pack(HEADER_FORMAT, MAGIC, VERSION, RECORD_SIZE, 0))
+        elif (size - HEADER_SIZE) % RECORD_SIZE:
+            # a record torn by a power cut, pad it so the next one is aligned
+            self.writer.append(self.file_name, bytes(RECORD_SIZE - (size - HEADER_SIZE) % RECORD_SIZE))
+        struct.pack_into(RECORD_FORMAT, self.record, 0, int(seconds),
+                         clamp(plant_id, 0xFFFF), clamp(x, 0xFFFF), clamp(y, 0xFFFF),
+                         clamp(value, 0xFFFF), kind, calibration)
+        self.writer.append(self.file_name, self.record)
+
+    def upgrade(self):
+        """
+        Rewrites an older log (OLD_RECORDS) with the current records,
+        curve version 0 for version 1. Returns True if it did
+        """
+        try:
+            file = open(self.file_name, 'rb')
+        except OSError:
+            return False
+        with file:
+            header = file.read(HEADER_SIZE)
+            if len(header) < HEADER_SIZE:
+                return False
+            magic, version, record_size, _ = struct.unpack(HEADER_FORMAT, header)
+            old_format, old_size = OLD_RECORDS.get(version, (None, None))
+            if magic != MAGIC or record_size != old_size:
+                return False
+            print("Upgrading record log: ", self.file_name)
+            old = bytearray(old_size)
+            upgraded = self.file_name + ".tmp"
+            with open(upgraded, 'wb') as out:
+                out.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, RECORD_SIZE, 0))
+                while file.readinto(old) == old_size:
+                    fields = struct.unpack(old_format, old)
+                    seconds, plant_id, x, y, value, kind = fields[:6]
+                    calibration = fields[6] if len(fields) > 6 else 0
+                    if kind == KIND_WATER:
+                        # whole ml
+                        value *= WATER_SCALE
+                    struct.pack_into(RECORD_FORMAT, self.record, 0, seconds, plant_id, x, y, value, kind, calibration)
+                    out.write(self.record)
+        os.remove(self.file_name)
+        os.rename(upgraded, self.file_name)
+        return True
+
+    def check_header(self, file):
+        file.seek(0)
+        header = file.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            return False
+        magic, version, record_size, _ = struct.unpack(HEADER_FORMAT, header)
+        if magic != MAGIC or version != VERSION or record_size != RECORD_SIZE:
+            print("Unknown record log: ", self.file_name, magic, version, record_size)
+            return False
+        return True
+
+    def records(self, start=0):
+        # Yields the records from index [start] on, read one at a time into a reused buffer
+        try:
+            file = open(self.file_name, 'rb')
+        except OSError:
+            return
+        with file:
+            if not self.check_header(file):
+                return
+            file.seek(self.offset_of(start))
+            while file.readinto(self.record) == RECORD_SIZE:
+                yield struct.unpack(RECORD_FORMAT, self.record)
+
+    def read(self, index, file):
+        file.seek(self.offset_of(index))
+        file.readinto(self.record)
+        return struct.unpack(RECORD_FORMAT, self.record)
+
+    def first_timestamp(self):
+        # Timestamp of the first record, None when there is none
+        try:
+            with open(self.file_name, 'rb') as file:
+                if not self.check_header(file) or self.count() == 0:
+                    return None
+                return self.read(0, file)[0]
+        except OSError:
+            return None
+
+    def find_runs(self, file):
+        # Indexes of the records whose timestamp is lower than the one before
+        runs = [0]
+        previous = None
+        file.seek(HEADER_SIZE)
+        for index in range(self.count()):
+            if file.readinto(self.record) != RECORD_SIZE:
+                break
+            seconds = struct.unpack_from("<I", self.record)[0]
+            if previous is not None and seconds < previous:
+                runs.append(index)
+            previous = seconds
+        return runs
+
+    def find_after(self, seconds):
+        # Index of the first record logged after [seconds], count() when there is none
+        count = self.count()
+        if count == 0:
+            return 0
+        with open(self.file_name, 'rb') as file:
+            runs = self.find_runs(file)
+            for run, start in enumerate(runs):
+                end = runs[run + 1] if run + 1 < len(runs) else count
+                low, high = start, end
+                while low < high:
+                    middle = (low + high) // 2
+                    if self.read(middle, file)[0] <= seconds:
+                        low = middle + 1
+                    else:
+                        high = middle
+                if low < end:
+                    return low
+        return count
+
+    def import_csv(self, csv_file_name, kind):
+        """
+        Moves the records of an old CSV log (month,day,year-2000,hour,minute,x,y,value)
+        into this log. The CSV is renamed to [csv_file_name].imported once done.
+        """
+        try:
+            file = open(csv_file_name, 'r')
+        except OSError:
+            return 0
+        imported = 0
+        with file:
+            for line in file:
+                try:
+                    fields = line.rstrip().split(",")
+                    self.append(timestamp_from_reading_name(line), UNKNOWN_PLANT,
+                                float(fields[5]), float(fields[6]), float(fields[7]), kind)
+                    imported += 1
+                except (ValueError, IndexError):
+                    print("Skipping log line: ", line)
+        # the records are on flash before the CSV goes
+        self.writer.flush("import")
+        os.rename(csv_file_name, csv_file_name + ".imported")
+        print("Imported ", imported, " records from ", csv_file_name)
+        return imported
+
+
+def first_record_timestamp(file_name):
+    return RecordLog(file_name).first_timestamp()
+
+
+class RecordCsvStream:
+    """
+    Reads RecordLogs (the segments of a log, oldest first) as the CSV they
+    used to be, from record [start] of the first one on, generating one
+    line at a time (see Utils.send_stream_task). Purges are left out.
+    """
+    def __init__(self, logs, start=0):
+        self.logs = logs
+        self.start = start
+        self.open_records()
+
+    def all_records(self):
+        for position, log in enumerate(self.logs):
+            for record in log.records(self.start if position == 0 else 0):
+                if record[5] != KIND_PURGE:
+                    yield record
+
+    def open_records(self):
+        self.lines = self.all_records()
+        self.pending = b""
+        self.pending_offset = 0
+        self.position = 0
+
+    def readinto(self, buffer):
+        count = 0
+        while count < len(buffer):
+            if self.pending_offset >= len(self.pending):
+                try:
+                    self.pending = csv_line(next(self.lines)).encode('utf-8')
+                except StopIteration:
+                    break
+                self.pending_offset = 0
+            take = min(len(buffer) - count, len(self.pending) - self.pending_offset)
+            buffer[count:count + take] = self.pending[self.pending_offset:self.pending_offset + take]
+            self.pending_offset += take
+            count += take
+        self.position += count
+        return count
+
+    def seek(self, position):
+        # Generates the lines again from the start when going back
+        if position < self.position:
+            self.lines.close()
+            self.open_records()
+        scratch = bytearray(64)
+        while self.position < position:
+            if not self.readinto(memoryview(scratch)[:min(64, position - self.position)]):
+                break
+        return self.position
+
+    def close(self):
+        self.lines.close()
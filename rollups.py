@@ -0,0 +1,282 @@
+"""
+Per plant daily and weekly moisture rollups, kept up to date as readings
+and waterings are logged so a dashboard does not need the whole history.
+
+The rollups live in a file of fixed-size slots split in two rings, one
+for day buckets and one for week buckets, so busy days never push out
+the week being filled. Each ring has [days] or [weeks] slots per plant
+there is room for: a new bucket takes the next slot of its ring and the
+oldest one is overwritten once the ring is full. The bucket being filled
+is updated in place. Changed slots are written when the LogWriter
+flushes, all in one open of the file.
+
+Room is made for plants PLANT_STEP at a time. When more plants log than
+there is room for (fit), the file is laid out again with the buckets it
+had, as is a file from older firmware.
+
+Header, 14 bytes:
+- Magic b"AGRU" - 4 bytes
+- Version - 1 byte
+- Slot size - 1 byte
+- Plants there is room for - 2 bytes
+- Day, week slots per plant - 1 byte each
+- Next day slot, next week slot to use - 2 bytes each
+
+The day ring (plants * days slots) comes first, then the week ring
+(plants * weeks slots).
+
+Slot, 18 bytes little endian ("<HHBBBxHII"):
+- Plant id (0xFFFF for an empty slot) - 2 bytes
+- First day of the bucket, days since 2000-01-01 - 2 bytes
+- Period (PERIOD_DAY, PERIOD_WEEK) - 1 byte
+- Min, max moisture % - 1 byte each
+- Padding - 1 byte
+- Moisture readings - 2 bytes
+- Sum of the moisture readings, mean = sum / count - 4 bytes
+- Water given, tenths of a ml - 4 bytes
+"""
+import struct
+
+from record_log import clamp, UNKNOWN_PLANT, WATER_SCALE
+from log_writer import LogWriter
+
+ROLLUP_FILE = "rollups.bin"
+
+class default_rollup_params:
+    # buckets kept per plant, today and last week at least
+    DAYS = 7
+    WEEKS = 2
+    # room is made for this many plants at a time (2.6 KB)
+    PLANT_STEP = 16
+
+MAGIC = b"AGRU"
+VERSION = 2
+HEADER_FORMAT = "<4sBBHBBHH"
+HEADER_SIZE = 14
+# the single ring of version 1
+V1_HEADER_SIZE = 8
+SLOT_FORMAT = "<HHBBBxHII"
+SLOT_SIZE = 18
+
+PERIOD_DAY = 0
+PERIOD_WEEK = 1
+
+EMPTY = UNKNOWN_PLANT
+
+def bucket_day(day, period):
+    # First day of the bucket [day] (days since 2000-01-01) falls in, weeks start on monday
+    if period == PERIOD_WEEK:
+        # 2000-01-03 was a monday
+        return day - (day - 2) % 7
+    return day
+
+def plant_room(plants, step=default_rollup_params.PLANT_STEP):
+    # Plants to make room for when [plants] log, a step more than needed
+    return (plants // step + 1) * step
+
+
+class Rollups:
+    """
+    [current] maps (plant id, period) to [slot, slot fields] of the bucket
+    being filled, so an update needs no read. [dirty] maps the slots
+    changed since the last flush to their fields.
+    """
+    _DEFAULT_ROLLUPS_INSTANCE = None
+
+    @classmethod
+    def get_default_rollups(cls):
+        if cls._DEFAULT_ROLLUPS_INSTANCE is None:
+            cls._DEFAULT_ROLLUPS_INSTANCE = Rollups(ROLLUP_FILE)
+        return cls._DEFAULT_ROLLUPS_INSTANCE
+
+    def __init__(self, file_name, plants=0, days=default_rollup_params.DAYS,
+                 weeks=default_rollup_params.WEEKS, writer=None):
+        self.file_name = file_name
+        self.days = days
+        self.weeks = weeks
+        self.slot = bytearray(SLOT_SIZE)
+        self.plants = 0
+        # next slot of the day and the week ring, from the start of the ring
+        self.next_slots = [0, 0]
+        self.current = {}
+        self.dirty = {}
+        self.header_dirty = False
+        self.load(plant_room(plants))
+        self.writer = writer if writer is not None else LogWriter.get_default_log_writer()
+        self.writer.add_flusher(self)
+
+    def ring(self, period):
+        # (first slot, slots) of the ring of [period]
+        if period == PERIOD_DAY:
+            return 0, self.plants * self.days
+        return self.plants * self.days, self.plants * self.weeks
+
+    def load(self, plants):
+        # Reads the file, laid out again when it has no room for [plants]
+        try:
+            file = open(self.file_name, 'rb')
+        except OSError:
+            self.create(plants)
+            return
+        with file:
+            header = file.read(HEADER_SIZE)
+            if len(header) == HEADER_SIZE and header[:4] == MAGIC and header[4] == VERSION:
+                _, _, slot_size, room, days, weeks, next_day, next_week = struct.unpack(HEADER_FORMAT, header)
+                if slot_size == SLOT_SIZE and room >= plants and days == self.days and weeks == self.weeks:
+                    self.plants = room
+                    self.next_slots = [next_day % max(1, room * days), next_week % max(1, room * weeks)]
+                    for slot in range(room * (days + weeks)):
+                        if file.readinto(self.slot) != SLOT_SIZE:
+                            break
+                        fields = list(struct.unpack(SLOT_FORMAT, self.slot))
+                        if fields[0] != EMPTY:
+                            self.make_current([slot, fields])
+                    return
+        self.lay_out(plants)
+
+    def make_current(self, bucket):
+        key = (bucket[1][0], bucket[1][2])
+        known = self.current.get(key, None)
+        if known is None or bucket[1][1] >= known[1][1]:
+            self.current[key] = bucket
+
+    def read_buckets(self):
+        # Fields of every bucket in the file, whatever its layout, oldest first
+        buckets = []
+        try:
+            with open(self.file_name, 'rb') as file:
+                header = file.read(HEADER_SIZE)
+                if len(header) < V1_HEADER_SIZE or header[:4] != MAGIC or header[5] != SLOT_SIZE:
+                    print("Unknown rollup file, starting over: ", self.file_name)
+                    return buckets
+                version = header[4]
+                file.seek(HEADER_SIZE if version == VERSION else V1_HEADER_SIZE)
+                while file.readinto(self.slot) == SLOT_SIZE:
+                    fields = list(struct.unpack(SLOT_FORMAT, self.slot))
+                    if fields[0] != EMPTY and fields[2] in (PERIOD_DAY, PERIOD_WEEK):
+                        if version == 1:
+                            # whole ml
+                            fields[7] *= WATER_SCALE
+                        buckets.append(fields)
+        except OSError:
+            pass
+        buckets.sort(key=lambda fields: fields[1])
+        return buckets
+
+    def lay_out(self, plants):
+        # Makes the file again with room for [plants], keeping the buckets it had
+        buckets = self.read_buckets()
+        self.create(plants)
+        for fields in buckets:
+            bucket = [self.take_slot(fields[2]), fields]
+            self.make_current(bucket)
+            self.dirty[bucket[0]] = fields
+        self.flush()
+
+    def create(self, plants):
+        self.plants = plants
+        self.next_slots = [0, 0]
+        self.current = {}
+        self.dirty = {}
+        struct.pack_into(SLOT_FORMAT, self.slot, 0, EMPTY, 0, 0, 0, 0, 0, 0, 0)
+        try:
+            with open(self.file_name, 'wb') as file:
+                file.write(self.header())
+                for _ in range(plants * (self.days + self.weeks)):
+                    file.write(self.slot)
+        except Exception as e:
+            print("Error writing to file: ", e)
+
+    def header(self):
+        return struct.pack(HEADER_FORMAT, MAGIC, VERSION, SLOT_SIZE, self.plants, self.days, self.weeks,
+                           self.next_slots[PERIOD_DAY], self.next_slots[PERIOD_WEEK])
+
+    def fit(self, plants):
+        # Makes room for [plants] logging, a no-op while there is
+        if plants > self.plants:
+            print("Making room for ", plants, " plants in the rollups")
+            self.flush()
+            self.lay_out(plant_room(plants))
+
+    def flush(self):
+        # Writes the changed slots, returns the number of files written
+        if not self.dirty and not self.header_dirty:
+            return 0
+        try:
+            with open(self.file_name, 'r+b') as file:
+                if self.header_dirty:
+                    file.write(self.header())
+                for slot, fields in self.dirty.items():
+                    struct.pack_into(SLOT_FORMAT, self.slot, 0, *fields)
+                    file.seek(HEADER_SIZE + slot * SLOT_SIZE)
+                    file.write(self.slot)
+        except Exception as e:
+            print("Error writing to file: ", e)
+        self.dirty = {}
+        self.header_dirty = False
+        return 1
+
+    def take_slot(self, period):
+        # Next slot of the ring of [period], the bucket in it is dropped
+        first, size = self.ring(period)
+        slot = first + self.next_slots[period]
+        self.next_slots[period] = (self.next_slots[period] + 1) % size
+        self.header_dirty = True
+        # the bucket about to be overwritten may still be some plant's current one
+        for other_key, other in list(self.current.items()):
+            if other[0] == slot:
+                del self.current[other_key]
+        return slot
+
+    def bucket(self, plant_id, period, day):
+        # [slot, fields] of the bucket of [plant_id] for [day], started if needed
+        key = (plant_id, period)
+        start = bucket_day(day, period)
+        known = self.current.get(key, None)
+        if known is not None and known[1][1] == start:
+            return known
+        if known is not None and known[1][1] > start:
+            # the clock went back, keep filling the latest bucket
+            return known
+
+        bucket = [self.take_slot(period), [plant_id, start, period, 0xFF, 0, 0, 0, 0]]
+        self.current[key] = bucket
+        return bucket
+
+    def update(self, plant_id, seconds, moisture=None, water_ml=0):
+        if plant_id == UNKNOWN_PLANT:
+            return
+        day = int(seconds) // 86400
+        for period in (PERIOD_DAY, PERIOD_WEEK):
+            slot, fields = self.bucket(plant_id, period, day)
+            if moisture is not None:
+                value = clamp(moisture, 0xFF)
+                fields[3] = min(fields[3], value)
+                fields[4] = max(fields[4], value)
+                fields[5] = min(fields[5] + 1, 0xFFFF)
+                fields[6] += value
+            fields[7] += clamp(water_ml * WATER_SCALE, 0xFFFF)
+            self.dirty[slot] = fields
+        self.writer.changed()
+
+    def add_moisture(self, plant_id, seconds, moisture):
+        self.update(plant_id, seconds, moisture=moisture)
+
+    def add_water(self, plant_id, seconds, water_ml):
+        self.update(plant_id, seconds, water_ml=water_ml)
+
+    def get(self, plant_id, period=PERIOD_DAY):
+        # The bucket being filled for [plant_id] as a dict, or None
+        known = self.current.get((plant_id, period), None)
+        if known is None:
+            return None
+        _, day, period, low, high, count, total, water = known[1]
+        return {
+            "day": day,
+            "period": period,
+            "min": low if count else None,
+            "max": high if count else None,
+            "mean": total / count if count else None,
+            "count": count,
+            "water_ml": water / WATER_SCALE,
+        }
@@ -0,0 +1,188 @@
+import math
+
+class default_route_params:
+    # Where the gantry parks between missions (see Controller.run_mission)
+    HOME = (10, 10)
+    # Max number of 2-opt / Or-opt improvement sweeps
+    MAX_PASSES = 8
+    # Longest run of stops Or-opt will try to relocate
+    OR_OPT_SEGMENT = 3
+
+def xy_to_ab(x, y):
+    # Belt a and b (mm) of [x], [y] as XY_motion.xy_to_ab has them, which
+    # also checks the gantry is homed: planning only needs the metric
+    return y - x, -y - x
+
+class RoutePlanner:
+    """
+    Orders the stops of a mission to cut down on belt travel.
+
+    On a CoreXY gantry the A and B motors run at the same time, so a move
+    takes as long as the longer of the two belt moves. The cost of going
+    from one stop to the next is therefore max(|da|, |db|) in belt mm,
+    with a and b from xy_to_ab.
+
+    The order is built with a nearest neighbour pass and then refined with
+    2-opt and Or-opt moves until nothing improves (or MAX_PASSES is hit).
+    """
+    @classmethod
+    def get_default_route_planner(cls, xy):
+        return RoutePlanner(xy, default_route_params.HOME,
+                            default_route_params.MAX_PASSES,
+                            default_route_params.OR_OPT_SEGMENT)
+
+    def __init__(self, xy, home=default_route_params.HOME,
+                 max_passes=default_route_params.MAX_PASSES,
+                 or_opt_segment=default_route_params.OR_OPT_SEGMENT):
+        self.xy = xy
+        self.home = home
+        self.max_passes = max_passes
+        self.or_opt_segment = or_opt_segment
+
+    def travel_cost(self, ab_from, ab_to):
+        # Both belts move together, the longer one sets the move time
+        return max(math.fabs(ab_to[0] - ab_from[0]), math.fabs(ab_to[1] - ab_from[1]))
+
+    def route_cost(self, points, start=None, end=None):
+        """
+        Total travel cost of visiting [points] (list of (x, y)) in order,
+        from [start] and finishing at [end] (either can be None)
+        """
+        path = [xy_to_ab(p[0], p[1]) for p in points]
+        if start is not None:
+            path.insert(0, xy_to_ab(start[0], start[1]))
+        if end is not None:
+            path.append(xy_to_ab(end[0], end[1]))
+        cost = 0
+        for i in range(len(path) - 1):
+            cost += self.travel_cost(path[i], path[i + 1])
+        return cost
+
+    def plan(self, stops, start=None, end=None):
+        """
+        Plans the order to visit [stops]
+
+        :param stops: dict of name -> (x, y) in mm
+        :param start: (x, y) the gantry starts at, or None for a free start
+        :param end: (x, y) the gantry has to finish at, or None for a free end
+        :return: list of names in visiting order
+        """
+        names = list(stops.keys())
+        if len(names) < 2:
+            return names
+
+        # Convert every stop once, the cost function only needs a and b
+        nodes = [xy_to_ab(stops[name][0], stops[name][1]) for name in names]
+        start_ab = None if start is None else xy_to_ab(start[0], start[1])
+        end_ab = None if end is None else xy_to_ab(end[0], end[1])
+
+        order = self._nearest_neighbour(nodes, start_ab)
+
+        for _ in range(self.max_passes):
+            improved = self._two_opt(order, nodes, start_ab, end_ab)
+            improved = self._or_opt(order, nodes, start_ab, end_ab) or improved
+            if not improved:
+                break
+
+        return [names[i] for i in order]
+
+    def _edge(self, nodes, i, j, start_ab, end_ab):
+        # Cost between two tour positions, -1 is the start and None is the end
+        if i == -1:
+            if start_ab is None:
+                return 0
+            a = start_ab
+        else:
+            a = nodes[i]
+        if j is None:
+            if end_ab is None:
+                return 0
+            b = end_ab
+        else:
+            b = nodes[j]
+        return self.travel_cost(a, b)
+
+    def _nearest_neighbour(self, nodes, start_ab):
+        remaining = list(range(len(nodes)))
+        order = []
+        if start_ab is None:
+            current = nodes[remaining.pop(0)]
+            order.append(0)
+        else:
+            current = start_ab
+        while remaining:
+            best_index = 0
+            best_cost = self.travel_cost(current, nodes[remaining[0]])
+            for k in range(1, len(remaining)):
+                cost = self.travel_cost(current, nodes[remaining[k]])
+                if cost < best_cost:
+                    best_cost = cost
+                    best_index = k
+            node = remaining.pop(best_index)
+            order.append(node)
+            current = nodes[node]
+        return order
+
+    def _two_opt(self, order, nodes, start_ab, end_ab):
+        # Reverse order[i:j+1] whenever that shortens the route
+        n = len(order)
+        improved = False
+        for i in range(n - 1):
+            prev = order[i - 1] if i > 0 else -1
+            for j in range(i + 1, n):
+                after = order[j + 1] if j + 1 < n else None
+                before = self._edge(nodes, prev, order[i], start_ab, end_ab) + \
+                         self._edge(nodes, order[j], after, start_ab, end_ab)
+                after_swap = self._edge(nodes, prev, order[j], start_ab, end_ab) + \
+                             self._edge(nodes, order[i], after, start_ab, end_ab)
+                if after_swap < before - 1e-6:
+                    order[i:j + 1] = order[i:j + 1][::-1]
+                    improved = True
+        return improved
+
+    def _or_opt(self, order, nodes, start_ab, end_ab):
+        # Move short runs of stops to a cheaper spot in the route
+        improved = False
+        for length in range(1, self.or_opt_segment + 1):
+            i = 0
+            while i + length <= len(order):
+                n = len(order)
+                first = order[i]
+                last = order[i + length - 1]
+                prev = order[i - 1] if i > 0 else -1
+                after = order[i + length] if i + length < n else None
+
+                removed_gain = self._edge(nodes, prev, first, start_ab, end_ab) + \
+                               self._edge(nodes, last, after, start_ab, end_ab) - \
+                               self._edge(nodes, prev, after, start_ab, end_ab)
+
+                segment = order[i:i + length]
+                rest = order[:i] + order[i + length:]
+
+                best_gain = 1e-6
+                best_position = None
+                best_reversed = False
+                for k in range(len(rest) + 1):
+                    left = rest[k - 1] if k > 0 else -1
+                    right = rest[k] if k < len(rest) else None
+                    gap = self._edge(nodes, left, right, start_ab, end_ab)
+                    forward = self._edge(nodes, left, first, start_ab, end_ab) + \
+                              self._edge(nodes, last, right, start_ab, end_ab) - gap
+                    backward = self._edge(nodes, left, last, start_ab, end_ab) + \
+                               self._edge(nodes, first, right, start_ab, end_ab) - gap
+                    if removed_gain - forward > best_gain:
+                        best_gain = removed_gain - forward
+                        best_position = k
+                        best_reversed = False
+                    if length > 1 and removed_gain - backward > best_gain:
+                        best_gain = removed_gain - backward
+                        best_position = k
+                        best_reversed = True
+
+                if best_position is not None:
+                    if best_reversed:
+                        segment = segment[::-1]
+                    order[:] = rest[:best_position] + segment + rest[best_position:]
+                    improved = True
+                i += 1
+        return improved
@@ -0,0 +1,225 @@
+"""
+Mission scheduling: when each mission runs next, and a scheduler that
+sleeps until the earliest of those times instead of polling the clock.
+
+A mission's schedule is read from its dict:
+- "time": [hour, minute] - when it runs
+- "repeat": REPEAT_DAILY (default), REPEAT_HOURS (from "time" every
+  "every_hours" hours until the end of the day) or REPEAT_WEEKDAYS (at
+  "time" on the days set in "weekdays", bit 0 monday ... bit 6 sunday)
+- "catch_up": CATCH_UP_ONCE (default, a run missed while the AgBot was
+  off or busy runs once, as soon as possible) or CATCH_UP_NONE (a run
+  missed by more than the grace period is skipped)
+"""
+import uasyncio as asyncio
+
+import heapq
+
+from record_log import timestamp, date_from_timestamp
+
+class default_scheduler_params:
+    # longest sleep before the time is read again (seconds)
+    MAX_SLEEP_S = 3600
+    # wait before reading the RTC again when it can not be read (seconds)
+    CLOCK_RETRY_S = 30
+    # a run this late still counts as on time with CATCH_UP_NONE (seconds)
+    GRACE_S = 5 * 60
+
+REPEAT_DAILY = "daily"
+REPEAT_HOURS = "hours"
+REPEAT_WEEKDAYS = "weekdays"
+
+CATCH_UP_ONCE = "once"
+CATCH_UP_NONE = "none"
+
+# as numbered over BLE
+REPEATS = (REPEAT_DAILY, REPEAT_HOURS, REPEAT_WEEKDAYS)
+CATCH_UPS = (CATCH_UP_ONCE, CATCH_UP_NONE)
+
+# mission types the scheduler runs
+SCHEDULED_TYPES = ("sense_moisture",)
+
+def schedule_error(hour, minute, repeat, every_hours, weekdays, catch_up):
+    # Why a schedule can not be used, None when it can
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        return "time out of range"
+    if repeat not in REPEATS:
+        return "unknown repeat"
+    if catch_up not in CATCH_UPS:
+        return "unknown catch up"
+    if not 1 <= every_hours <= 24:
+        return "every_hours out of range"
+    if not 0 <= weekdays <= 0x7F or (repeat == REPEAT_WEEKDAYS and weekdays == 0):
+        return "no such weekdays"
+    return None
+
+def weekday(day):
+    # 0 monday ... 6 sunday of [day] (days since 2000-01-01, a saturday)
+    return (day + 5) % 7
+
+def fire_times_on(mission, day):
+    # Times (seconds since 2000) [mission] runs on [day]
+    hour, minute = mission["time"][0], mission["time"][1]
+    start = day * 86400 + int(hour) * 3600 + int(minute) * 60
+    repeat = mission.get("repeat", REPEAT_DAILY)
+    if repeat == REPEAT_WEEKDAYS:
+        if not (mission.get("weekdays", 0x7F) >> weekday(day)) & 1:
+            return ()
+    elif repeat == REPEAT_HOURS:
+        step = max(1, int(mission.get("every_hours", 24))) * 3600
+        return range(start, (day + 1) * 86400, step)
+    return (start,)
+
+def next_fire(mission, after):
+    # First time [mission] runs after [after], None if it never does
+    first_day = after // 86400
+    # a week covers every weekday
+    for day in range(first_day, first_day + 8):
+        for fire in fire_times_on(mission, day):
+            if fire > after:
+                return fire
+    return None
+
+
+class MissionRuns:
+    """
+    When each mission last ran, so "did it already run today" is one dict
+    lookup instead of a scan of the whole history. Holds one entry per
+    mission, built on boot from the missions logged today only
+    (Utils.iter_mission_history(since=start of today)).
+    """
+    def __init__(self):
+        # mission id -> seconds since 2000 of its last run
+        self.last_runs = {}
+
+    def load(self, history):
+        # [history] rows are [mission id, day, month, year - 2000, hour, minute]
+        for row in history:
+            try:
+                mission_id, day, month, year, hour, minute = row[:6]
+            except ValueError:
+                print("Skipping mission history row: ", row)
+                continue
+            self.record(mission_id, timestamp(2000 + year, month, day, hour, minute))
+
+    def record(self, mission_id, seconds):
+        last = self.last_runs.get(mission_id, None)
+        if last is None or seconds > last:
+            self.last_runs[mission_id] = seconds
+
+    def last_run(self, mission_id):
+        # Seconds since 2000 of the last run of [mission_id], None if it did not run yet
+        return self.last_runs.get(mission_id, None)
+
+    def ran_on(self, mission_id, day):
+        # Whether [mission_id] ran on [day] (days since 2000-01-01)
+        last = self.last_runs.get(mission_id, None)
+        return last is not None and last // 86400 == day
+
+    def forget(self, mission_id):
+        self.last_runs.pop(mission_id, None)
+
+
+class MissionScheduler:
+    """
+    Keeps a heap of (next run, mission id) of the missions in [memory] and
+    sleeps until the first one is due. wake() (missions changed, clock set)
+    makes it build the heap again right away. [get_now] returns the time
+    in seconds since 2000 (None when unknown), [run_mission] is an async
+    function(mission, now) that runs a due mission and logs it.
+    """
+    def __init__(self, memory, get_now, run_mission, runs=None,
+                 max_sleep_s=default_scheduler_params.MAX_SLEEP_S,
+                 clock_retry_s=default_scheduler_params.CLOCK_RETRY_S,
+                 grace_s=default_scheduler_params.GRACE_S):
+        self.memory = memory
+        self.get_now = get_now
+        self.run_mission = run_mission
+        self.runs = runs if runs is not None else MissionRuns()
+        self.max_sleep_s = max_sleep_s
+        self.clock_retry_s = clock_retry_s
+        self.grace_s = grace_s
+
+        self.queue = []
+        self.changed = True
+        self.event = asyncio.Event()
+        # counters
+        self.wakeups = 0
+        self.fired = 0
+
+    def wake(self):
+        # The missions or the clock changed
+        self.changed = True
+        self.event.set()
+
+    def due_time(self, mission, now):
+        # When [mission] should run next, at or before [now] if it is due
+        mission_id = mission["mission_id"]
+        last = self.runs.last_run(mission_id)
+        if last is None:
+            # nothing ran today, today's runs are still to do
+            after = now - now % 86400 - 1
+        elif mission.get("repeat", REPEAT_DAILY) == REPEAT_HOURS:
+            after = last
+        else:
+            # a daily mission that ran today is done for the day
+            after = last - last % 86400 + 86400 - 1
+        fire = next_fire(mission, after)
+        if fire is None:
+            return None
+        if now - fire > self.grace_s and mission.get("catch_up", CATCH_UP_ONCE) == CATCH_UP_NONE:
+            fire = next_fire(mission, now)
+        return fire
+
+    def schedule(self, mission, now):
+        fire = self.due_time(mission, now)
+        if fire is not None:
+            heapq.heappush(self.queue, (fire, mission["mission_id"]))
+
+    def rebuild(self, now):
+        self.queue = []
+        for mission in self.memory.get_missions():
+            if mission.get("type", None) in SCHEDULED_TYPES:
+                self.schedule(mission, now)
+        self.changed = False
+        if self.queue:
+            print("Next mission: ", self.queue[0][1], "at", date_from_timestamp(self.queue[0][0]))
+
+    async def sleep(self, seconds):
+        # Sleeps [seconds] or until wake(), a wake() before this (while a
+        # mission ran) was already seen by run() building the heap again
+        self.event.clear()
+        try:
+            await asyncio.wait_for_ms(self.event.wait(), int(seconds * 1000))
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        while True:
+            now = self.get_now()
+            self.wakeups += 1
+            if now is None:
+                print("Error: Could not get time")
+                await self.sleep(self.clock_retry_s)
+                continue
+            if self.changed:
+                self.rebuild(now)
+            if not self.queue:
+                await self.sleep(self.max_sleep_s)
+                continue
+
+            fire, mission_id = self.queue[0]
+            if fire > now:
+                # the clock is read again on waking, a sleep may overshoot
+                await self.sleep(min(fire - now, self.max_sleep_s))
+                continue
+
+            heapq.heappop(self.queue)
+            mission = self.memory.get_mission(mission_id)
+            if mission is None:
+                continue
+            self.fired += 1
+            await self.run_mission(mission, now)
+            self.runs.record(mission_id, now)
+            # runs that came due during this one are caught up as the mission says
+            self.schedule(mission, self.get_now() or now)
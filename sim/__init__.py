@@ -0,0 +1,175 @@
+"""
+Host side simulator for the AgBot.
+
+Provides CPython versions of the MicroPython only modules the firmware
+imports (machine, rp2, bluetooth, aioble, uasyncio, micropython,
+deflate), backed by a model of the XRP board: DC motors with PIO
+encoders, the CoreXY gantry and z axis with their end stops, the pump,
+a soil moisture field read through the ADC, a DS3231 on I2C and an
+in-memory BLE radio.
+
+Everything runs on a virtual clock, so Controller, AgBot, XY_motion and
+main.tasks run unmodified and much faster than real time:
+
+    import sim
+    sim.install()
+
+    import main
+    controller = sim.build_controller("/tmp/farm")
+    sim.run(main.tasks(controller), duration=3600)
+
+    print(sim.board().stats())
+"""
+import gc
+import os
+import sys
+import time
+
+from sim import runtime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# RAM left for the MicroPython heap on a Pico W running BLE
+HEAP_SIZE = 160 * 1024
+
+_TICKS_PERIOD = 1 << 30
+_TICKS_MAX = _TICKS_PERIOD - 1
+_TICKS_HALF = _TICKS_PERIOD // 2
+
+_installed = False
+
+
+def _ticks_ms():
+    return int(runtime.clock().now * 1000) & _TICKS_MAX
+
+
+def _ticks_us():
+    return int(runtime.clock().now * 1000000) & _TICKS_MAX
+
+
+def _ticks_diff(end, start):
+    return ((end - start + _TICKS_HALF) & _TICKS_MAX) - _TICKS_HALF
+
+
+def _ticks_add(ticks, delta):
+    return (ticks + delta) & _TICKS_MAX
+
+
+def _sleep_ms(ms):
+    runtime.clock().spend(ms / 1000)
+
+
+def _sleep_us(us):
+    runtime.clock().spend(us / 1000000)
+
+
+def _mem_alloc():
+    import tracemalloc
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    return 0
+
+
+def _mem_free():
+    return max(0, HEAP_SIZE - _mem_alloc())
+
+
+def install(**board_args):
+    """
+    Starts the simulation and makes the MicroPython modules importable.
+    [board_args] go to sim.hardware.Board (bed size, start position, ...).
+    """
+    global _installed
+    runtime.start(**board_args)
+    if _installed:
+        return
+
+    from sim import machine, rp2, bluetooth, aioble, uasyncio, micropython, deflate
+    sys.modules["machine"] = machine
+    sys.modules["rp2"] = rp2
+    sys.modules["bluetooth"] = bluetooth
+    sys.modules["aioble"] = aioble
+    sys.modules["uasyncio"] = uasyncio
+    sys.modules["micropython"] = micropython
+    sys.modules["deflate"] = deflate
+
+    for path in (os.path.join(REPO_ROOT, "lib"), REPO_ROOT):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+    time.ticks_ms = _ticks_ms
+    time.ticks_us = _ticks_us
+    time.ticks_cpu = _ticks_us
+    time.ticks_diff = _ticks_diff
+    time.ticks_add = _ticks_add
+    time.sleep_ms = _sleep_ms
+    time.sleep_us = _sleep_us
+
+    gc.mem_alloc = _mem_alloc
+    gc.mem_free = _mem_free
+
+    _installed = True
+
+
+def reset(**board_args):
+    """
+    New bed for the next scenario. Time keeps running, the firmware's
+    motor singletons carry over and see the new board.
+    """
+    return runtime.replace_board(**board_args)
+
+
+def board():
+    return runtime.board()
+
+
+def now():
+    # virtual seconds since install()
+    return runtime.clock().now
+
+
+def run(coro, duration=None):
+    """
+    Runs [coro] on the virtual clock. With a [duration] (virtual seconds)
+    the coroutine is cancelled once it is up and None is returned.
+    """
+    import asyncio
+
+    async def bounded():
+        task = asyncio.ensure_future(coro)
+        done, _ = await asyncio.wait([task], timeout=duration)
+        if task in done:
+            return task.result()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return None
+
+    return runtime.loop().run_until_complete(bounded())
+
+
+def build_controller(workdir, data=None):
+    """
+    Makes a Controller whose memory and log files live in [workdir].
+    [data] replaces agbot_data.json, otherwise the repo's copy is used
+    when the directory has none.
+    """
+    import json
+    from agbot import AgBot
+    from agbot_memory import AgBotMemory
+    from clock import Clock
+    from controller import Controller
+    from soft_clock import SoftClock
+
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    data_file = os.path.join(workdir, "agbot_data.json")
+    if data is not None:
+        with open(data_file, "w") as file:
+            json.dump(data, file)
+    elif not os.path.exists(data_file):
+        with open(os.path.join(REPO_ROOT, "agbot_data.json")) as source:
+            with open(data_file, "w") as file:
+                file.write(source.read())
+
+    # a software clock of its own, following the current board's DS3231
+    return Controller(AgBotMemory(data_file), AgBot.get_default_agbot(), SoftClock(Clock.get_default_clock()))
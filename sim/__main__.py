@@ -0,0 +1,40 @@
+"""
+Runs the full firmware (main.tasks) in the simulator.
+
+    python -m sim --minutes 30 --data agbot_data.json --workdir /tmp/agbot
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import sim
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the AgBot firmware in the simulator")
+    parser.add_argument("--minutes", type=float, default=10, help="virtual minutes to run for")
+    parser.add_argument("--data", help="agbot_data.json to start from (default: the repo's)")
+    parser.add_argument("--workdir", help="where memory and logs are written (default: a temp dir)")
+    args = parser.parse_args()
+
+    sim.install()
+    import main as firmware
+
+    data = None
+    if args.data:
+        with open(args.data) as file:
+            data = json.load(file)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="agbot-sim-")
+    controller = sim.build_controller(os.path.abspath(workdir), data)
+
+    started = time.time()
+    sim.run(firmware.tasks(controller), duration=args.minutes * 60)
+    print("Simulated %.0f s in %.1f s" % (sim.now(), time.time() - started))
+    print("Board: ", sim.board().stats())
+    print("Files in: ", workdir)
+
+
+if __name__ == "__main__":
+    main()
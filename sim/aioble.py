@@ -0,0 +1,141 @@
+"""
+Simulated `aioble` module: a peripheral GATT server kept in memory and
+reached by sim.ble.Central.
+"""
+import asyncio
+import errno
+from collections import deque
+
+from sim import runtime as _runtime
+
+_WRITE_CAPTURE_QUEUE_LIMIT = 10
+
+
+class DeviceDisconnectedError(Exception):
+    pass
+
+
+class Device:
+    def __init__(self, addr="00:00:00:00:00:01"):
+        self.addr = addr
+
+    def __repr__(self):
+        return "Device(ADDR_PUBLIC, %s)" % self.addr
+
+
+class DeviceConnection:
+    def __init__(self):
+        self.device = Device()
+        self.mtu = None
+        self._link = None
+        self._connected = True
+        self._disconnect_event = None
+
+    def is_connected(self):
+        return self._connected
+
+    def _disconnected(self):
+        self._connected = False
+        if self._disconnect_event is not None:
+            self._disconnect_event.set()
+
+    async def disconnected(self, timeout_ms=None):
+        if not self._connected:
+            return
+        self._disconnect_event = asyncio.Event()
+        if timeout_ms is None:
+            await self._disconnect_event.wait()
+        else:
+            await asyncio.wait_for(self._disconnect_event.wait(), timeout_ms / 1000)
+
+    async def disconnect(self, timeout_ms=2000):
+        if self._link is not None:
+            self._link.connected = False
+        self._disconnected()
+
+    async def exchange_mtu(self, mtu=None, timeout_ms=1000):
+        wanted = mtu or _runtime.radio().preferred_mtu
+        self.mtu = min(wanted, self._link.central.mtu)
+        self._link.mtu = self.mtu
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.disconnect()
+
+
+class Service:
+    def __init__(self, uuid):
+        self.uuid = uuid
+        self.characteristics = []
+
+
+class Characteristic:
+    def __init__(self, service, uuid, read=False, write=False, write_no_response=False,
+                 notify=False, indicate=False, initial=None, capture=False):
+        service.characteristics.append(self)
+        self.service = service
+        self.uuid = uuid
+        self.flags = (read, write, write_no_response, notify, indicate)
+        self._value = bytes(initial) if initial is not None else b""
+        self._capture = capture
+        self._writes = deque((), _WRITE_CAPTURE_QUEUE_LIMIT)
+        self._write_event = None
+
+    def read(self):
+        return self._value
+
+    def write(self, data, send_update=False):
+        self._value = bytes(data)
+        if send_update:
+            link = _runtime.radio().link
+            if link is not None:
+                self.notify(link.connection)
+
+    def notify(self, connection, data=None):
+        if connection is None or connection._link is None:
+            raise OSError(errno.ENOTCONN, "ENOTCONN")
+        connection._link.notify(self.uuid, self._value if data is None else data)
+
+    async def indicate(self, connection, data=None, timeout_ms=1000):
+        self.notify(connection, data)
+
+    def _remote_write(self, connection, data):
+        self._value = data
+        if self._capture:
+            self._writes.append((connection, data))
+        else:
+            self._writes.clear()
+            self._writes.append((connection, None))
+        if self._write_event is not None:
+            self._write_event.set()
+
+    async def written(self, timeout_ms=None):
+        while not self._writes:
+            if self._write_event is None:
+                self._write_event = asyncio.Event()
+            self._write_event.clear()
+            if timeout_ms is None:
+                await self._write_event.wait()
+            else:
+                await asyncio.wait_for(self._write_event.wait(), timeout_ms / 1000)
+        connection, data = self._writes.popleft()
+        if self._capture:
+            return connection, data
+        return connection
+
+
+def register_services(*services):
+    _runtime.radio().register(services)
+
+
+def config(mtu=None, **kwargs):
+    if mtu is not None:
+        _runtime.radio().preferred_mtu = mtu
+
+
+async def advertise(interval_us, adv_data=None, resp_data=None, connectable=True,
+                    limited_disc=False, include_tx_power=False, name=None, services=None,
+                    appearance=0, manufacturer=None, timeout_ms=None):
+    return await _runtime.radio().advertise(timeout_ms)
@@ -0,0 +1,163 @@
+"""
+In-memory BLE radio for the simulator.
+
+The firmware side uses the simulated aioble module. Host side code (tests,
+benchmarks) plays the phone app through Central. Packets go over a Link
+that models the connection interval: notifications are sent a few per
+connection event, and when the controller's TX buffers are full notify
+raises OSError(ENOMEM), like the Pico's BLE stack does.
+"""
+import asyncio
+import errno
+
+from sim import runtime as _runtime
+
+
+class Link:
+    def __init__(self, connection, central, conn_interval=0.015, packets_per_event=4,
+                 tx_buffers=16, mtu=185):
+        self.connection = connection
+        self.central = central
+        self.conn_interval = conn_interval
+        self.packets_per_event = packets_per_event
+        self.tx_buffers = tx_buffers
+        self.mtu = mtu
+        self.connected = True
+
+        self._next_tx = 0.0
+        self._in_flight = 0
+
+        # counters
+        self.notifications_sent = 0
+        self.notify_bytes = 0
+        self.notify_rejected = 0
+        self.notify_truncated = 0
+
+    def notify(self, uuid, data):
+        if not self.connected:
+            raise OSError(errno.ENOTCONN, "ENOTCONN")
+        if self._in_flight >= self.tx_buffers:
+            self.notify_rejected += 1
+            raise OSError(errno.ENOMEM, "ENOMEM")
+        data = bytes(data)
+        max_payload = self.mtu - 3
+        if len(data) > max_payload:
+            self.notify_truncated += 1
+            data = data[:max_payload]
+
+        loop = _runtime.loop()
+        slot = self.conn_interval / self.packets_per_event
+        self._next_tx = max(loop.time(), self._next_tx) + slot
+        self._in_flight += 1
+        self.notifications_sent += 1
+        self.notify_bytes += len(data)
+        loop.call_at(self._next_tx, self._deliver, uuid, data)
+
+    def _deliver(self, uuid, data):
+        self._in_flight -= 1
+        if self.connected:
+            self.central._receive(uuid, data)
+
+    def write(self, characteristic, data):
+        # a write request takes a connection event to arrive
+        loop = _runtime.loop()
+        loop.call_later(self.conn_interval, characteristic._remote_write, self.connection, bytes(data))
+
+
+class Radio:
+    def __init__(self):
+        self.services = []
+        # largest ATT MTU the peripheral accepts, aioble.config(mtu=...)
+        self.preferred_mtu = 256
+        self.link = None
+        self._advertising = None
+
+    def register(self, services):
+        self.services = list(services)
+
+    def characteristic(self, uuid):
+        for service in self.services:
+            for characteristic in service.characteristics:
+                if characteristic.uuid == uuid:
+                    return characteristic
+        raise KeyError("No characteristic %r" % (uuid,))
+
+    async def advertise(self, timeout_ms=None):
+        self._advertising = _runtime.loop().create_future()
+        try:
+            if timeout_ms is None:
+                return await self._advertising
+            return await asyncio.wait_for(self._advertising, timeout_ms / 1000)
+        finally:
+            self._advertising = None
+
+    def is_advertising(self):
+        return self._advertising is not None and not self._advertising.done()
+
+
+class Central:
+    """
+    The phone app. Connects to the advertising firmware, writes to its
+    characteristics and collects notifications.
+    """
+    def __init__(self, mtu=185, conn_interval=0.015, packets_per_event=4, tx_buffers=16):
+        self.mtu = mtu
+        self.conn_interval = conn_interval
+        self.packets_per_event = packets_per_event
+        self.tx_buffers = tx_buffers
+        self.link = None
+        # uuid -> list of (virtual time, bytes)
+        self.notifications = {}
+        self._events = {}
+
+    async def connect(self, timeout=30.0):
+        from sim.aioble import DeviceConnection
+        radio = _runtime.radio()
+        deadline = _runtime.loop().time() + timeout
+        while not radio.is_advertising():
+            if _runtime.loop().time() > deadline:
+                raise asyncio.TimeoutError()
+            await asyncio.sleep(0.05)
+        connection = DeviceConnection()
+        self.link = Link(connection, self, self.conn_interval, self.packets_per_event,
+                         self.tx_buffers, min(self.mtu, radio.preferred_mtu))
+        connection._link = self.link
+        # the app asks for its MTU right after connecting
+        connection.mtu = self.link.mtu
+        radio.link = self.link
+        radio._advertising.set_result(connection)
+        return connection
+
+    async def disconnect(self):
+        if self.link is not None:
+            self.link.connected = False
+            self.link.connection._disconnected()
+            self.link = None
+            _runtime.radio().link = None
+
+    async def write(self, uuid, data):
+        characteristic = _runtime.radio().characteristic(uuid)
+        self.link.write(characteristic, data)
+        await asyncio.sleep(self.conn_interval)
+
+    def read(self, uuid):
+        return _runtime.radio().characteristic(uuid).read()
+
+    def _receive(self, uuid, data):
+        self.notifications.setdefault(uuid, []).append((_runtime.loop().time(), data))
+        event = self._events.get(uuid)
+        if event is not None:
+            event.set()
+
+    async def notification(self, uuid, timeout=None, since=0):
+        """
+        Waits for the [since]th notification on [uuid] and returns its data
+        """
+        while len(self.notifications.get(uuid, [])) <= since:
+            event = self._events.setdefault(uuid, asyncio.Event())
+            event.clear()
+            if timeout is None:
+                await event.wait()
+            else:
+                await asyncio.wait_for(event.wait(), timeout)
+        return self.notifications[uuid][since][1]
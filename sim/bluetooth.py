@@ -0,0 +1,40 @@
+"""
+Simulated `bluetooth` module. The simulated aioble does not go through
+bluetooth.BLE, so only UUID is provided.
+"""
+import uuid as _uuid
+
+
+class UUID:
+    def __init__(self, value):
+        if isinstance(value, UUID):
+            self._value = value._value
+        elif isinstance(value, int):
+            self._value = value
+        elif isinstance(value, (bytes, bytearray)):
+            self._value = bytes(value)
+        else:
+            self._value = _uuid.UUID(value).bytes
+
+    def __eq__(self, other):
+        return isinstance(other, UUID) and self._value == other._value
+
+    def __hash__(self):
+        return hash(self._value)
+
+    def __repr__(self):
+        if isinstance(self._value, int):
+            return "UUID(0x%04x)" % self._value
+        return "UUID('%s')" % _uuid.UUID(bytes=self._value)
+
+
+FLAG_READ = 0x0002
+FLAG_WRITE_NO_RESPONSE = 0x0004
+FLAG_WRITE = 0x0008
+FLAG_NOTIFY = 0x0010
+FLAG_INDICATE = 0x0020
+
+
+class BLE:
+    def __init__(self):
+        raise NotImplementedError("Use the simulated aioble module")
@@ -0,0 +1,106 @@
+"""
+Virtual time for the simulator.
+
+Everything in the simulation (hardware timers, motor physics, the DS3231,
+the BLE link and the asyncio loop) reads time from one VirtualClock, so a
+run is deterministic and goes as fast as the host can compute it.
+
+Hardware timers behave like interrupts: when the clock moves past a
+timer's deadline the callback runs right away, in the middle of whatever
+was running, just like a soft IRQ on the Pico.
+"""
+import asyncio
+import heapq
+import selectors
+
+
+class VirtualClock:
+    def __init__(self):
+        # seconds since the simulation started
+        self.now = 0.0
+        self._timers = []
+        self._timer_seq = 0
+        self._in_irq = False
+
+    def add_timer(self, timer, deadline):
+        self._timer_seq += 1
+        heapq.heappush(self._timers, (deadline, self._timer_seq, timer))
+
+    def remove_timer(self, timer):
+        self._timers = [entry for entry in self._timers if entry[2] is not timer]
+        heapq.heapify(self._timers)
+
+    def next_deadline(self):
+        return self._timers[0][0] if self._timers else None
+
+    def advance_to(self, t):
+        """
+        Moves the clock to [t], running every timer that comes due on the way
+        """
+        if t < self.now:
+            return
+        if self._in_irq:
+            # no nested interrupts, time just passes inside the handler
+            self.now = t
+            return
+        while self._timers and self._timers[0][0] <= t:
+            deadline, _, timer = heapq.heappop(self._timers)
+            self.now = max(self.now, deadline)
+            self._in_irq = True
+            try:
+                timer.fire()
+            finally:
+                self._in_irq = False
+        self.now = t
+
+    def spend(self, seconds):
+        # time taken by a hardware access or by blocking code
+        self.advance_to(self.now + seconds)
+
+
+class _VirtualSelector(selectors.BaseSelector):
+    """
+    Selector that never waits on real file descriptors.
+    Waiting for [timeout] just moves the virtual clock forward.
+    """
+    def __init__(self, clock):
+        self._clock = clock
+        self._map = {}
+
+    def register(self, fileobj, events, data=None):
+        key = selectors.SelectorKey(fileobj, fileobj if isinstance(fileobj, int) else fileobj.fileno(),
+                                    events, data)
+        self._map[fileobj] = key
+        return key
+
+    def unregister(self, fileobj):
+        return self._map.pop(fileobj)
+
+    def get_map(self):
+        return self._map
+
+    def close(self):
+        self._map = {}
+
+    def select(self, timeout=None):
+        if timeout is None:
+            deadline = self._clock.next_deadline()
+            if deadline is None:
+                raise RuntimeError("Simulation deadlocked: nothing is scheduled")
+            # only hardware timers are left, run up to the next one
+            self._clock.advance_to(deadline)
+        else:
+            self._clock.advance_to(self._clock.now + timeout)
+        return []
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """
+    asyncio loop running on a VirtualClock. Sleeping costs no host time.
+    """
+    def __init__(self, clock):
+        super().__init__(_VirtualSelector(clock))
+        self.sim_clock = clock
+
+    def time(self):
+        return self.sim_clock.now
@@ -0,0 +1,55 @@
+"""
+Simulated `deflate` module (MicroPython 1.21+) on top of zlib, enough for
+DeflateIO to compress into and decompress from a file.
+"""
+import zlib as _zlib
+
+AUTO = 0
+RAW = 1
+ZLIB = 2
+GZIP = 3
+
+_WBITS = {AUTO: 47, RAW: -15, ZLIB: 15, GZIP: 31}
+
+
+class DeflateIO:
+    def __init__(self, stream, format=AUTO, wbits=0, close=False):
+        self.stream = stream
+        self.format = format
+        self.wbits = _WBITS[format]
+        self.close_stream = close
+        self.compressor = None
+        self.decompressor = None
+        self.pending = b""
+
+    def write(self, data):
+        if self.compressor is None:
+            self.compressor = _zlib.compressobj(wbits=self.wbits if self.format != AUTO else 15)
+        self.stream.write(self.compressor.compress(bytes(data)))
+        return len(data)
+
+    def read(self, size=-1):
+        if self.decompressor is None:
+            self.decompressor = _zlib.decompressobj(wbits=self.wbits)
+        while size < 0 or len(self.pending) < size:
+            chunk = self.stream.read(256)
+            if not chunk:
+                self.pending += self.decompressor.flush()
+                break
+            self.pending += self.decompressor.decompress(chunk)
+        if size < 0:
+            size = len(self.pending)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if self.compressor is not None:
+            self.stream.write(self.compressor.flush())
+            self.compressor = None
+        if self.close_stream:
+            self.stream.close()
@@ -0,0 +1,384 @@
+"""
+Physical model of an AgBot built on the XRP board.
+
+The pin numbers mirror XRPLib's default encoded motors and the AgBot
+defaults (moisture probe on pin 27, DS3231 on I2C 1 at 0x68):
+
+    motor 1 (belt A)  dir 6,  pwm 7,  encoder 4/5,   flipped
+    motor 2 (belt B)  dir 14, pwm 15, encoder 12/13
+    motor 3 (pump)    dir 2,  pwm 3,  encoder 0/1
+    motor 4 (z axis)  dir 10, pwm 11, encoder 8/9,   flipped
+
+Motors are first order (a free speed and a time constant) and are
+integrated lazily, whenever the firmware touches a pin or an encoder.
+"""
+import datetime
+import math
+import random
+
+# Costs of hardware accesses, in seconds of virtual time
+PIN_ACCESS_COST = 10e-6
+PIO_READ_COST = 20e-6
+ADC_READ_COST = 10e-6
+I2C_BYTE_COST = 100e-6
+
+# Motors are not re-integrated for changes shorter than this
+MIN_UPDATE_INTERVAL = 0.5e-3
+
+_MAX_PWM = 65534
+
+
+class DCMotor:
+    """
+    Gearmotor with a quadrature encoder on the motor shaft.
+    Position is kept in output shaft revolutions, in the direction the
+    motor physically turns (before any flip_dir in the firmware).
+    """
+    COUNTS_PER_REVOLUTION = 585
+
+    def __init__(self, dir_pin, pwm_pin, encoder_pin, flip=False,
+                 free_speed_rpm=90, time_constant=0.05, deadband=0.08):
+        self.dir_pin = dir_pin
+        self.pwm_pin = pwm_pin
+        self.encoder_pin = encoder_pin
+        # firmware sign, so models can work in EncodedMotor.get_position units
+        self.sign = -1 if flip else 1
+        self.free_speed = free_speed_rpm / 60  # rev/s
+        self.time_constant = time_constant
+        self.deadband = deadband
+
+        self.revolutions = 0.0
+        self.velocity = 0.0  # rev/s
+        self.effort = 0.0
+
+    def set_drive(self, direction_level, duty):
+        effort = duty / _MAX_PWM
+        self.effort = -effort if direction_level else effort
+
+    def advance(self, dt):
+        target = 0.0
+        if math.fabs(self.effort) > self.deadband:
+            target = self.effort * self.free_speed
+        decay = math.exp(-dt / self.time_constant)
+        start = self.velocity
+        self.velocity = target + (start - target) * decay
+        # exact integral of the first order response over dt
+        self.revolutions += target * dt + (start - target) * self.time_constant * (1 - decay)
+
+    @property
+    def position(self):
+        # position as seen through EncodedMotor.get_position
+        return self.revolutions * self.sign
+
+    @position.setter
+    def position(self, value):
+        self.revolutions = value * self.sign
+
+    def counts(self):
+        return int(math.floor(self.revolutions * self.COUNTS_PER_REVOLUTION))
+
+
+class Gantry:
+    """
+    CoreXY gantry driven by belts A and B, with hard stops at 0 and the
+    gantry size on each axis. Belt positions follow XY_motion:
+    a = y - x, b = -y - x (mm).
+    """
+    def __init__(self, motor_a, motor_b, turns_to_mm, x_size, y_size, x, y):
+        self.motor_a = motor_a
+        self.motor_b = motor_b
+        self.turns_to_mm = turns_to_mm
+        self.x_size = x_size
+        self.y_size = y_size
+        # belt positions (turns) that correspond to x = 0, y = 0
+        self.a_zero = motor_a.position - (y - x) / turns_to_mm
+        self.b_zero = motor_b.position - (-y - x) / turns_to_mm
+
+        # odometry for benchmarks
+        self.belt_travel = 0.0  # mm, |da| + |db|
+        self._last_ab = self.belt_mm()
+
+    def belt_mm(self):
+        a = (self.motor_a.position - self.a_zero) * self.turns_to_mm
+        b = (self.motor_b.position - self.b_zero) * self.turns_to_mm
+        return a, b
+
+    def position(self):
+        a, b = self.belt_mm()
+        return (-a - b) / 2, (a - b) / 2
+
+    def constrain(self):
+        x, y = self.position()
+        x_clamped = min(max(x, 0.0), self.x_size)
+        y_clamped = min(max(y, 0.0), self.y_size)
+        if x_clamped != x or y_clamped != y:
+            # the carriage is against a stop, the belts can't go further
+            self.motor_a.position = (y_clamped - x_clamped) / self.turns_to_mm + self.a_zero
+            self.motor_b.position = (-y_clamped - x_clamped) / self.turns_to_mm + self.b_zero
+        a, b = self.belt_mm()
+        self.belt_travel += math.fabs(a - self._last_ab[0]) + math.fabs(b - self._last_ab[1])
+        self._last_ab = (a, b)
+
+
+class ZAxis:
+    """
+    Rack and pinion z axis. Up is negative motor position (Z_motion's
+    DEFAULT_UP_EFFORT), the top stop is at 0 mm and the soil is [depth] mm
+    below it.
+    """
+    def __init__(self, motor, turns_to_mm, depth=25.0, z=5.0):
+        self.motor = motor
+        self.turns_to_mm = turns_to_mm
+        self.depth = depth
+        self.zero = motor.position - z / turns_to_mm
+        self.in_soil = False
+        self.inserted_at = None
+        # number of times the probe went into the soil
+        self.cycles = 0
+
+    def depth_mm(self):
+        return (self.motor.position - self.zero) * self.turns_to_mm
+
+    def constrain(self, now):
+        z = self.depth_mm()
+        z_clamped = min(max(z, 0.0), self.depth)
+        if z_clamped != z:
+            self.motor.position = z_clamped / self.turns_to_mm + self.zero
+        in_soil = z_clamped >= self.depth - 2.0
+        if in_soil and not self.in_soil:
+            self.cycles += 1
+            self.inserted_at = now
+        self.in_soil = in_soil
+
+
+class MoistureField:
+    """
+    Soil moisture (0-100 %) over the bed. A smooth random landscape that
+    gets wetter wherever water is dispensed.
+    """
+    def __init__(self, seed=0, mean=45.0, spread=25.0, patch_size=120.0):
+        rng = random.Random(seed)
+        self.mean = mean
+        self.spread = spread
+        self.waves = [(rng.uniform(0.5, 1.5) / patch_size, rng.uniform(0.5, 1.5) / patch_size,
+                       rng.uniform(0, 2 * math.pi), rng.uniform(0, 2 * math.pi))
+                      for _ in range(3)]
+        self.watered = []  # (x, y, ml)
+
+    def moisture_at(self, x, y):
+        value = 0.0
+        for kx, ky, px, py in self.waves:
+            value += math.sin(kx * x + px) * math.cos(ky * y + py)
+        value = self.mean + self.spread * value / len(self.waves)
+        for wx, wy, ml in self.watered:
+            distance_2 = (x - wx) ** 2 + (y - wy) ** 2
+            value += 0.5 * ml * math.exp(-distance_2 / (2 * 40.0 ** 2))
+        return min(max(value, 0.0), 100.0)
+
+    def water(self, x, y, ml):
+        if self.watered and self.watered[-1][0] == x and self.watered[-1][1] == y:
+            self.watered[-1] = (x, y, self.watered[-1][2] + ml)
+        else:
+            self.watered.append((x, y, ml))
+
+
+class MoistureProbe:
+    """
+    Capacitive probe on the z axis. It reads air while raised and settles
+    towards the soil moisture after it goes in.
+    """
+    def __init__(self, field, settle_time=0.3, noise=1.5, air=2.0, seed=0):
+        self.field = field
+        self.settle_time = settle_time
+        self.noise = noise
+        self.air = air
+        self.rng = random.Random(seed)
+
+    def read_percent(self, board):
+        z = board.z_axis
+        if not z.in_soil:
+            value = self.air
+        else:
+            x, y = board.gantry.position()
+            soil = self.field.moisture_at(x, y)
+            elapsed = board.clock.now - z.inserted_at
+            value = soil + (self.air - soil) * math.exp(-elapsed / self.settle_time)
+        value += self.rng.gauss(0, self.noise)
+        return min(max(value, 0.0), 100.0)
+
+
+class DS3231:
+    """
+    Register model of the DS3231 real time clock (registers 0x00-0x06, BCD).
+    The weekday register is kept as written and advances once a day.
+    [drift_ppm] is how much faster than the virtual clock (the Pico's
+    crystal) it runs.
+    """
+    def __init__(self, clock, start=datetime.datetime(2024, 6, 10, 8, 0, 0), weekday=3, drift_ppm=0):
+        self.clock = clock
+        self.drift_ppm = drift_ppm
+        self._set(start, weekday)
+
+    def _set(self, when, weekday):
+        self._base = when
+        self._base_weekday = weekday
+        self._base_now = self.clock.now
+
+    def now(self):
+        elapsed = self.clock.now - self._base_now
+        return self._base + datetime.timedelta(seconds=elapsed * (1 + self.drift_ppm / 1e6))
+
+    def weekday(self):
+        days = (self.now().date() - self._base.date()).days
+        return (self._base_weekday + days) % 7
+
+    @staticmethod
+    def _bcd(value):
+        return ((value // 10) << 4) + (value % 10)
+
+    @staticmethod
+    def _bin(value):
+        return value - 6 * (value >> 4)
+
+    def registers(self):
+        now = self.now()
+        return bytearray([self._bcd(now.second), self._bcd(now.minute), self._bcd(now.hour),
+                          self._bcd(self.weekday()), self._bcd(now.day), self._bcd(now.month),
+                          self._bcd(now.year - 2000)])
+
+    def read(self, register, count):
+        data = self.registers() + bytearray(0x13 - 7)
+        return bytes(data[register:register + count])
+
+    def write(self, register, data):
+        regs = self.registers()
+        for i, value in enumerate(data):
+            if register + i < 7:
+                regs[register + i] = value
+        values = [self._bin(v) for v in regs]
+        second, minute, hour, weekday, day, month, year = values
+        try:
+            when = datetime.datetime(2000 + year, month, day, hour, minute, second)
+        except ValueError:
+            # the real chip happily stores nonsense, keep the time running
+            return
+        self._set(when, weekday)
+
+
+class Board:
+    """
+    Everything wired to the XRP board. The firmware talks to it through
+    the simulated machine and rp2 modules.
+    """
+    def __init__(self, clock, x_size=400.0, y_size=300.0, start_xy=(200.0, 150.0),
+                 field=None, start_time=datetime.datetime(2024, 6, 10, 8, 0, 0),
+                 rtc_drift_ppm=0, seed=0):
+        self.clock = clock
+        self.motors = [
+            DCMotor(6, 7, 4, flip=True),
+            DCMotor(14, 15, 12),
+            DCMotor(2, 3, 0),
+            DCMotor(10, 11, 8, flip=True),
+        ]
+        self._by_dir_pin = {m.dir_pin: m for m in self.motors}
+        self._by_pwm_pin = {m.pwm_pin: m for m in self.motors}
+        self._by_encoder_pin = {m.encoder_pin: m for m in self.motors}
+
+        # AgBot geometry, kept in sync with xy_motion / z_motion / pump defaults
+        belt_turns_to_mm = (9 / 24) * (9 / 27) * (36 * 2)
+        self.gantry = Gantry(self.motors[0], self.motors[1], belt_turns_to_mm,
+                             x_size, y_size, start_xy[0], start_xy[1])
+        self.z_axis = ZAxis(self.motors[3], 12 * math.pi)
+        self.pump_turns_to_ml = 1.5
+        self.water_dispensed = 0.0  # ml
+        self._pump_last = self.motors[2].position
+
+        self.field = field if field is not None else MoistureField(seed)
+        self.probe = MoistureProbe(self.field, seed=seed)
+        self.adc_channels = {27: self.probe}
+        self.i2c_devices = {0x68: DS3231(clock, start_time, drift_ppm=rtc_drift_ppm)}
+        self.i2c_transactions = 0
+
+        self.pin_levels = {}
+        self.pwm_duty = {}
+        self._last_update = clock.now
+
+    ### Physics
+
+    def update(self):
+        dt = self.clock.now - self._last_update
+        if dt < MIN_UPDATE_INTERVAL:
+            return
+        self._last_update = self.clock.now
+        for motor in self.motors:
+            motor.advance(dt)
+        self.gantry.constrain()
+        self.z_axis.constrain(self.clock.now)
+
+        pump_position = self.motors[2].position
+        turns = pump_position - self._pump_last
+        self._pump_last = pump_position
+        if turns > 0:
+            ml = turns / self.pump_turns_to_ml
+            self.water_dispensed += ml
+            x, y = self.gantry.position()
+            self.field.water(x, y, ml)
+
+    def _drive_changed(self, pin_id):
+        motor = self._by_dir_pin.get(pin_id) or self._by_pwm_pin.get(pin_id)
+        if motor is None:
+            return
+        self.update()
+        motor.set_drive(self.pin_levels.get(motor.dir_pin, 0),
+                        self.pwm_duty.get(motor.pwm_pin, 0))
+
+    ### Pins
+
+    def set_pin(self, pin_id, level):
+        self.clock.spend(PIN_ACCESS_COST)
+        self.pin_levels[pin_id] = 1 if level else 0
+        self._drive_changed(pin_id)
+
+    def get_pin(self, pin_id):
+        self.clock.spend(PIN_ACCESS_COST)
+        return self.pin_levels.get(pin_id, 0)
+
+    def set_duty(self, pin_id, duty):
+        self.clock.spend(PIN_ACCESS_COST)
+        self.pwm_duty[pin_id] = max(0, min(65535, int(duty)))
+        self._drive_changed(pin_id)
+
+    def get_duty(self, pin_id):
+        return self.pwm_duty.get(pin_id, 0)
+
+    ### Peripherals
+
+    def encoder_counts(self, base_pin):
+        self.clock.spend(PIO_READ_COST)
+        self.update()
+        motor = self._by_encoder_pin.get(base_pin)
+        if motor is None:
+            return 0
+        return motor.counts()
+
+    def read_adc(self, pin_id):
+        self.clock.spend(ADC_READ_COST)
+        self.update()
+        channel = self.adc_channels.get(pin_id)
+        if channel is None:
+            return 0
+        return int(channel.read_percent(self) / 100 * 65535)
+
+    def i2c_device(self, address):
+        return self.i2c_devices.get(address)
+
+    ### Odometry
+
+    def stats(self):
+        self.update()
+        return {
+            "belt_travel_mm": self.gantry.belt_travel,
+            "z_cycles": self.z_axis.cycles,
+            "water_dispensed_ml": self.water_dispensed,
+            "i2c_transactions": self.i2c_transactions,
+        }
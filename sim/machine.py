@@ -0,0 +1,209 @@
+"""
+Simulated `machine` module, wired to the board model in sim.hardware.
+"""
+from sim import hardware as _hw
+from sim import runtime as _runtime
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self.mode = mode
+        self.pull = pull
+        if value is not None:
+            self.value(value)
+
+    def init(self, mode=-1, pull=-1, value=None):
+        self.mode = mode
+        self.pull = pull
+        if value is not None:
+            self.value(value)
+
+    def value(self, level=None):
+        if level is None:
+            return _runtime.board().get_pin(self.id)
+        _runtime.board().set_pin(self.id, level)
+
+    def __call__(self, level=None):
+        return self.value(level)
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    high = on
+    low = off
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING):
+        return None
+
+    def __repr__(self):
+        return "Pin(%d)" % self.id
+
+
+class PWM:
+    def __init__(self, pin, freq=None, duty_u16=None):
+        self.pin = pin
+        self._freq = 0
+        if freq is not None:
+            self.freq(freq)
+        if duty_u16 is not None:
+            self.duty_u16(duty_u16)
+
+    def freq(self, value=None):
+        if value is None:
+            return self._freq
+        self._freq = value
+
+    def duty_u16(self, value=None):
+        if value is None:
+            return _runtime.board().get_duty(self.pin.id)
+        _runtime.board().set_duty(self.pin.id, value)
+
+    def deinit(self):
+        _runtime.board().set_duty(self.pin.id, 0)
+
+
+class ADC:
+    def __init__(self, pin):
+        self.pin_id = pin.id if isinstance(pin, Pin) else pin
+
+    def read_u16(self):
+        return _runtime.board().read_adc(self.pin_id)
+
+
+class I2C:
+    def __init__(self, id, scl=None, sda=None, freq=400000):
+        self.id = id
+        self.freq = freq
+
+    def _device(self, address):
+        board = _runtime.board()
+        board.i2c_transactions += 1
+        device = board.i2c_device(address)
+        if device is None:
+            # what MicroPython raises when nothing acks the address
+            raise OSError(5, "EIO")
+        return device
+
+    def scan(self):
+        return sorted(_runtime.board().i2c_devices.keys())
+
+    def readfrom_mem(self, address, register, count, addrsize=8):
+        device = self._device(address)
+        _runtime.clock().spend((count + 2) * _hw.I2C_BYTE_COST)
+        return device.read(register, count)
+
+    def readfrom_mem_into(self, address, register, buf, addrsize=8):
+        buf[:] = self.readfrom_mem(address, register, len(buf))
+
+    def writeto_mem(self, address, register, data, addrsize=8):
+        device = self._device(address)
+        _runtime.clock().spend((len(data) + 2) * _hw.I2C_BYTE_COST)
+        device.write(register, bytes(data))
+
+
+class Timer:
+    """
+    Virtual timer. Callbacks run like soft interrupts, whenever virtual
+    time (advanced by the asyncio loop or by hardware accesses) passes
+    their deadline.
+    """
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id=-1, mode=PERIODIC, period=-1, freq=-1, callback=None):
+        self.id = id
+        self._period = None
+        self._callback = None
+        if callback is not None:
+            self.init(mode=mode, period=period, freq=freq, callback=callback)
+
+    def init(self, mode=PERIODIC, period=-1, freq=-1, callback=None):
+        self.deinit()
+        if freq > 0:
+            period = 1000 / freq
+        self._mode = mode
+        self._period = period / 1000
+        self._callback = callback
+        clock = _runtime.clock()
+        clock.add_timer(self, clock.now + self._period)
+
+    def deinit(self):
+        if self._callback is not None:
+            _runtime.clock().remove_timer(self)
+        self._callback = None
+
+    def fire(self):
+        callback = self._callback
+        if callback is None:
+            return
+        if self._mode == Timer.PERIODIC:
+            clock = _runtime.clock()
+            clock.add_timer(self, clock.now + self._period)
+        else:
+            self._callback = None
+        callback(self)
+
+
+class RTC:
+    """
+    The Pico's internal RTC, following the board's DS3231
+    """
+    def datetime(self, value=None):
+        if value is not None:
+            return
+        ds3231 = _runtime.board().i2c_device(0x68)
+        now = ds3231.now()
+        return (now.year, now.month, now.day, now.weekday(), now.hour, now.minute, now.second, 0)
+
+
+class ResetError(SystemExit):
+    pass
+
+
+def reset():
+    raise ResetError("machine.reset()")
+
+
+def soft_reset():
+    raise ResetError("machine.soft_reset()")
+
+
+def freq(value=None):
+    if value is None:
+        return 125000000
+
+
+def unique_id():
+    return b"\xe6\x61\x41\x04\x03\x57\x2b\x21"
+
+
+def idle():
+    _runtime.clock().spend(1e-3)
+
+
+def lightsleep(time_ms=None):
+    if time_ms is not None:
+        _runtime.clock().spend(time_ms / 1000)
+
+
+deepsleep = lightsleep
+
+
+def disable_irq():
+    return 0
+
+
+def enable_irq(state=0):
+    pass
@@ -0,0 +1,34 @@
+"""
+Simulated `micropython` module.
+"""
+from sim import runtime as _runtime
+
+
+def const(value):
+    return value
+
+
+def native(func):
+    return func
+
+
+viper = native
+
+
+def opt_level(level=None):
+    return 0
+
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+
+def mem_info(verbose=None):
+    import gc
+    print("stack: 0 out of 7936")
+    print("GC: total: %d, used: %d, free: %d" % (gc.mem_alloc() + gc.mem_free(),
+                                                 gc.mem_alloc(), gc.mem_free()))
+
+
+def schedule(func, arg):
+    _runtime.loop().call_soon(func, arg)
@@ -0,0 +1,64 @@
+"""
+Simulated `rp2` module. Only what XRPLib's PIO quadrature encoder needs:
+the program is never assembled, the state machine reports the count of
+the motor wired to its input pins.
+"""
+from sim import runtime as _runtime
+
+
+class PIO:
+    IN_LOW = 0
+    IN_HIGH = 1
+    OUT_LOW = 2
+    OUT_HIGH = 3
+    SHIFT_LEFT = 0
+    SHIFT_RIGHT = 1
+    JOIN_NONE = 0
+    JOIN_TX = 1
+    JOIN_RX = 2
+
+
+def asm_pio(**settings):
+    def decorator(program):
+        program.pio_settings = settings
+        return program
+    return decorator
+
+
+class StateMachine:
+    def __init__(self, id, program=None, freq=-1, in_base=None, **kwargs):
+        self.id = id
+        self.program = program
+        self.in_base = in_base.id if in_base is not None else None
+        self._active = 0
+        self._offset = 0
+
+    def init(self, program=None, freq=-1, in_base=None, **kwargs):
+        self.program = program
+        if in_base is not None:
+            self.in_base = in_base.id
+
+    def active(self, value=None):
+        if value is None:
+            return self._active
+        self._active = 1 if value else 0
+
+    def _counts(self):
+        return _runtime.board().encoder_counts(self.in_base)
+
+    def exec(self, instruction):
+        if instruction.replace(" ", "") == "set(x,0)":
+            self._offset = self._counts()
+
+    def get(self, buf=None, shift=0):
+        # X register, pushed as an unsigned 32 bit word
+        return (self._counts() - self._offset) & 0xFFFFFFFF
+
+    def put(self, value, shift=0):
+        pass
+
+    def rx_fifo(self):
+        return 4
+
+    def tx_fifo(self):
+        return 0
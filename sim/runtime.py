@@ -0,0 +1,45 @@
+"""
+The running simulation: one virtual clock, its asyncio loop and the board.
+"""
+from sim.clock import VirtualClock, VirtualTimeLoop
+from sim.hardware import Board
+
+_clock = None
+_loop = None
+_board = None
+_radio = None
+
+
+def start(**board_args):
+    global _clock, _loop, _board, _radio
+    from sim.ble import Radio
+    _clock = VirtualClock()
+    _loop = VirtualTimeLoop(_clock)
+    _board = Board(_clock, **board_args)
+    _radio = Radio()
+
+
+def replace_board(**board_args):
+    """
+    Swaps in a fresh board (new bed, new moisture field) on the same clock.
+    Firmware objects look the board up on every access so they follow along.
+    """
+    global _board
+    _board = Board(_clock, **board_args)
+    return _board
+
+
+def clock():
+    return _clock
+
+
+def loop():
+    return _loop
+
+
+def board():
+    return _board
+
+
+def radio():
+    return _radio
@@ -0,0 +1,57 @@
+"""
+Simulated `uasyncio` module.
+
+CPython's asyncio running on the simulation's virtual clock, trimmed to
+what MicroPython's asyncio provides (so code that would not run on the
+Pico, e.g. asyncio.Queue, fails here too) plus the *_ms helpers.
+"""
+import asyncio as _asyncio
+
+from sim import runtime as _runtime
+
+CancelledError = _asyncio.CancelledError
+TimeoutError = _asyncio.TimeoutError
+Task = _asyncio.Task
+Event = _asyncio.Event
+Lock = _asyncio.Lock
+
+create_task = _asyncio.create_task
+current_task = _asyncio.current_task
+gather = _asyncio.gather
+sleep = _asyncio.sleep
+wait_for = _asyncio.wait_for
+
+
+async def sleep_ms(ms):
+    await _asyncio.sleep(ms / 1000)
+
+
+async def wait_for_ms(aw, timeout):
+    return await _asyncio.wait_for(aw, timeout / 1000)
+
+
+class ThreadSafeFlag:
+    def __init__(self):
+        self._event = _asyncio.Event()
+
+    def set(self):
+        self._event.set()
+
+    def clear(self):
+        self._event.clear()
+
+    async def wait(self):
+        await self._event.wait()
+        self._event.clear()
+
+
+def get_event_loop():
+    return _runtime.loop()
+
+
+def new_event_loop():
+    return _runtime.loop()
+
+
+def run(coro):
+    return _runtime.loop().run_until_complete(coro)
@@ -0,0 +1,182 @@
+"""
+Software clock disciplined by the DS3231.
+
+Clock.get_time costs a 7 byte I2C transaction, BCD decoding and string
+formatting per call. SoftClock reads the DS3231 once, then serves the
+time from time.ticks_ms(), reading it again every [resync_period_ms]
+(from run(), not from the callers) to follow it.
+
+At a resync the software time is kept, sub second phase included, while
+it still agrees with the second read from the DS3231. When it does not
+it is stepped to the nearest edge of that second (by more than
+[max_step_s] the clock was set and the drift estimate starts over).
+
+The drift of ticks_ms against the DS3231 is measured over all the time
+since the last step and corrected, in ppm. The DS3231 only gives whole
+seconds so the estimate waits for [min_baseline_ms] of baseline.
+
+All the arithmetic is on ints, floats on the Pico are single precision
+and can not hold seconds since 2000.
+"""
+import uasyncio as asyncio
+
+import time
+
+from clock import Clock
+from record_log import timestamp, date_from_timestamp
+
+class default_soft_clock_params:
+    # how often the DS3231 is read again (ms)
+    RESYNC_PERIOD_MS = 10 * 60 * 1000
+    # a caller finding the last read older than this reads the DS3231 itself (ms),
+    # also keeps ticks_diff well inside its range
+    MAX_FREE_RUN_MS = 60 * 60 * 1000
+    # baseline needed before the drift is corrected (ms)
+    MIN_BASELINE_MS = 60 * 60 * 1000
+    # largest drift believed, more is a bad read (ppm)
+    MAX_DRIFT_PPM = 500
+    # a step larger than this is the clock being set (seconds)
+    MAX_STEP_S = 5
+
+
+class SoftClock:
+    _DEFAULT_SOFT_CLOCK_INSTANCE = None
+
+    @classmethod
+    def get_default_soft_clock(cls):
+        if cls._DEFAULT_SOFT_CLOCK_INSTANCE is None:
+            cls._DEFAULT_SOFT_CLOCK_INSTANCE = SoftClock(Clock.get_default_clock())
+        return cls._DEFAULT_SOFT_CLOCK_INSTANCE
+
+    def __init__(self, rtc,
+                 resync_period_ms=default_soft_clock_params.RESYNC_PERIOD_MS,
+                 max_free_run_ms=default_soft_clock_params.MAX_FREE_RUN_MS,
+                 min_baseline_ms=default_soft_clock_params.MIN_BASELINE_MS,
+                 max_drift_ppm=default_soft_clock_params.MAX_DRIFT_PPM,
+                 max_step_s=default_soft_clock_params.MAX_STEP_S):
+        self.rtc = rtc
+        self.resync_period_ms = resync_period_ms
+        self.max_free_run_ms = max_free_run_ms
+        self.min_baseline_ms = min_baseline_ms
+        self.max_drift_ppm = max_drift_ppm
+        self.max_step_s = max_step_s
+
+        # software time is base_seconds + (phase_ms + corrected ms since base_ticks) // 1000
+        self.base_seconds = None
+        self.base_ticks = 0
+        self.phase_ms = 0
+        self.drift_ppm = 0
+        # DS3231 seconds and ticks_ms elapsed since the drift baseline started
+        self.anchor_seconds = None
+        self.anchor_ms = 0
+        # last value served, the time does not go back between resyncs
+        self.last = None
+
+        # counters
+        self.reads = 0
+        self.steps = 0
+
+        self.sync()
+
+    def elapsed_ms(self, ticks):
+        # ms of DS3231 time since base_ticks, drift corrected
+        elapsed = time.ticks_diff(ticks, self.base_ticks)
+        return self.phase_ms + elapsed + elapsed * self.drift_ppm // 1000000
+
+    def read_rtc(self):
+        # Seconds since 2000 from the DS3231, None when it can not be read
+        self.reads += 1
+        time_now = self.rtc.read_time()
+        if time_now is None:
+            return None
+        return timestamp(*time_now)
+
+    def sync(self):
+        # Reads the DS3231 and disciplines the software time to it, returns False if it could not
+        seconds = self.read_rtc()
+        ticks = time.ticks_ms()
+        if seconds is None:
+            return False
+        if self.base_seconds is None:
+            self.step(seconds, ticks)
+            return True
+
+        elapsed = time.ticks_diff(ticks, self.base_ticks)
+        corrected = self.elapsed_ms(ticks)
+        predicted = self.base_seconds + corrected // 1000
+        if predicted == seconds:
+            # still agreeing, keep the sub second phase
+            self.base_seconds = seconds
+            self.phase_ms = corrected % 1000
+            self.base_ticks = ticks
+        elif abs(predicted - seconds) > self.max_step_s:
+            print("Clock stepped by ", seconds - predicted, "s")
+            self.anchor_seconds = None
+            self.step(seconds, ticks)
+            return True
+        else:
+            # off by a second or so: ahead, the DS3231 is about to tick; behind, it just did
+            self.step(seconds, ticks, 999 if predicted > seconds else 0)
+
+        self.anchor_ms += elapsed
+        if self.anchor_ms >= self.min_baseline_ms:
+            drift = ((seconds - self.anchor_seconds) * 1000 - self.anchor_ms) * 1000000 // self.anchor_ms
+            self.drift_ppm = max(-self.max_drift_ppm, min(self.max_drift_ppm, drift))
+        return True
+
+    def step(self, seconds, ticks, phase_ms=500):
+        # Sets the software time to [phase_ms] into DS3231 second [seconds]
+        if self.base_seconds is not None:
+            self.steps += 1
+        self.base_seconds = seconds
+        self.base_ticks = ticks
+        self.phase_ms = phase_ms
+        if self.anchor_seconds is None:
+            self.anchor_seconds = seconds
+            self.anchor_ms = 0
+            self.drift_ppm = 0
+            self.last = None
+
+    def timestamp(self):
+        # Seconds since 2000, None when the DS3231 was never read
+        if self.base_seconds is None or time.ticks_diff(time.ticks_ms(), self.base_ticks) >= self.max_free_run_ms:
+            if not self.sync() and self.base_seconds is None:
+                return None
+        seconds = self.base_seconds + self.elapsed_ms(time.ticks_ms()) // 1000
+        if self.last is not None and seconds < self.last:
+            return self.last
+        self.last = seconds
+        return seconds
+
+    def datetime(self):
+        # (year, month, day, hour, minute, second), None when the time is unknown
+        seconds = self.timestamp()
+        if seconds is None:
+            return None
+        return date_from_timestamp(seconds)
+
+    def set_time_piece_by_piece(self, sec, minute, hour, weekday, month, day, year):
+        self.rtc.set_time_piece_by_piece(sec, minute, hour, weekday, month, day, year)
+        self.anchor_seconds = None
+        self.base_seconds = None
+        self.sync()
+
+    def manual(self):
+        self.rtc.manual()
+        # the time may have been set
+        self.anchor_seconds = None
+        self.base_seconds = None
+        self.sync()
+
+    def stats(self):
+        return {
+            "rtc_reads": self.reads,
+            "steps": self.steps,
+            "drift_ppm": self.drift_ppm,
+        }
+
+    async def run(self):
+        # Reads the DS3231 every [resync_period_ms]
+        while True:
+            await asyncio.sleep_ms(self.resync_period_ms)
+            self.sync()
@@ -0,0 +1,86 @@
+import struct
+import time
+
+class default_telemetry_params:
+    # a position change bigger than this is sent right away (mm)
+    CHANGE_THRESHOLD_MM = 0.5
+    # how often the position is checked while moving (20 Hz)
+    MOVING_PERIOD_MS = 50
+    # how often the position is checked while still
+    IDLE_PERIOD_MS = 200
+    # a packet is sent at least this often, moving or not
+    HEARTBEAT_MS = 5000
+
+# Position packet, big endian:
+# Byte 0-1 -> Homed uint16
+# Byte 2-3 -> X uint16 (mm)
+# Byte 4-5 -> Y uint16 (mm)
+# Byte 6-7 -> Z uint16 (mm)
+# Byte 8-9 -> Sequence Number uint16
+# Byte 10-13 -> Timestamp uint32 (ms, time.ticks_ms)
+PACKET_FORMAT = ">HHHHHI"
+
+def to_uint16(value):
+    return min(max(int(value), 0), 0xFFFF)
+
+
+class PositionTelemetry:
+    """
+    Decides when the position is worth a notification: as soon as it
+    moved more than [change_threshold_mm] (so up to 1000 / moving_period_ms
+    times a second while moving) and every [heartbeat_ms] otherwise.
+    """
+    def __init__(self,
+                 change_threshold_mm=default_telemetry_params.CHANGE_THRESHOLD_MM,
+                 moving_period_ms=default_telemetry_params.MOVING_PERIOD_MS,
+                 idle_period_ms=default_telemetry_params.IDLE_PERIOD_MS,
+                 heartbeat_ms=default_telemetry_params.HEARTBEAT_MS):
+        self.change_threshold_mm = change_threshold_mm
+        self.moving_period_ms = moving_period_ms
+        self.idle_period_ms = idle_period_ms
+        self.heartbeat_ms = heartbeat_ms
+
+        self.seq = 0
+        self.last_sent = None
+        self.last_sent_ms = None
+        self.last_checked = None
+        self.moving = False
+
+        # counters
+        self.packets = 0
+        self.checks = 0
+
+    def period_ms(self):
+        # How long to wait before the next check
+        return self.moving_period_ms if self.moving else self.idle_period_ms
+
+    def update(self, homed, x, y, z, now_ms=None):
+        # The packet to send for this position, or None if nothing worth sending
+        if now_ms is None:
+            now_ms = time.ticks_ms()
+        self.checks += 1
+
+        # anything moving at all since the last check keeps the fast rate
+        position = (homed, x, y, z)
+        self.moving = self.last_checked is not None and position != self.last_checked
+        self.last_checked = position
+
+        changed = False
+        if self.last_sent is None or homed != self.last_sent[0]:
+            changed = True
+        else:
+            _, last_x, last_y, last_z = self.last_sent
+            changed = (abs(x - last_x) > self.change_threshold_mm or
+                       abs(y - last_y) > self.change_threshold_mm or
+                       abs(z - last_z) > self.change_threshold_mm)
+
+        if not changed and time.ticks_diff(now_ms, self.last_sent_ms) < self.heartbeat_ms:
+            return None
+
+        packet = struct.pack(PACKET_FORMAT, to_uint16(homed), to_uint16(x), to_uint16(y), to_uint16(z),
+                             self.seq, now_ms & 0xFFFFFFFF)
+        self.seq = (self.seq + 1) & 0xFFFF
+        self.last_sent = position
+        self.last_sent_ms = now_ms
+        self.packets += 1
+        return packet
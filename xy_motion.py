@@ -1,10 +1,14 @@
 from XRPLib.encoded_motor import EncodedMotor
+from XRPLib.encoder import Encoder
+from XRPLib.controller import Controller
 from XRPLib.pid import PID
 from XRPLib.timeout import Timeout
 import time
 import math
 import uasyncio as asyncio
 
+from motion_profile import MotionProfile, S_CURVE
+
 def bound_effort(value, max_effort=1.0):
         return max(0, min(max_effort, value))
 
@@ -14,6 +18,68 @@ class default_gantry_params:
     PULLEY_PITCH = 2 # mm
     TURNS_TO_MM = MOTOR_REDUCTION * (PULLEY_TEETH * PULLEY_PITCH)
 
+    ## Motion profile limits per belt, (A, B)
+    # A belt runs at about 13.5 mm/s at full effort (90 rpm motors, see
+    # SPEED_FEEDFORWARD), 13 keeps a little effort for position corrections
+    MAX_VELOCITY = (13, 13) # mm/s
+    # The motors reach full speed in about 150 ms, 100 mm/s^2 is well inside that
+    MAX_ACCELERATION = (100, 100) # mm/s^2
+    PROFILE_SHAPE = S_CURVE # TRAPEZOIDAL or S_CURVE
+
+    ## Profile tracking
+    CONTROL_PERIOD_MS = 20 # 50 Hz, same rate as the motor speed controllers
+    POSITION_KP = 2.0 # mm/s of correction per mm behind the profile
+    POSITION_TOLERANCE = 1.0 # mm, per belt
+    SETTLE_TIMEOUT = 1.0 # s allowed past the planned duration to reach tolerance
+
+    ## Belt speed control while following a profile, speeds in counts per 20ms
+    SPEED_FEEDFORWARD = 1 / 17.5 # effort per count/20ms, about 1 / free speed
+    STATIC_EFFORT = 0.1 # effort needed to get the belt moving
+    SPEED_KP = 0.03
+    SPEED_KI = 0.2
+    SPEED_MAX_INTEGRAL = 1.0
+
+class ProfileSpeedController(Controller):
+    """
+    Speed controller for belts following a motion profile.
+    The motor's default speed PID gets almost all of its effort from the
+    integral term, so it lags a changing target by a second or more and
+    overshoots when the profile stops. This one feeds the target speed
+    forward and only uses PI for the remaining error.
+    """
+    def __init__(self, motor: EncodedMotor,
+                 kv=default_gantry_params.SPEED_FEEDFORWARD,
+                 ks=default_gantry_params.STATIC_EFFORT,
+                 kp=default_gantry_params.SPEED_KP,
+                 ki=default_gantry_params.SPEED_KI,
+                 max_integral=default_gantry_params.SPEED_MAX_INTEGRAL):
+        self.motor = motor
+        self.kv = kv
+        self.ks = ks
+        self.pid = PID(kp=kp, ki=ki, max_integral=max_integral)
+
+    def update(self, error: float) -> float:
+        target = self.motor.target_speed or 0
+        effort = self.pid.update(error)
+        if target != 0:
+            effort += self.kv * target + math.copysign(self.ks, target)
+        return max(-1, min(1, effort))
+
+    def is_done(self) -> bool:
+        return self.pid.is_done()
+
+    def clear_history(self):
+        self.pid.clear_history()
+
+def track_speed(motor: EncodedMotor, speed_rpm: float):
+    # set_speed clears the speed PID history, so only call it to turn speed
+    # control on or off, otherwise just move the target along
+    if motor.target_speed is None or speed_rpm == 0:
+        motor.set_speed(speed_rpm)
+    else:
+        # rpm to counts per 20ms, as in EncodedMotor.set_speed
+        motor.target_speed = speed_rpm * Encoder.resolution / (60 * 50)
+
 class XY_motion:
     @classmethod
     def get_default_xy(cls, x = None, y = None):
@@ -25,21 +91,40 @@ class XY_motion:
         encMotor2.set_effort(0)
 
         xy_default = XY_motion(encMotor1, encMotor2, x, y,
-                        default_gantry_params.TURNS_TO_MM)
+                        default_gantry_params.TURNS_TO_MM,
+                        default_gantry_params.MAX_VELOCITY,
+                        default_gantry_params.MAX_ACCELERATION,
+                        default_gantry_params.PROFILE_SHAPE)
         return xy_default
 
     def stop(self):
-        self.motor_a.set_effort(0)
-        self.motor_b.set_effort(0)
+        # set_speed with no target also turns speed control off
+        self.motor_a.set_speed()
+        self.motor_b.set_speed()
 
     def __init__(self, motor_a: EncodedMotor, motor_b: EncodedMotor,
                  x_max = None, y_max = None,
-                 motor_turns_to_mm: float=default_gantry_params.TURNS_TO_MM):
+                 motor_turns_to_mm: float=default_gantry_params.TURNS_TO_MM,
+                 max_velocity=default_gantry_params.MAX_VELOCITY,
+                 max_acceleration=default_gantry_params.MAX_ACCELERATION,
+                 profile_shape: int=default_gantry_params.PROFILE_SHAPE):
         self.zero_zero = (motor_a.get_position(), motor_b.get_position())
         self.motor_a = motor_a
         self.motor_b = motor_b
         self.turns_to_mm = motor_turns_to_mm
 
+        self.speed_controller_a = ProfileSpeedController(motor_a)
+        self.speed_controller_b = ProfileSpeedController(motor_b)
+
+        ## Motion profile limits, (A, B) in mm/s and mm/s^2
+        self.max_velocity = max_velocity
+        self.max_acceleration = max_acceleration
+        self.profile_shape = profile_shape
+
+        ## Planned and actual duration of the last move (s)
+        self.last_move_planned = 0
+        self.last_move_actual = 0
+
         self.x_max = x_max
         self.y_max = y_max
 
@@ -103,8 +188,6 @@ class XY_motion:
     async def move_relative_xy(self,
                 x:float,
                 y:float,
-                base_effort:float=0.8,
-                kp:float=10,
                 check_safety = True):
         if check_safety and not self.safe_to_move():
             return
@@ -122,17 +205,18 @@ class XY_motion:
         relative_b_turns = relative_b_mm / self.turns_to_mm
         print(f"Moving {x} in x and {y} in y. Traveling from {self.get_position()} to {(x,y)}")
         print(f"Relative a: {relative_a_mm} and b: {relative_b_mm}")
-        await self.move_relative_ab(relative_a_turns, relative_b_turns, base_effort, kp, check_safety=check_safety)
+        await self.move_relative_ab(relative_a_turns, relative_b_turns, check_safety=check_safety)
 
     async def move_relative_ab(self,
                delta_a:float, # turns
                delta_b:float, # turns
-               base_effort:float=0.8,
-               kp:float=10,
-               proximity_distance=5, # mm
-               slow_down_distance=10, # mm
-               slow_down_effort=0.5,
+               kp:float=default_gantry_params.POSITION_KP,
+               position_tolerance=default_gantry_params.POSITION_TOLERANCE, # mm
+               settle_timeout=default_gantry_params.SETTLE_TIMEOUT, # s
                check_safety = True):
+        ### Follows a motion profile on each belt with closed loop speed control.
+        # Both profiles are stretched to the slower one so the belts finish
+        # together and the gantry moves in a straight line.
 
         print("Moving Reletive")
 
@@ -141,53 +225,45 @@ class XY_motion:
         startingA = self.motor_a.get_position()
         startingB = self.motor_b.get_position()
 
-        targetA = startingA + delta_a
-        targetB = startingB + delta_b
-
-        encoderCorrection_max = 1 - base_effort
-        peak_effort = 1.0
-
-        # counter = 0
-
-        while(True):
-            x, y = self.get_position()
-
-            total_mm_diff = math.fabs(targetA - self.motor_a.get_position()) + math.fabs(targetB - self.motor_b.get_position()) * self.turns_to_mm
-            if total_mm_diff < proximity_distance:
-                ### if within 5 mm of target of sum belt length diff, exit
-                break
-            elif total_mm_diff < slow_down_distance:
-                ### if within 50 mm of target of sum belt length diff, slow down
-                peak_effort = slow_down_effort
-
-            delta_a_so_far = self.motor_a.get_position() - startingA
-            delta_a_to_done = targetA - self.motor_a.get_position()
-            if delta_a_to_done == 0 or delta_a == 0:
-                a_fraction_done = 1
-            else:
-                a_fraction_done = delta_a_so_far / delta_a
-
-            delta_b_so_far = self.motor_b.get_position() - startingB
-            delta_b_to_done = targetB - self.motor_b.get_position()
-            if delta_b_to_done == 0 or delta_b == 0:
-                b_fraction_done = 1
-            else:
-                b_fraction_done = delta_b_so_far / delta_b
-
-            encoderCorrection = kp*(a_fraction_done - b_fraction_done)
-
-            if not delta_a_to_done:
-                delta_a_to_done = 1
-
-            a_effort = bound_effort(base_effort - encoderCorrection, peak_effort) * math.copysign(1, delta_a_to_done)
-            b_effort = bound_effort(base_effort + encoderCorrection, peak_effort) * math.copysign(1, delta_b_to_done)
-
-            self.motor_a.set_effort(a_effort)
-            self.motor_b.set_effort(b_effort)
-            await asyncio.sleep(0.1)
-
-        self.motor_a.set_effort(0)
-        self.motor_b.set_effort(0)
+        profile_a = MotionProfile(delta_a * self.turns_to_mm, self.max_velocity[0],
+                                  self.max_acceleration[0], self.profile_shape)
+        profile_b = MotionProfile(delta_b * self.turns_to_mm, self.max_velocity[1],
+                                  self.max_acceleration[1], self.profile_shape)
+        planned_duration = max(profile_a.duration, profile_b.duration)
+        profile_a.stretch(planned_duration)
+        profile_b.stretch(planned_duration)
+
+        self.motor_a.set_speed_controller(self.speed_controller_a)
+        self.motor_b.set_speed_controller(self.speed_controller_b)
+        start_time = time.ticks_ms()
+        try:
+            while True:
+                t = time.ticks_diff(time.ticks_ms(), start_time) / 1000
+
+                target_a, velocity_a = profile_a.sample(t)
+                target_b, velocity_b = profile_b.sample(t)
+                error_a = target_a - (self.motor_a.get_position() - startingA) * self.turns_to_mm
+                error_b = target_b - (self.motor_b.get_position() - startingB) * self.turns_to_mm
+
+                if t >= planned_duration:
+                    if math.fabs(error_a) < position_tolerance and math.fabs(error_b) < position_tolerance:
+                        break
+                    if t >= planned_duration + settle_timeout:
+                        print(f"Move did not settle, off by {(error_a, error_b)} mm")
+                        break
+
+                # profile velocity plus a correction for how far behind the profile we are, in rpm
+                track_speed(self.motor_a, (velocity_a + kp * error_a) / self.turns_to_mm * 60)
+                track_speed(self.motor_b, (velocity_b + kp * error_b) / self.turns_to_mm * 60)
+                await asyncio.sleep_ms(default_gantry_params.CONTROL_PERIOD_MS)
+        finally:
+            self.stop()
+            self.motor_a.set_speed_controller(self.motor_a.DEFAULT_SPEED_CONTROLLER)
+            self.motor_b.set_speed_controller(self.motor_b.DEFAULT_SPEED_CONTROLLER)
+
+        self.last_move_planned = planned_duration
+        self.last_move_actual = time.ticks_diff(time.ticks_ms(), start_time) / 1000
+        print(f"Move planned {self.last_move_planned:.2f} s, took {self.last_move_actual:.2f} s")
 
     async def bang(self,
              A_Motor_Direction = 1,